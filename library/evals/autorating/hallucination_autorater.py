@@ -25,10 +25,23 @@ from autorating_utils import (
     format_summary,
     generate_evaluation_report,
 )
-from models.vertex_model import VertexModel, run_tasks_in_parallel
+from models.model_util import stream_tasks_in_parallel
+from models.vertex_model import VertexModel
 import pandas as pd
 
 
+def _null_result(statement: str, comments: str) -> dict[str, str]:
+  """Returns the result row for a statement that couldn't be rated."""
+  return {
+      "statement": statement,
+      "comments": comments,
+      "has_hallucinations": "NULL",
+      "analysis": "NULL",
+      "explanation": "NULL",
+      "runtime": "NULL",
+  }
+
+
 class HallucinationAutorater:
 
   def __init__(self, model: VertexModel, output_dir: str):
@@ -118,25 +131,11 @@ For example:
 
       except Exception as e:
         logging.error(f"Error during LLM call or parsing: {e}")
-        return {
-            "statement": statement,
-            "comments": comments,
-            "has_hallucinations": "NULL",
-            "analysis": "NULL",
-            "explanation": "NULL",
-            "runtime": "NULL",
-        }
+        return _null_result(statement, comments)
 
       if not response:
         logging.warning("Skipping due to invalid response from LLM.")
-        return {
-            "statement": statement,
-            "comments": comments,
-            "has_hallucinations": "NULL",
-            "analysis": "NULL",
-            "explanation": "NULL",
-            "runtime": "NULL",
-        }
+        return _null_result(statement, comments)
 
       statement_runtime_sec = time.perf_counter() - start_time_statement
       logging.info(
@@ -152,7 +151,24 @@ For example:
           "runtime": f"{statement_runtime_sec:.2f}",
       }
 
-    results = await run_tasks_in_parallel(prompts, evaluate)
+    def log_progress(num_done: int, num_failed: int):
+      if num_done % 100 == 0 or num_done == len(prompts):
+        logging.info(
+            f"Rated {num_done}/{len(prompts)} statements ({num_failed} failed)."
+        )
+
+    # Results are put in place as they finish, so a slow statement doesn't
+    # hold back the others.
+    results = [None] * len(prompts)
+    async for task_result in stream_tasks_in_parallel(
+        prompts, evaluate, on_progress=log_progress
+    ):
+      result = task_result.result
+      if task_result.error is not None:
+        logging.error(f"Error evaluating statement: {task_result.error}")
+        _, statement, comments = task_result.item
+        result = _null_result(statement, comments)
+      results[task_result.index] = result
 
     for result in results:
       # add to dataframe
@@ -86,11 +86,11 @@ async def main():
   )
   args = parser.parse_args()
 
-  model = VertexModel(args.gcpProject, args.location, args.model)
-  autorater = HallucinationAutorater(model, args.outputDir)
-  summaries = read_csv(args.inputFile)
+  with VertexModel(args.gcpProject, args.location, args.model) as model:
+    autorater = HallucinationAutorater(model, args.outputDir)
+    summaries = read_csv(args.inputFile)
 
-  await autorater.rate_hallucination(summaries, args.additionalContext)
+    await autorater.rate_hallucination(summaries, args.additionalContext)
 
 
 if __name__ == "__main__":
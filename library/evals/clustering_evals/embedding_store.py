@@ -0,0 +1,203 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A persistent on-disk store for text embeddings, backed by SQLite.
+
+Embeddings are keyed by the embedding model, task type, output dimensionality
+and a hash of the text, so re-running evals on the same data doesn't request
+any embeddings again.
+"""
+
+import hashlib
+import logging
+import sqlite3
+import time
+import numpy as np
+
+# The default maximum total size of the stored embeddings.
+DEFAULT_MAX_SIZE_BYTES = 1024**3
+# How much of the database to memory map for reads.
+MMAP_SIZE_BYTES = 256 * 1024**2
+# The fraction of the maximum size the store is shrunk to when it's evicting,
+# so that eviction doesn't run again after every write.
+EVICTION_TARGET = 0.9
+# SQLite's default limit on the number of parameters in a statement is 999.
+MAX_QUERY_PARAMS = 900
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+  model TEXT NOT NULL,
+  task_type TEXT NOT NULL,
+  dimensionality INTEGER NOT NULL,
+  text_hash BLOB NOT NULL,
+  vector BLOB NOT NULL,
+  last_used REAL NOT NULL,
+  PRIMARY KEY (model, task_type, dimensionality, text_hash)
+);
+CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used);
+"""
+
+
+def _hash_text(text: str) -> bytes:
+  return hashlib.sha256(text.encode("utf-8")).digest()
+
+
+class EmbeddingStore:
+  """Stores embeddings as float32 blobs in a SQLite database.
+
+  When the stored embeddings exceed the maximum size, the least recently used
+  ones are evicted. The size is tracked as embeddings are stored and evicted,
+  so writes don't scan the whole table. It's only recomputed before evicting,
+  in case other processes wrote to the same database.
+  """
+
+  def __init__(
+      self, path: str, max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES
+  ):
+    """Opens the store, creating it if it doesn't exist.
+
+    Args:
+      path: The path of the SQLite database file.
+      max_size_bytes: The maximum total size of the stored embeddings.
+    """
+    self.path = path
+    self.max_size_bytes = max_size_bytes
+    self._connection = sqlite3.connect(path)
+    self._connection.execute(f"PRAGMA mmap_size = {MMAP_SIZE_BYTES}")
+    self._connection.execute("PRAGMA journal_mode = WAL")
+    self._connection.executescript(_SCHEMA)
+    self._size_bytes = self.size_bytes()
+
+  def close(self):
+    self._connection.close()
+
+  def get_many(
+      self,
+      texts: list[str],
+      model: str,
+      task_type: str,
+      dimensionality: int | None = None,
+  ) -> dict[str, np.ndarray]:
+    """Returns the stored embeddings for the texts that have one.
+
+    Args:
+      texts: The texts to look up.
+      model: The embedding model.
+      task_type: The task type the embeddings were requested for.
+      dimensionality: The requested output dimensionality, or None for the
+        model's default.
+
+    Returns:
+      A dict from each text found in the store to its embedding.
+    """
+    hashes = {_hash_text(text): text for text in texts}
+    hash_list = list(hashes)
+    key = (model, task_type, dimensionality or 0)
+    found = {}
+    with self._connection:
+      for i in range(0, len(hash_list), MAX_QUERY_PARAMS):
+        batch = hash_list[i : i + MAX_QUERY_PARAMS]
+        placeholders = ",".join("?" * len(batch))
+        rows = self._connection.execute(
+            "SELECT text_hash, vector FROM embeddings WHERE model = ? AND"
+            " task_type = ? AND dimensionality = ? AND text_hash IN"
+            f" ({placeholders})",
+            (*key, *batch),
+        ).fetchall()
+        for text_hash, vector in rows:
+          found[hashes[text_hash]] = np.frombuffer(vector, dtype=np.float32)
+        self._connection.executemany(
+            "UPDATE embeddings SET last_used = ? WHERE model = ? AND"
+            " task_type = ? AND dimensionality = ? AND text_hash = ?",
+            [(time.time(), *key, text_hash) for text_hash, _ in rows],
+        )
+    return found
+
+  def put_many(
+      self,
+      embeddings: dict[str, np.ndarray],
+      model: str,
+      task_type: str,
+      dimensionality: int | None = None,
+  ):
+    """Stores embeddings, then evicts old ones if the store is too large.
+
+    Args:
+      embeddings: A dict from texts to their embeddings.
+      model: The embedding model.
+      task_type: The task type the embeddings were requested for.
+      dimensionality: The requested output dimensionality, or None for the
+        model's default.
+    """
+    now = time.time()
+    key = (model, task_type, dimensionality or 0)
+    rows = [
+        (*key, _hash_text(text), np.asarray(vector, dtype=np.float32).tobytes())
+        for text, vector in embeddings.items()
+    ]
+    with self._connection:
+      replaced_size = self._stored_size(key, [row[3] for row in rows])
+      self._connection.executemany(
+          "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?, ?, ?)",
+          [(*row, now) for row in rows],
+      )
+    self._size_bytes += sum(len(row[4]) for row in rows) - replaced_size
+    self._evict_if_needed()
+
+  def _stored_size(self, key: tuple[str, str, int], hashes: list[bytes]) -> int:
+    """Returns the total size of the stored embeddings with the given hashes."""
+    size = 0
+    for i in range(0, len(hashes), MAX_QUERY_PARAMS):
+      batch = hashes[i : i + MAX_QUERY_PARAMS]
+      placeholders = ",".join("?" * len(batch))
+      size += self._connection.execute(
+          "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings WHERE"
+          " model = ? AND task_type = ? AND dimensionality = ? AND text_hash"
+          f" IN ({placeholders})",
+          (*key, *batch),
+      ).fetchone()[0]
+    return size
+
+  def size_bytes(self) -> int:
+    """Returns the total size of the stored embeddings."""
+    return self._connection.execute(
+        "SELECT COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+    ).fetchone()[0]
+
+  def _evict_if_needed(self):
+    if self._size_bytes <= self.max_size_bytes:
+      return
+    size = self._size_bytes = self.size_bytes()
+    if size <= self.max_size_bytes:
+      return
+    to_free = size - int(self.max_size_bytes * EVICTION_TARGET)
+    freed = 0
+    with self._connection:
+      rows = self._connection.execute(
+          "SELECT rowid, LENGTH(vector) FROM embeddings ORDER BY last_used"
+      )
+      rowids = []
+      for rowid, vector_size in rows:
+        if freed >= to_free:
+          break
+        rowids.append((rowid,))
+        freed += vector_size
+      rows.close()
+      self._connection.executemany(
+          "DELETE FROM embeddings WHERE rowid = ?", rowids
+      )
+    self._size_bytes -= freed
+    logging.info(
+        f"Evicted {len(rowids)} embeddings ({freed} bytes) from {self.path}."
+    )
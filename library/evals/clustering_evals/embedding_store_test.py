@@ -0,0 +1,139 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for embedding_store."""
+
+import os
+import tempfile
+import unittest
+from unittest.mock import MagicMock, patch
+# Module under test
+import embedding_store
+import embeddings_lib
+from embedding_table import EmbeddingTable
+import numpy as np
+
+
+class TestEmbeddingStore(unittest.TestCase):
+
+  def setUp(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self.path = os.path.join(temp_dir.name, "embeddings.sqlite")
+
+  def open_store(self, **kwargs) -> embedding_store.EmbeddingStore:
+    store = embedding_store.EmbeddingStore(self.path, **kwargs)
+    self.addCleanup(store.close)
+    return store
+
+  def test_stores_embeddings_across_instances(self):
+    self.open_store().put_many(
+        {"a": np.array([1.0, 2.0]), "b": np.array([3.0, 4.0])},
+        "model",
+        "CLUSTERING",
+    )
+
+    found = self.open_store().get_many(["a", "b", "c"], "model", "CLUSTERING")
+
+    self.assertEqual(set(found), {"a", "b"})
+    np.testing.assert_allclose(found["a"], [1.0, 2.0])
+    self.assertEqual(found["a"].dtype, np.float32)
+
+  def test_embeddings_are_keyed_by_model_task_and_dimensionality(self):
+    store = self.open_store()
+    store.put_many({"a": np.array([1.0])}, "model", "CLUSTERING")
+
+    self.assertEqual(store.get_many(["a"], "other", "CLUSTERING"), {})
+    self.assertEqual(store.get_many(["a"], "model", "RETRIEVAL_QUERY"), {})
+    self.assertEqual(store.get_many(["a"], "model", "CLUSTERING", 768), {})
+
+  def test_evicts_least_recently_used(self):
+    # Each embedding takes 8 bytes, so only two fit.
+    store = self.open_store(max_size_bytes=20)
+    with patch("time.time", side_effect=[1.0, 2.0, 3.0, 4.0]):
+      store.put_many({"a": np.zeros(2)}, "model", "CLUSTERING")
+      store.put_many({"b": np.zeros(2)}, "model", "CLUSTERING")
+      # Reading "a" makes "b" the least recently used.
+      store.get_many(["a"], "model", "CLUSTERING")
+      store.put_many({"c": np.zeros(2)}, "model", "CLUSTERING")
+
+    found = store.get_many(["a", "b", "c"], "model", "CLUSTERING")
+    self.assertEqual(set(found), {"a", "c"})
+    self.assertLessEqual(store.size_bytes(), 20)
+
+  def test_tracks_size_without_scanning(self):
+    store = self.open_store(max_size_bytes=100)
+    store.put_many({"a": np.zeros(2)}, "model", "CLUSTERING")
+
+    with patch.object(store, "size_bytes") as mock_size_bytes:
+      # Replacing an embedding only counts its new size.
+      store.put_many(
+          {"a": np.zeros(4), "b": np.zeros(2)}, "model", "CLUSTERING"
+      )
+    mock_size_bytes.assert_not_called()
+    self.assertEqual(store._size_bytes, 24)
+    self.assertEqual(store.size_bytes(), 24)
+
+    # A reopened store starts from the stored size.
+    self.assertEqual(self.open_store()._size_bytes, 24)
+
+  @patch("embeddings_lib.embeddings", new_callable=EmbeddingTable)
+  @patch("embeddings_lib._get_client")
+  def test_embeddings_lib_reads_from_store(
+      self, mock_get_client, unused_table
+  ):
+    client = mock_get_client.return_value
+    client.vertexai = True
+    client.models.embed_content.return_value = MagicMock(
+        embeddings=[MagicMock(values=[1.0, 0.0])]
+    )
+    embeddings_lib.use_store(self.open_store())
+    self.addCleanup(embeddings_lib.use_store, None)
+
+    embeddings_lib.get_embeddings(["a", "b"])
+    self.assertEqual(client.models.embed_content.call_count, 2)
+
+    # A new process starts with an empty in-memory cache.
+    embeddings_lib.set_embedding_dtype("float32")
+    result = embeddings_lib.get_embeddings(["a", "b"])
+    self.assertEqual(client.models.embed_content.call_count, 2)
+    np.testing.assert_allclose(result, [[1.0, 0.0], [1.0, 0.0]])
+
+  @patch("embeddings_lib.embeddings", new_callable=EmbeddingTable)
+  @patch("embeddings_lib._get_client")
+  def test_embeddings_lib_stores_unquantized_embeddings(
+      self, mock_get_client, unused_table
+  ):
+    client = mock_get_client.return_value
+    client.vertexai = True
+    client.models.embed_content.return_value = MagicMock(
+        embeddings=[MagicMock(values=[0.3, 0.7])]
+    )
+    store = self.open_store()
+    embeddings_lib.use_store(store)
+    self.addCleanup(embeddings_lib.use_store, None)
+    embeddings_lib.set_embedding_dtype("int8")
+
+    embeddings_lib.get_embeddings(["a"])
+
+    found = store.get_many(
+        ["a"],
+        embeddings_lib.EMBEDDING_MODEL,
+        embeddings_lib.EMBEDDING_TASK_TYPE,
+    )
+    np.testing.assert_allclose(found["a"], [0.3, 0.7], rtol=1e-6)
+
+
+if __name__ == "__main__":
+  unittest.main()
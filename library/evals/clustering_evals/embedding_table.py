@@ -0,0 +1,195 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A matrix of L2-normalized text embeddings, indexed by text.
+
+Keeping embeddings normalized in one contiguous matrix turns cosine similarity
+into a dot product, and the similarities between many pairs of texts into a
+single matrix multiplication.
+"""
+
+import numpy as np
+
+# The dtypes embeddings can be stored as. float16 halves and int8 quarters the
+# memory of float32, at the cost of some precision.
+SUPPORTED_DTYPES = ("float32", "float16", "int8")
+# int8 values are the normalized values scaled by this.
+INT8_SCALE = 127
+# The number of rows allocated when the first embeddings are added.
+INITIAL_CAPACITY = 64
+
+
+class EmbeddingTable:
+  """Stores embeddings as rows of a matrix, normalized to unit length.
+
+  The norms are kept alongside, so the original vectors can be reconstructed.
+  """
+
+  def __init__(self, dtype: str = "float32"):
+    """Initializes an empty table.
+
+    Args:
+      dtype: The dtype to store normalized embeddings as, one of
+        SUPPORTED_DTYPES.
+    """
+    if dtype not in SUPPORTED_DTYPES:
+      raise ValueError(
+          f"Unsupported dtype '{dtype}', expected one of {SUPPORTED_DTYPES}."
+      )
+    self.dtype = np.dtype(dtype)
+    self._index: dict[str, int] = {}
+    self._matrix = None
+    self._norms = np.empty(0, dtype=np.float32)
+
+  @classmethod
+  def from_arrays(
+      cls, texts: list[str], normalized: np.ndarray, norms: np.ndarray
+  ) -> "EmbeddingTable":
+    """Returns a table that uses the given arrays as its storage, uncopied.
+
+    Adding new texts to the table copies the arrays first, but replacing the
+    embeddings of texts already in it writes to them.
+
+    Args:
+      texts: The texts, in row order.
+      normalized: The normalized embeddings, as stored by a table (see
+        arrays), with a row for each text.
+      norms: The norm of each text's original embedding.
+    """
+    table = cls(normalized.dtype.name)
+    if texts:
+      table._index = {text: row for row, text in enumerate(texts)}
+      table._matrix = normalized
+      table._norms = norms
+    return table
+
+  def arrays(self) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """Returns the texts, and views of their stored embeddings and norms.
+
+    The embeddings are normalized, and scaled by INT8_SCALE for int8 tables.
+    """
+    if self._matrix is None:
+      return [], np.empty((0, 0), dtype=self.dtype), self._norms
+    num_rows = len(self)
+    return (
+        list(self._index),
+        self._matrix[:num_rows],
+        self._norms[:num_rows],
+    )
+
+  def __len__(self) -> int:
+    return len(self._index)
+
+  def __contains__(self, text: str) -> bool:
+    return text in self._index
+
+  @property
+  def dimensionality(self) -> int | None:
+    """The length of the stored embeddings, or None if the table is empty."""
+    return None if self._matrix is None else self._matrix.shape[1]
+
+  @property
+  def nbytes(self) -> int:
+    """The memory used by the stored embeddings and norms."""
+    if self._matrix is None:
+      return 0
+    return len(self) * (self._matrix[0].nbytes + self._norms.itemsize)
+
+  def add(self, texts: list[str], vectors: np.ndarray) -> None:
+    """Adds or replaces the embeddings of the texts.
+
+    Args:
+      texts: The texts.
+      vectors: A matrix with the embedding of each text as a row.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if not texts:
+      return
+    if vectors.shape[0] != len(texts):
+      raise ValueError(
+          f"Got {vectors.shape[0]} vectors for {len(texts)} texts."
+      )
+    if self._matrix is None:
+      self._matrix = np.empty(
+          (INITIAL_CAPACITY, vectors.shape[1]), dtype=self.dtype
+      )
+      self._norms = np.empty(INITIAL_CAPACITY, dtype=np.float32)
+    elif vectors.shape[1] != self.dimensionality:
+      raise ValueError(
+          f"Got {vectors.shape[1]} dimensional embeddings for a table of"
+          f" {self.dimensionality} dimensional embeddings."
+      )
+
+    rows = np.array(
+        [self._index.setdefault(text, len(self._index)) for text in texts]
+    )
+    self._ensure_capacity(len(self._index))
+    norms = np.linalg.norm(vectors, axis=1)
+    normalized = vectors / np.where(norms == 0, 1, norms)[:, np.newaxis]
+    if self.dtype == np.int8:
+      normalized = np.round(normalized * INT8_SCALE)
+    self._matrix[rows] = normalized.astype(self.dtype)
+    self._norms[rows] = norms
+
+  def _ensure_capacity(self, num_rows: int) -> None:
+    capacity = self._matrix.shape[0]
+    if num_rows <= capacity:
+      return
+    capacity = max(num_rows, 2 * capacity)
+    matrix = np.empty((capacity, self._matrix.shape[1]), dtype=self.dtype)
+    matrix[: self._matrix.shape[0]] = self._matrix
+    self._matrix = matrix
+    norms = np.empty(capacity, dtype=np.float32)
+    norms[: self._norms.shape[0]] = self._norms
+    self._norms = norms
+
+  def rows(self, texts: list[str]) -> np.ndarray:
+    """Returns the row index of each text. Raises KeyError for unknown texts."""
+    return np.array([self._index[text] for text in texts], dtype=np.intp)
+
+  def get_normalized(self, texts: list[str]) -> np.ndarray:
+    """Returns the normalized float32 embeddings of the texts, as rows."""
+    normalized = self._matrix[self.rows(texts)].astype(np.float32)
+    if self.dtype == np.int8:
+      normalized /= INT8_SCALE
+    return normalized
+
+  def get_vectors(self, texts: list[str]) -> np.ndarray:
+    """Returns the original (unnormalized) embeddings of the texts, as rows."""
+    rows = self.rows(texts)
+    return self.get_normalized(texts) * self._norms[rows][:, np.newaxis]
+
+  def truncated(self, dimensionality: int) -> "EmbeddingTable":
+    """Returns a table of the embeddings truncated to their first dimensions.
+
+    The truncated embeddings are renormalized, and keep the table's dtype.
+
+    Args:
+      dimensionality: The number of dimensions to keep.
+    """
+    table = EmbeddingTable(self.dtype.name)
+    texts = list(self._index)
+    if texts:
+      table.add(texts, self.get_vectors(texts)[:, :dimensionality])
+    return table
+
+  def get_cosine_similarities(
+      self, texts_a: list[str], texts_b: list[str]
+  ) -> np.ndarray:
+    """Returns the cosine similarity of every pair of texts.
+
+    Returns:
+      A len(texts_a) x len(texts_b) matrix of similarities.
+    """
+    return self.get_normalized(texts_a) @ self.get_normalized(texts_b).T
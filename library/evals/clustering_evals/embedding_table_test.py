@@ -0,0 +1,109 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for embedding_table."""
+
+import unittest
+# Module under test
+from embedding_table import EmbeddingTable
+import numpy as np
+
+
+class TestEmbeddingTable(unittest.TestCase):
+
+  def test_reconstructs_vectors(self):
+    table = EmbeddingTable()
+    table.add(["a", "b"], np.array([[3.0, 4.0], [0.0, 2.0]]))
+
+    self.assertEqual(len(table), 2)
+    self.assertIn("a", table)
+    np.testing.assert_allclose(table.get_normalized(["a"]), [[0.6, 0.8]])
+    np.testing.assert_allclose(
+        table.get_vectors(["b", "a"]), [[0.0, 2.0], [3.0, 4.0]]
+    )
+
+  def test_grows_and_replaces_rows(self):
+    table = EmbeddingTable()
+    texts = [f"text{i}" for i in range(100)]
+    table.add(texts, np.arange(200, dtype=np.float64).reshape(100, 2) + 1)
+    table.add(["text0"], np.array([[5.0, 0.0]]))
+
+    self.assertEqual(len(table), 100)
+    np.testing.assert_allclose(table.get_vectors(["text0"]), [[5.0, 0.0]])
+    np.testing.assert_allclose(table.get_vectors(["text99"]), [[199.0, 200.0]])
+
+  def test_from_arrays_uses_arrays_without_copying(self):
+    table = EmbeddingTable("float16")
+    table.add(["a", "b"], np.array([[3.0, 4.0], [0.0, 2.0]]))
+    texts, normalized, norms = table.arrays()
+
+    copy = EmbeddingTable.from_arrays(texts, normalized, norms)
+
+    self.assertEqual(texts, ["a", "b"])
+    self.assertEqual(normalized.shape, (2, 2))
+    self.assertEqual(copy.dtype, np.float16)
+    np.testing.assert_allclose(
+        copy.get_vectors(["b", "a"]), [[0.0, 2.0], [3.0, 4.0]], rtol=1e-3
+    )
+    self.assertTrue(np.shares_memory(copy.arrays()[1], normalized))
+
+  def test_cosine_similarities(self):
+    table = EmbeddingTable()
+    table.add(["a", "b", "c"], np.array([[1.0, 0.0], [0.0, 3.0], [1.0, 1.0]]))
+
+    np.testing.assert_allclose(
+        table.get_cosine_similarities(["a", "b"], ["a", "b", "c"]),
+        [[1.0, 0.0, np.cos(np.pi / 4)], [0.0, 1.0, np.cos(np.pi / 4)]],
+        atol=1e-6,
+    )
+
+  def test_quantized_dtypes_approximate_similarities(self):
+    rng = np.random.default_rng(0)
+    vectors = rng.normal(size=(20, 64))
+    normalized = vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+    expected = normalized @ normalized.T
+    texts = [str(i) for i in range(20)]
+    float32_nbytes = 20 * (64 + 1) * 4
+
+    for dtype, atol in (("float16", 1e-3), ("int8", 2e-2)):
+      table = EmbeddingTable(dtype)
+      table.add(texts, vectors)
+      np.testing.assert_allclose(
+          table.get_cosine_similarities(texts, texts), expected, atol=atol
+      )
+      self.assertLess(table.nbytes, float32_nbytes)
+
+  def test_truncated(self):
+    table = EmbeddingTable()
+    table.add(["a"], np.array([[3.0, 4.0, 12.0]]))
+
+    truncated = table.truncated(2)
+
+    self.assertEqual(truncated.dimensionality, 2)
+    np.testing.assert_allclose(truncated.get_vectors(["a"]), [[3.0, 4.0]])
+    np.testing.assert_allclose(truncated.get_normalized(["a"]), [[0.6, 0.8]])
+
+  def test_rejects_mismatched_dimensionality(self):
+    table = EmbeddingTable()
+    table.add(["a"], np.array([[1.0, 0.0]]))
+    with self.assertRaises(ValueError):
+      table.add(["b"], np.array([[1.0, 0.0, 0.0]]))
+
+  def test_rejects_unsupported_dtype(self):
+    with self.assertRaises(ValueError):
+      EmbeddingTable("float64")
+
+
+if __name__ == "__main__":
+  unittest.main()
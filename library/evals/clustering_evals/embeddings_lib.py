@@ -15,35 +15,301 @@
 """This namespace contains utilities for processing semantic embeddings
 
 and semantic similarity/dissimilarity between pieces of text using
-the Vertex AI Embeddings API. Embedding values are cached in memory to
-avoid unnecessary computations.
+the Vertex AI Embeddings API, or a local backend. Embedding values are cached
+in memory to avoid unnecessary computations.
 """
 
+import abc
+import concurrent.futures
+import logging
 from google import genai
 from google.genai.types import EmbedContentConfig
 import numpy as np
+from embedding_store import EmbeddingStore
+from embedding_table import EmbeddingTable
+import shared_embeddings
+
+# The embedding model to use.
+EMBEDDING_MODEL = "gemini-embedding-001"
+# The task the embeddings are optimized for.
+EMBEDDING_TASK_TYPE = "CLUSTERING"
+# The maximum number of texts per embed_content request on the Gemini API.
+MAX_BATCH_SIZE = 100
+# Vertex AI only accepts a single text per request for gemini-embedding-001, so
+# there throughput comes from concurrent requests alone.
+VERTEX_MAX_BATCH_SIZE = 1
+# The maximum number of embed_content requests in flight at a time.
+MAX_CONCURRENT_REQUESTS = 8
+# The full dimensionality of gemini-embedding-001 embeddings.
+GEMINI_FULL_DIMENSIONALITY = 3072
 
 # Create a cache for comment embeddings, so that we don't need to re-request or
 # explicitly track string embeddings across multiple calls.
-embeddings = {}
+embeddings = EmbeddingTable()
+
+# The client shared by all requests, created on first use.
+_client = None
+# The backend embeddings are computed with. See use_backend.
+_backend = None
+# The persistent store embeddings are read from and written to, if any.
+_store = None
+# The dimensionality embeddings are requested at, or None for the model's full
+# dimensionality. See set_output_dimensionality.
+output_dimensionality = None
+
+
+class EmbeddingBackend(abc.ABC):
+  """Computes embeddings for texts."""
+
+  # Identifies the backend and its model, e.g. in the persistent store.
+  name: str
+  # The task the embeddings are optimized for, if the backend supports any.
+  task_type: str = ""
+  # The dimensionality of the backend's embeddings.
+  full_dimensionality: int
+
+  def prepare(self, texts: list[str]) -> None:
+    """Called with the texts to embed, before the store is searched for them.
+
+    Backends whose name depends on the texts, e.g. on a corpus they are fit
+    on, settle it here, so it matches the name their embeddings were stored
+    under.
+
+    Args:
+      texts: The texts that aren't cached in memory.
+    """
+
+  @abc.abstractmethod
+  def embed(
+      self, texts: list[str], dimensionality: int | None = None
+  ) -> np.ndarray:
+    """Returns the embeddings of the texts.
+
+    Args:
+      texts: The texts to embed.
+      dimensionality: The number of dimensions to return, or None for the full
+        dimensionality.
+
+    Returns:
+      A matrix with the embedding of each text as a row, in the order of texts.
+    """
+
+
+class GeminiBackend(EmbeddingBackend):
+  """Requests embeddings from the Gemini API, or Vertex AI.
+
+  Texts are requested in batches, with up to MAX_CONCURRENT_REQUESTS requests
+  in flight.
+  """
+
+  name = EMBEDDING_MODEL
+  task_type = EMBEDDING_TASK_TYPE
+  full_dimensionality = GEMINI_FULL_DIMENSIONALITY
+
+  def embed(
+      self, texts: list[str], dimensionality: int | None = None
+  ) -> np.ndarray:
+    client = _get_client()
+    batch_size = VERTEX_MAX_BATCH_SIZE if client.vertexai else MAX_BATCH_SIZE
+    batches = [
+        texts[i : i + batch_size] for i in range(0, len(texts), batch_size)
+    ]
+    logging.info(
+        f"Requesting {len(texts)} embeddings in {len(batches)} requests."
+    )
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=MAX_CONCURRENT_REQUESTS
+    ) as executor:
+      batch_embeddings = executor.map(
+          lambda batch: _embed_batch(client, batch, dimensionality), batches
+      )
+      return np.array([
+          embedding for batch in batch_embeddings for embedding in batch
+      ])
+
+
+def use_backend(backend: EmbeddingBackend | None) -> None:
+  """Sets the backend embeddings are computed with, clearing the cache.
+
+  Args:
+    backend: The backend to use, or None for the default GeminiBackend.
+  """
+  global _backend, embeddings
+  _backend = backend
+  embeddings = EmbeddingTable(embeddings.dtype.name)
+
+
+def _get_backend() -> EmbeddingBackend:
+  global _backend
+  if _backend is None:
+    _backend = GeminiBackend()
+  return _backend
+
+
+def use_store(store: EmbeddingStore | None) -> None:
+  """Sets a persistent store to check before requesting embeddings.
+
+  Args:
+    store: The store to use, or None to stop using one.
+  """
+  global _store
+  _store = store
+
+
+def set_embedding_dtype(dtype: str) -> None:
+  """Sets the dtype embeddings are cached as, clearing the cache.
+
+  Args:
+    dtype: One of embedding_table.SUPPORTED_DTYPES.
+  """
+  global embeddings
+  embeddings = EmbeddingTable(dtype)
+
+
+def share_embeddings() -> shared_embeddings.SharedEmbeddingTable:
+  """Copies the cached embeddings into shared memory, for worker processes.
+
+  Workers read them with use_shared_embeddings. Close the returned
+  SharedEmbeddingTable once the workers are done, to free the memory.
+  """
+  return shared_embeddings.SharedEmbeddingTable(embeddings)
+
+
+def use_shared_embeddings(
+    handle: shared_embeddings.SharedTableHandle,
+) -> None:
+  """Replaces the cache with embeddings shared by another process.
+
+  The shared embeddings are read without being copied.
+
+  Args:
+    handle: The handle of the SharedEmbeddingTable from share_embeddings.
+  """
+  global embeddings
+  embeddings = shared_embeddings.attach(handle)
+
+
+def set_output_dimensionality(dimensionality: int | None) -> None:
+  """Sets the dimensionality embeddings are requested at.
+
+  gemini-embedding-001 is trained so that the first dimensions of an
+  embedding carry the most information (Matryoshka representation learning),
+  so lower dimensional embeddings are the full ones truncated and
+  renormalized. Cached embeddings are truncated locally when lowering the
+  dimensionality, rather than being requested again.
+
+  Args:
+    dimensionality: The number of dimensions, or None for the model's full
+      dimensionality.
+  """
+  global embeddings, output_dimensionality
+  full_dimensionality = _get_backend().full_dimensionality
+  current = output_dimensionality or full_dimensionality
+  new = dimensionality or full_dimensionality
+  if new < current:
+    embeddings = embeddings.truncated(new)
+  elif new > current:
+    embeddings = EmbeddingTable(embeddings.dtype.name)
+  output_dimensionality = dimensionality
+
+
+def _get_client() -> genai.Client:
+  global _client
+  if _client is None:
+    _client = genai.Client()
+  return _client
+
+
+def _embed_batch(
+    client: genai.Client, texts: list[str], dimensionality: int | None
+) -> list[np.ndarray]:
+  response = client.models.embed_content(
+      model=EMBEDDING_MODEL,
+      contents=texts,
+      config=EmbedContentConfig(
+          task_type=EMBEDDING_TASK_TYPE,
+          output_dimensionality=dimensionality,
+      ),
+  )
+  return [np.array(embedding.values) for embedding in response.embeddings]
+
+
+def _add_stored_embeddings(
+    texts: list[str], dimensionality: int | None
+) -> list[str]:
+  """Caches the texts' embeddings found in the store, at the given dimensions.
+
+  Returns:
+    The texts that weren't found.
+  """
+  backend = _get_backend()
+  stored = _store.get_many(
+      texts, backend.name, backend.task_type, dimensionality
+  )
+  if stored:
+    vectors = np.stack(list(stored.values()))
+    if output_dimensionality is not None:
+      vectors = vectors[:, :output_dimensionality]
+    embeddings.add(list(stored), vectors)
+  return [text for text in texts if text not in stored]
+
+
+def get_embeddings(texts: list[str]) -> np.ndarray:
+  """Gets the embeddings for the texts, memoizing the results.
+
+  Texts that aren't cached in memory or in the persistent store (see use_store)
+  are deduplicated and computed together by the backend (see use_backend),
+  which defaults to the Gemini API.
+
+  Args:
+    texts: The texts to embed.
+
+  Returns:
+    A matrix with the embedding of each text as a row, in the order of texts.
+  """
+  missing = [text for text in dict.fromkeys(texts) if text not in embeddings]
+  if missing:
+    _get_backend().prepare(missing)
+  if missing and _store is not None:
+    missing = _add_stored_embeddings(missing, output_dimensionality)
+  if missing and _store is not None and output_dimensionality is not None:
+    # Full embeddings can be truncated to any lower dimensionality.
+    missing = _add_stored_embeddings(missing, None)
+  if missing:
+    backend = _get_backend()
+    vectors = backend.embed(missing, output_dimensionality)
+    # Cache the results for later calls
+    embeddings.add(missing, vectors)
+    if _store is not None:
+      # The store keeps the backend's vectors, not the in-memory table's
+      # possibly quantized copies, since it isn't keyed by dtype.
+      _store.put_many(
+          dict(zip(missing, vectors)),
+          backend.name,
+          backend.task_type,
+          output_dimensionality,
+      )
+
+  if not texts:
+    return np.empty((0, 0))
+  return embeddings.get_vectors(texts)
 
 
 def get_embedding(comment_text: str) -> np.ndarray:
   """Gets the emedding for the comment text, memoizing the results."""
-  vertex_client = genai.Client()
-  # Return the cached comment embedding if present
-  if comment_text in embeddings:
-    return embeddings[comment_text]
-  else:
-    response = vertex_client.models.embed_content(
-        model="gemini-embedding-001",
-        contents=[comment_text],
-        config=EmbedContentConfig(task_type="CLUSTERING"),
-    )
-    result = np.array(response.embeddings[0].values)
-    # Cache the result for later calls
-    embeddings[comment_text] = result
-    return result
+  return get_embeddings([comment_text])[0]
+
+
+def get_cosine_similarity_matrix(
+    texts_a: list[str], texts_b: list[str]
+) -> np.ndarray:
+  """Returns the cosine similarity between every pair of texts.
+
+  Returns:
+    A len(texts_a) x len(texts_b) matrix of similarities.
+  """
+  get_embeddings(list(texts_a) + list(texts_b))
+  return embeddings.get_cosine_similarities(texts_a, texts_b)
 
 
 def get_cosine_similarity(a: str | np.ndarray, b: str | np.ndarray) -> float:
@@ -51,6 +317,8 @@ def get_cosine_similarity(a: str | np.ndarray, b: str | np.ndarray) -> float:
 
   to it's embedding vector.
   """
+  if isinstance(a, str) and isinstance(b, str):
+    return get_cosine_similarity_matrix([a], [b])[0, 0]
   if isinstance(a, str):
     a = get_embedding(a)
   if isinstance(b, str):
@@ -58,6 +326,19 @@ def get_cosine_similarity(a: str | np.ndarray, b: str | np.ndarray) -> float:
   return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
 
 
+def get_cosine_distance_matrix(
+    texts_a: list[str], texts_b: list[str]
+) -> np.ndarray:
+  """Returns the cosine distance (1 - cosine_similarity) between every pair of
+
+  texts.
+
+  Returns:
+    A len(texts_a) x len(texts_b) matrix of distances.
+  """
+  return 1 - get_cosine_similarity_matrix(texts_a, texts_b)
+
+
 def get_cosine_distance(a: str | np.ndarray, b: str | np.ndarray) -> float:
   """Returns the cosine distance (1 - cosine_similarity) between two vectors,
 
@@ -18,6 +18,7 @@ import unittest
 from unittest.mock import MagicMock, patch
 # Module under test
 import embeddings_lib
+from embedding_table import EmbeddingTable
 import numpy as np
 
 
@@ -60,3 +61,90 @@ class TestEmbeddingsLib(unittest.TestCase):
         embeddings_lib.get_cosine_distance(vec_a, vec_c),
         1.0 - np.cos(np.pi / 4),
     )  # ~0.293
+
+  @patch("embeddings_lib.embeddings", new_callable=EmbeddingTable)
+  def test_get_cosine_distance_matrix(self, table):
+    table.add(["a", "b", "c"], np.array([[1.0, 0.0], [0.0, 1.0], [1.0, 1.0]]))
+
+    distances = embeddings_lib.get_cosine_distance_matrix(
+        ["a", "c"], ["a", "b"]
+    )
+
+    np.testing.assert_allclose(
+        distances,
+        [[0.0, 1.0], [1.0 - np.cos(np.pi / 4), 1.0 - np.cos(np.pi / 4)]],
+        atol=1e-6,
+    )
+
+  @patch("embeddings_lib.embeddings", new_callable=EmbeddingTable)
+  @patch("embeddings_lib._get_client")
+  def test_get_embeddings_batches_and_caches(
+      self, mock_get_client, unused_table
+  ):
+    def embed_content(model, contents, config):
+      response = MagicMock()
+      response.embeddings = [
+          MagicMock(values=[float(len(text)), 1.0]) for text in contents
+      ]
+      return response
+
+    client = mock_get_client.return_value
+    client.vertexai = False
+    client.models.embed_content.side_effect = embed_content
+
+    with patch("embeddings_lib.MAX_BATCH_SIZE", 2):
+      result = embeddings_lib.get_embeddings(["a", "bb", "a", "ccc"])
+    np.testing.assert_allclose(
+        result, [[1.0, 1.0], [2.0, 1.0], [1.0, 1.0], [3.0, 1.0]]
+    )
+    # The duplicate is only requested once, in batches of at most 2 texts.
+    self.assertEqual(client.models.embed_content.call_count, 2)
+
+    # Cached texts aren't requested again.
+    np.testing.assert_allclose(
+        embeddings_lib.get_embedding("bb"), [2.0, 1.0]
+    )
+    self.assertEqual(client.models.embed_content.call_count, 2)
+
+  @patch("embeddings_lib.embeddings", new_callable=EmbeddingTable)
+  @patch("embeddings_lib._get_client")
+  def test_get_embeddings_uses_single_text_requests_on_vertex(
+      self, mock_get_client, unused_table
+  ):
+    client = mock_get_client.return_value
+    client.vertexai = True
+    client.models.embed_content.return_value.embeddings = [
+        MagicMock(values=[1.0])
+    ]
+
+    embeddings_lib.get_embeddings(["a", "b", "c"])
+    self.assertEqual(client.models.embed_content.call_count, 3)
+
+  @patch("embeddings_lib.embeddings", new_callable=EmbeddingTable)
+  @patch("embeddings_lib._get_client")
+  def test_set_output_dimensionality(self, mock_get_client, unused_table):
+    client = mock_get_client.return_value
+    client.vertexai = True
+    client.models.embed_content.return_value.embeddings = [
+        MagicMock(values=[3.0, 4.0, 12.0])
+    ]
+    self.addCleanup(embeddings_lib.set_output_dimensionality, None)
+
+    embeddings_lib.get_embeddings(["a"])
+    embeddings_lib.set_output_dimensionality(2)
+
+    # The cached embedding is truncated rather than requested again.
+    np.testing.assert_allclose(embeddings_lib.get_embedding("a"), [3.0, 4.0])
+    self.assertEqual(client.models.embed_content.call_count, 1)
+
+    # New embeddings are requested at the lower dimensionality.
+    client.models.embed_content.return_value.embeddings = [
+        MagicMock(values=[1.0, 0.0])
+    ]
+    embeddings_lib.get_embedding("b")
+    config = client.models.embed_content.call_args.kwargs["config"]
+    self.assertEqual(config.output_dimensionality, 2)
+
+    # Raising the dimensionality again clears the cache.
+    embeddings_lib.set_output_dimensionality(None)
+    self.assertNotIn("a", embeddings_lib.embeddings)
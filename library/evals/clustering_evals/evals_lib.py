@@ -17,6 +17,10 @@
 and Categorization.
 """
 
+import concurrent.futures
+import multiprocessing
+import os
+from typing import Callable
 import embeddings_lib as embeddings
 import numpy as np
 import pandas as pd
@@ -24,6 +28,10 @@ import pandas as pd
 TOPICS_COL = "topics"
 COMMENT_ID_COL = "comment-id"
 COMMENT_TEXT_COL = "comment_text"
+# How worker processes that evaluate runs in parallel are started. Spawned
+# workers don't inherit the parent's threads or API clients, and read the
+# embeddings from shared memory rather than from a copy of the parent's.
+WORKER_START_METHOD = "spawn"
 
 
 class AnalysisResults:
@@ -41,6 +49,10 @@ class AnalysisResults:
     self.max = np.max(values)
 
 
+# An analysis of comments dataframes, such as analyze_categorization_diffs.
+Analysis = Callable[[list[pd.DataFrame]], AnalysisResults]
+
+
 def convert_topics_col_to_list(comments: pd.DataFrame) -> pd.DataFrame:
   """Converts the topics column values from strings of semicolon-separated
 
@@ -59,6 +71,92 @@ def convert_topics_col_to_list(comments: pd.DataFrame) -> pd.DataFrame:
   return comments
 
 
+def prefetch_embeddings(data: list[pd.DataFrame]) -> None:
+  """Fetches the embeddings of all comment texts and topic names in the data.
+
+  The evals request embeddings one text at a time, so fetching them together
+  up front lets them be requested in concurrent batches instead.
+
+  Args:
+    data: A list of comments dataframes.
+  """
+  texts = []
+  for df in data:
+    if COMMENT_TEXT_COL in df.columns:
+      texts.extend(df[COMMENT_TEXT_COL])
+    texts.extend(df[TOPICS_COL].explode().dropna())
+  embeddings.get_embeddings(list(dict.fromkeys(texts)))
+
+
+def get_topic_assignment_matrices(
+    data: list[pd.DataFrame],
+) -> list[np.ndarray]:
+  """Encodes each comments dataframe as a multi-hot topic assignment matrix.
+
+  Rows are aligned across the dataframes by comment id, in the order of the
+  first dataframe, and columns are topic ids shared by all of them, so the
+  matrices can be compared element by element.
+
+  Args:
+    data: A list of comments dataframes, each including the comments of the
+      first.
+
+  Returns:
+    A boolean comments x topics matrix for each dataframe.
+  """
+  comment_ids = pd.Index(data[0][COMMENT_ID_COL]).unique()
+  assignments = []
+  for df in data:
+    topics = df.drop_duplicates(COMMENT_ID_COL).set_index(COMMENT_ID_COL)
+    missing_ids = comment_ids.difference(topics.index)
+    if not missing_ids.empty:
+      raise ValueError(
+          f"Comments {list(missing_ids)} are missing from a dataframe."
+      )
+    aligned_topics = topics[TOPICS_COL].reindex(comment_ids)
+    assignments.append(
+        aligned_topics.reset_index(drop=True).explode().dropna()
+    )
+
+  # Intern the topic names of all the dataframes together, so that each topic
+  # has the same column in every matrix.
+  topic_ids, topic_names = pd.factorize(pd.concat(assignments))
+  matrices = []
+  offset = 0
+  for comment_topics in assignments:
+    matrix = np.zeros((len(comment_ids), len(topic_names)), dtype=bool)
+    matrix[
+        comment_topics.index.to_numpy(dtype=np.intp),
+        topic_ids[offset : offset + len(comment_topics)],
+    ] = True
+    matrices.append(matrix)
+    offset += len(comment_topics)
+  return matrices
+
+
+def get_pairwise_assignment_changes(data: list[pd.DataFrame]) -> np.ndarray:
+  """Returns how many topic assignments changed for each comment between all
+
+  pairs of comments dataframes.
+
+  A comment moved from one topic to another counts as two changes: a topic
+  removed and a topic added.
+
+  Args:
+    data: A list of comments dataframes.
+
+  Returns:
+    A pairs x comments matrix of counts, with a row for each pair of dataframes.
+  """
+  matrices = np.stack(get_topic_assignment_matrices(data))
+  # Compare each matrix with all the later ones at once.
+  changes = [
+      np.count_nonzero(matrices[index] ^ matrices[index + 1 :], axis=2)
+      for index in range(len(matrices))
+  ]
+  return np.concatenate(changes)
+
+
 def get_pairwise_categorization_diffs(
     df1: pd.DataFrame, df2: pd.DataFrame
 ) -> float:
@@ -70,33 +168,53 @@ def get_pairwise_categorization_diffs(
     df1: The first comments dataframe.
     df2: The second comments dataframe.
   """
-  count_diffs = 0
+  changes = get_pairwise_assignment_changes([df1, df2])
+  return np.mean(changes > 0)
 
-  for _, row in df1.iterrows():
-    matching_row = df2[df2[COMMENT_ID_COL].eq(row[COMMENT_ID_COL])]
-    unique_diffs = set(row[TOPICS_COL]) ^ set(matching_row[TOPICS_COL].iloc[0])
-    if len(unique_diffs) >= 1:
-      # TODO: add additional metric that tracks degree of change, ie how many
-      # assignments changed.
-      count_diffs += 1
 
-  return count_diffs / df1.shape[0]
+def analyze_categorization_diffs(data: list[pd.DataFrame]) -> AnalysisResults:
+  """Returns the average rate of comments with at least one topic difference
 
+  between all pairs of comments dataframes.
+
+  Args:
+    data: A list of comments dataframes.
+  """
+  changes = get_pairwise_assignment_changes(data)
+  return AnalysisResults(np.mean(changes > 0, axis=1))
 
-def analyze_categorization_diffs(data: list[pd.DataFrame]) -> float:
-  """Returns the average rate of comments with at least one topic difference
+
+def analyze_categorization_change_degree(
+    data: list[pd.DataFrame],
+) -> AnalysisResults:
+  """Returns the average number of topic assignments changed per comment
 
   between all pairs of comments dataframes.
 
+  This complements analyze_categorization_diffs, which counts a comment as
+  changed no matter how many of its topics changed.
+
   Args:
     data: A list of comments dataframes.
   """
-  pairwise_diffs = []
-  for index, df1 in enumerate(data):
-    for df2 in data[index + 1 : len(data)]:
-      pairwise_diffs.append(get_pairwise_categorization_diffs(df1, df2))
+  changes = get_pairwise_assignment_changes(data)
+  return AnalysisResults(np.mean(changes, axis=1))
 
-  return AnalysisResults(pairwise_diffs)
+
+def get_topic_set_similarity_from_matrix(similarities: np.ndarray) -> float:
+  """Returns the average semantic similarity between the closest matching topic
+
+  names between two sets of topic names, given the similarity of every pair.
+
+  Args:
+    similarities: The cosine similarity between each topic name in the first
+      set (rows) and each topic name in the second set (columns).
+  """
+  # For each topic set get the average similarity of each topic to its most
+  # similar topic. This is macro-averaged at the topic set level.
+  mean_similarity_1 = np.mean(np.max(similarities, axis=1))
+  mean_similarity_2 = np.mean(np.max(similarities, axis=0))
+  return np.mean([mean_similarity_1, mean_similarity_2])
 
 
 def get_topic_set_similarity(
@@ -110,49 +228,41 @@ def get_topic_set_similarity(
     topic_set_1: The first set of topic names.
     topic_set_2: The second set of topic names.
   """
-
-  def get_similarities_for_first_topic_set(
-      topic_set_1: set[str], topic_set_2: set[str]
-  ) -> list[float]:
-    similarities = []
-    for topic in topic_set_1:
-      other_topics_and_similarity = [
-          (other_topic, embeddings.get_cosine_similarity(topic, other_topic))
-          for other_topic in topic_set_2
-      ]
-      similarities.append(
-          max(other_topics_and_similarity, key=lambda x: x[1])[1]
-      )
-    return similarities
-
-  # For each topic set get the average similarity of each topic to its most
-  # similar topic. This is macro-averaged at the topic set level.
-  mean_similarity_1 = np.mean(
-      get_similarities_for_first_topic_set(topic_set_1, topic_set_2)
-  )
-  mean_similarity_2 = np.mean(
-      get_similarities_for_first_topic_set(topic_set_2, topic_set_1)
+  similarities = embeddings.get_cosine_similarity_matrix(
+      list(topic_set_1), list(topic_set_2)
   )
-
-  return np.mean([mean_similarity_1, mean_similarity_2])
+  return get_topic_set_similarity_from_matrix(similarities)
 
 
 def analyze_topic_set_similarity(data: list[pd.DataFrame]) -> AnalysisResults:
   """Return the average topic_set_similarity between all pairs of dataframes.
 
+  The topic names of all the dataframes are embedded together, and each pair's
+  similarity is read from a slice of one similarity matrix per dataframe.
+
   Args:
     data: A list of comments dataframes.
   """
-  topic_sets = []
-  for df in data:
-    exploded_topics = df[TOPICS_COL].explode()
-    topic_sets.append(exploded_topics.unique())
+  topic_sets = [list(df[TOPICS_COL].explode().dropna().unique()) for df in data]
+  all_topics = list(dict.fromkeys(t for topics in topic_sets for t in topics))
+  topic_indices = {topic: index for index, topic in enumerate(all_topics)}
+  columns = [
+      np.array([topic_indices[t] for t in topics], dtype=np.intp)
+      for topics in topic_sets
+  ]
 
   similarities = []
-  for index, topic_set_1 in enumerate(topic_sets):
-    for topic_set_2 in topic_sets[index + 1 : len(topic_sets)]:
-      similarity = get_topic_set_similarity(topic_set_1, topic_set_2)
-      similarities.append(similarity)
+  for index, topic_set_1 in enumerate(topic_sets[:-1]):
+    # The similarity of each of this set's topics to every topic name.
+    set_similarities = embeddings.get_cosine_similarity_matrix(
+        topic_set_1, all_topics
+    )
+    for topic_set_2_columns in columns[index + 1 :]:
+      similarities.append(
+          get_topic_set_similarity_from_matrix(
+              set_similarities[:, topic_set_2_columns]
+          )
+      )
   return AnalysisResults(similarities)
 
 
@@ -166,6 +276,70 @@ def get_topic_comments(comments: pd.DataFrame, topic_name: str) -> pd.DataFrame:
   return comments[comments[TOPICS_COL].apply(lambda x: topic_name in list(x))]
 
 
+def get_topic_assignments(
+    comments: pd.DataFrame, topics: list[str]
+) -> np.ndarray:
+  """Returns a comments x topics boolean matrix of the comments' topics.
+
+  Args:
+    comments: The comments dataframe.
+    topics: The topics, in the order of the matrix's columns.
+  """
+  topic_indices = {topic: index for index, topic in enumerate(topics)}
+  comment_topics = comments[TOPICS_COL].reset_index(drop=True).explode()
+  comment_topics = comment_topics[comment_topics.isin(topic_indices)]
+  assignments = np.zeros((len(comments), len(topics)), dtype=bool)
+  assignments[
+      comment_topics.index.to_numpy(dtype=np.intp),
+      comment_topics.map(topic_indices).to_numpy(dtype=np.intp),
+  ] = True
+  return assignments
+
+
+def get_cosine_distances(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+  """Returns the cosine distance between every row of a and every row of b."""
+  norms = np.outer(np.linalg.norm(a, axis=1), np.linalg.norm(b, axis=1))
+  return 1 - (a @ b.T) / norms
+
+
+def _get_separations(
+    distances: np.ndarray, assignments: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+  """Returns each comment's distance to, and index of, its closest topic that
+
+  it's _not_ assigned, given comments x topics distance and assignment
+  matrices. The distance is `nan` for comments assigned to every topic.
+  """
+  unassigned_distances = np.where(assignments, np.inf, distances)
+  closest_topics = np.argmin(unassigned_distances, axis=1)
+  separations = np.take_along_axis(
+      unassigned_distances, closest_topics[:, np.newaxis], axis=1
+  )[:, 0]
+  separations[assignments.all(axis=1)] = np.nan
+  return separations, closest_topics
+
+
+def _get_cohesions_and_separations(
+    distances: np.ndarray, assignments: np.ndarray
+) -> tuple[np.ndarray, np.ndarray]:
+  """Returns the cohesion and separation of every topic, given comments x
+
+  topics distance and assignment matrices.
+
+  A topic's cohesion is the average distance between its comments and itself,
+  and its separation the average distance between its comments and their
+  closest topic they're _not_ assigned.
+  """
+  topic_sizes = assignments.sum(axis=0)
+  cohesions = np.where(assignments, distances, 0).sum(axis=0) / topic_sizes
+  comment_separations = _get_separations(distances, assignments)[0]
+  separations = (
+      np.where(assignments, comment_separations[:, np.newaxis], 0).sum(axis=0)
+      / topic_sizes
+  )
+  return cohesions, separations
+
+
 def topic_centered_cohesion(comments: pd.DataFrame, topic_name: str) -> float:
   """Returns cluster cohesion for the topic, treating the topic name embedding as the
 
@@ -244,21 +418,72 @@ def topic_centered_silhouette(comments: pd.DataFrame) -> AnalysisResults:
   topics in
   the dataset.
   """
-  topics = comments[TOPICS_COL].explode().unique()
-  topic_scores = [
-      topic_centered_silhouette_for_topic(comments, topic) for topic in topics
-  ]
+  topics = list(comments[TOPICS_COL].explode().dropna().unique())
+  # Every topic's cohesion and separation come from the distances between
+  # every comment and every topic name, computed at once.
+  distances = embeddings.get_cosine_distance_matrix(
+      comments[COMMENT_TEXT_COL].tolist(), topics
+  )
+  cohesions, separations = _get_cohesions_and_separations(
+      distances, get_topic_assignments(comments, topics)
+  )
+  topic_scores = (separations - cohesions) / np.maximum(cohesions, separations)
   return AnalysisResults(topic_scores)
 
 
-def analyze_topic_centered_silhouette_scores(
+def evaluate_runs(
+    evaluate: Callable[[pd.DataFrame], float],
     data: list[pd.DataFrame],
+    max_workers: int | None = None,
+) -> list[float]:
+  """Evaluates each comments dataframe, in parallel worker processes.
+
+  The embeddings of all the dataframes are fetched first, and placed in shared
+  memory once, so the workers read them without copying and only the
+  dataframes are sent to them.
+
+  Args:
+    evaluate: The evaluation of a single dataframe. It's sent to the workers,
+      so it must be a module level function.
+    data: A list of comments dataframes.
+    max_workers: The maximum number of worker processes. Defaults to the number
+      of CPUs. With a single worker, the dataframes are evaluated in this
+      process.
+
+  Returns:
+    The result of evaluate for each dataframe, in order.
+  """
+  max_workers = min(max_workers or os.cpu_count() or 1, len(data))
+  if max_workers <= 1:
+    return [evaluate(df) for df in data]
+
+  prefetch_embeddings(data)
+  # The workers only need the columns the evals use.
+  runs = [df[[COMMENT_TEXT_COL, TOPICS_COL]] for df in data]
+  with embeddings.share_embeddings() as shared_table:
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers,
+        mp_context=multiprocessing.get_context(WORKER_START_METHOD),
+        initializer=embeddings.use_shared_embeddings,
+        initargs=(shared_table.handle,),
+    ) as pool:
+      return list(pool.map(evaluate, runs))
+
+
+def topic_centered_silhouette_mean(comments: pd.DataFrame) -> float:
+  """Returns the mean topic_centered_silhouette score of the topics."""
+  return topic_centered_silhouette(comments).mean
+
+
+def analyze_topic_centered_silhouette_scores(
+    data: list[pd.DataFrame], max_workers: int | None = None
 ) -> AnalysisResults:
   """Returns analysis of topic_centered_silhouette scores for a collection
 
-  of comment dataframes.
+  of comment dataframes, evaluated in parallel by up to max_workers processes
+  (see evaluate_runs).
   """
-  scores = [topic_centered_silhouette(df).mean for df in data]
+  scores = evaluate_runs(topic_centered_silhouette_mean, data, max_workers)
   return AnalysisResults(scores)
 
 
@@ -283,17 +508,47 @@ class CentroidSilhouette:
   and cluster centroids as the mean of these emedding vectors for every comment
   assigned to the corresponding topic. Dissimilairty between points is defined
   in terms of the cosine similarity metric.
+
+  Centroids and distances are computed in float64 from the cached embeddings,
+  which are stored as float32 by default. Scores therefore match a computation
+  on the original vectors to within about 1e-6, rather than exactly.
   """
 
   def __init__(self, comments: pd.DataFrame):
     """Initialize the centroid-based silhouette analysis.
 
+    Embeddings are fetched, and centroids and distances computed, on first use.
+
     Args:
       comments: Comment dataframe with topics column of string lists.
     """
     self.__comments = comments
-    self.__topics = list(comments[TOPICS_COL].explode().unique())
-    self.__topic_centroids = {}
+    self.__topics = list(comments[TOPICS_COL].explode().dropna().unique())
+    self.__topic_indices = {
+        topic: index for index, topic in enumerate(self.__topics)
+    }
+    self.__topic_centroids = None
+    self.__cohesions = None
+    self.__separations = None
+
+  def __compute(self) -> None:
+    """Computes every topic's centroid, cohesion and separation at once."""
+    if self.__topic_centroids is not None:
+      return
+    # A comments x topics multi-hot matrix of topic assignments.
+    assignments = get_topic_assignments(self.__comments, self.__topics)
+    comment_vectors = embeddings.get_embeddings(
+        self.__comments[COMMENT_TEXT_COL].tolist()
+    ).astype(np.float64)
+    topic_sizes = assignments.sum(axis=0)
+    self.__topic_centroids = (
+        assignments.T.astype(np.float64) @ comment_vectors
+    ) / topic_sizes[:, np.newaxis]
+
+    distances = get_cosine_distances(comment_vectors, self.__topic_centroids)
+    self.__cohesions, self.__separations = _get_cohesions_and_separations(
+        distances, assignments
+    )
 
   def get_topic_centroid(self, topic_name: str) -> np.ndarray:
     """Return centroid array for comment embeddings corresponding to the topic.
@@ -301,16 +556,8 @@ class CentroidSilhouette:
     Args:
       topic_name: The name of the topic.
     """
-    if topic_name in self.__topic_centroids:
-      return self.__topic_centroids[topic_name]
-    else:
-      topic_comments = get_topic_comments(self.__comments, topic_name)
-      comment_texts = topic_comments[COMMENT_TEXT_COL]
-      topic_centroid = np.mean(
-          np.stack([embeddings.get_embedding(ct) for ct in comment_texts]),
-          axis=0,
-      )
-      return topic_centroid
+    self.__compute()
+    return self.__topic_centroids[self.__topic_indices[topic_name]]
 
   def silhouette(self) -> AnalysisResults:
     """Returns AnalysisResults summary of silhouette scores for the clustering
@@ -338,13 +585,8 @@ class CentroidSilhouette:
     Args:
       topic_name: The name of the topic.
     """
-    topic_centroid = self.get_topic_centroid(topic_name)
-    topic_comments = get_topic_comments(self.__comments, topic_name)
-    distances = [
-        embeddings.get_cosine_distance(topic_centroid, ct)
-        for ct in topic_comments[COMMENT_TEXT_COL]
-    ]
-    return np.mean(distances)
+    self.__compute()
+    return self.__cohesions[self.__topic_indices[topic_name]]
 
   def topic_separation(self, topic_name: str) -> float:
     """Returns the cluster separation for the given topic, representing how
@@ -354,12 +596,8 @@ class CentroidSilhouette:
     Args:
       topic_name: The name of the topic.
     """
-    topic_comments = get_topic_comments(self.__comments, topic_name)
-    separations = [
-        self.comment_separation(comment)[0]
-        for comment in topic_comments.to_dict("records")
-    ]
-    return np.mean(separations)
+    self.__compute()
+    return self.__separations[self.__topic_indices[topic_name]]
 
   def comment_separation(self, comment: dict) -> tuple[float, str | None]:
     """Computes cluster separation for the given comment.
@@ -373,26 +611,76 @@ class CentroidSilhouette:
       to the closest non-assigned topic, and closest_topic_name is the name of
       that topic. If a comment is assigned to all topics, returns (`nan`, None).
     """
-    distances = []
-    for topic in self.__topics:
-      if topic not in comment[TOPICS_COL]:
-        centroid = self.get_topic_centroid(topic)
-        comment_text = comment[COMMENT_TEXT_COL]
-        distances.append(
-            (embeddings.get_cosine_distance(centroid, comment_text), topic)
-        )
+    self.__compute()
+    comment_vector = embeddings.get_embedding(comment[COMMENT_TEXT_COL])
+    distances = get_cosine_distances(
+        comment_vector[np.newaxis, :].astype(np.float64),
+        self.__topic_centroids,
+    )
+    assignments = np.array(
+        [[topic in comment[TOPICS_COL] for topic in self.__topics]]
+    )
+    separations, closest_topics = _get_separations(distances, assignments)
     # This covers the case where a comment is assigned to every topic
-    if not distances:
+    if np.isnan(separations[0]):
       return (float("nan"), None)
-    return min(distances)
+    return (separations[0], self.__topics[closest_topics[0]])
+
+
+def centroid_silhouette_mean(comments: pd.DataFrame) -> float:
+  """Returns the mean CentroidSilhouette score of the topics."""
+  return CentroidSilhouette(comments).silhouette().mean
 
 
 def analyze_centroid_silhouette_scores(
-    data: list[pd.DataFrame],
+    data: list[pd.DataFrame], max_workers: int | None = None
 ) -> AnalysisResults:
   """Returns analysis of centroid_silhouette scores for a collection
 
-  of comment dataframes.
+  of comment dataframes, evaluated in parallel by up to max_workers processes
+  (see evaluate_runs).
   """
-  scores = [CentroidSilhouette(df).silhouette().mean for df in data]
+  scores = evaluate_runs(centroid_silhouette_mean, data, max_workers)
   return AnalysisResults(scores)
+
+
+def calibrate_dimensionality(
+    data: list[pd.DataFrame],
+    analyses: dict[str, Analysis],
+    dimensionalities: list[int],
+) -> pd.DataFrame:
+  """Returns how much each analysis drifts at lower embedding dimensionalities.
+
+  The analyses are run at full dimensionality, and then at each of the given
+  dimensionalities from highest to lowest, so that each step only truncates
+  the cached embeddings and no new ones are requested. This leaves embeddings
+  at the lowest of the dimensionalities.
+
+  Args:
+    data: A list of comments dataframes.
+    analyses: The analyses to run on the data, by name.
+    dimensionalities: The embedding dimensionalities to compare.
+
+  Returns:
+    A dataframe with the mean of each analysis at each dimensionality, and its
+    drift from the mean at full dimensionality.
+  """
+  embeddings.set_output_dimensionality(None)
+  prefetch_embeddings(data)
+  full_means = {
+      name: analysis(data).mean for name, analysis in analyses.items()
+  }
+
+  rows = []
+  for dimensionality in sorted(set(dimensionalities), reverse=True):
+    embeddings.set_output_dimensionality(dimensionality)
+    for name, analysis in analyses.items():
+      mean = analysis(data).mean
+      rows.append({
+          "Evaluation Name": name,
+          "Dimensionality": dimensionality,
+          "Mean": mean,
+          "Full Dimensionality Mean": full_means[name],
+          "Drift": mean - full_means[name],
+      })
+  return pd.DataFrame(rows)
@@ -16,11 +16,16 @@
 
 import math
 import unittest
-from unittest.mock import patch
+from unittest.mock import ANY, patch
+from embedding_table import EmbeddingTable
 import evals_lib
 import numpy as np
 import pandas as pd
 
+# How closely CentroidSilhouette's scores from float32 cached embeddings match
+# those computed from the original float64 vectors.
+CENTROID_SILHOUETTE_TOLERANCE = 1e-6
+
 
 def assert_topic_lists_equal(
     all_expected_topics: list[list[str]], all_result_topics: list[list[str]]
@@ -34,6 +39,28 @@ def assert_topic_lists_equal(
     assert expected_topics == result_topics
 
 
+def exact_match_similarities(
+    texts_a: list[str], texts_b: list[str]
+) -> np.ndarray:
+  """Returns a similarity matrix where only identical texts are similar."""
+  return np.array([[float(a == b) for b in texts_b] for a in texts_a])
+
+
+def embeddings_lookup(vectors: dict[str, np.ndarray]):
+  """Returns a fake get_embeddings that looks texts up in the dict."""
+  return lambda texts: np.stack([vectors[text] for text in texts])
+
+
+def distances_lookup(distances: dict[tuple[str, str], float]):
+  """Returns a fake get_cosine_distance_matrix from comments to topics, which
+
+  looks (topic, comment) pairs up in the dict.
+  """
+  return lambda comments, topics: np.array([
+      [distances[(topic, comment)] for topic in topics] for comment in comments
+  ])
+
+
 class TestEvalsLib(unittest.TestCase):
 
   def test_convert_topics_col_to_list(self):
@@ -69,6 +96,73 @@ class TestEvalsLib(unittest.TestCase):
     result_df = evals_lib.convert_topics_col_to_list(pd.DataFrame(data))
     assert_topic_lists_equal(expected_topics, result_df["topics"].tolist())
 
+  @patch("evals_lib.embeddings.get_embeddings")
+  def test_prefetch_embeddings(self, mock_get_embeddings):
+    df1 = pd.DataFrame({
+        "comment_text": ["a", "b"],
+        "topics": [["topic1"], ["topic1", "topic2"]],
+    })
+    df2 = pd.DataFrame({"comment_text": ["a"], "topics": [["topic3"]]})
+    evals_lib.prefetch_embeddings([df1, df2])
+    mock_get_embeddings.assert_called_once_with(
+        ["a", "b", "topic1", "topic2", "topic3"]
+    )
+
+  @patch("embeddings_lib.embeddings", new_callable=EmbeddingTable)
+  def test_silhouette_analyses_in_worker_processes(self, table):
+    """Test that parallel evaluation matches evaluation in this process."""
+    rng = np.random.default_rng(0)
+    texts = [f"comment{i}" for i in range(6)] + ["topic1", "topic2", "topic3"]
+    # The workers can only read the embeddings this process shares with them.
+    table.add(texts, rng.normal(size=(len(texts), 8)))
+    data = [
+        pd.DataFrame({
+            "comment_text": [f"comment{i}" for i in range(6)],
+            "topics": [
+                [["topic1"], ["topic2"], ["topic3"], ["topic1", "topic2"]][
+                    (i + run) % 4
+                ]
+                for i in range(6)
+            ],
+        })
+        for run in range(3)
+    ]
+
+    for analyze in (
+        evals_lib.analyze_topic_centered_silhouette_scores,
+        evals_lib.analyze_centroid_silhouette_scores,
+    ):
+      sequential = analyze(data, max_workers=1)
+      parallel = analyze(data, max_workers=2)
+      self.assertAlmostEqual(parallel.mean, sequential.mean)
+      self.assertAlmostEqual(parallel.min, sequential.min)
+      self.assertAlmostEqual(parallel.max, sequential.max)
+
+  @patch("evals_lib.prefetch_embeddings")
+  @patch("evals_lib.embeddings.set_output_dimensionality")
+  def test_calibrate_dimensionality(
+      self, mock_set_output_dimensionality, mock_prefetch_embeddings
+  ):
+    analysis_means = {None: 0.5, 768: 0.45, 256: 0.4}
+    current = {}
+    mock_set_output_dimensionality.side_effect = lambda d: current.update(d=d)
+    analyses = {
+        "Fake": lambda data: evals_lib.AnalysisResults(
+            [analysis_means[current["d"]]]
+        )
+    }
+
+    result = evals_lib.calibrate_dimensionality([], analyses, [256, 768])
+
+    # Dimensionalities are visited from highest to lowest.
+    self.assertEqual(
+        [c.args[0] for c in mock_set_output_dimensionality.call_args_list],
+        [None, 768, 256],
+    )
+    self.assertEqual(result["Dimensionality"].tolist(), [768, 256])
+    np.testing.assert_allclose(result["Drift"], [-0.05, -0.1])
+    self.assertEqual(result["Full Dimensionality Mean"].tolist(), [0.5, 0.5])
+
   def test_analyze_categorization_diffs_no_diffs(self):
     """Test with two identical DataFrames."""
     df1 = pd.DataFrame({
@@ -96,69 +190,141 @@ class TestEvalsLib(unittest.TestCase):
     result = evals_lib.analyze_categorization_diffs(data)
     self.assertEqual(result.mean, 0.5)
 
-  @patch("evals_lib.embeddings.get_cosine_similarity")
+  def test_analyze_categorization_diffs_aligns_comments(self):
+    """Test that comments are matched by id, not by position."""
+    df1 = pd.DataFrame({
+        "comment-id": [1, 2, 3],
+        "topics": [["topic1"], ["topic2", "topic3"], []],
+    })
+    df2 = pd.DataFrame({
+        "comment-id": [3, 1, 2],
+        "topics": [[], ["topic1"], ["topic3", "topic2"]],
+    })
+    result = evals_lib.analyze_categorization_diffs([df1, df2])
+    self.assertEqual(result.mean, 0.0)
+
+  def test_analyze_categorization_diffs_missing_comment(self):
+    """Test that a comment missing from a dataframe is reported."""
+    df1 = pd.DataFrame({"comment-id": [1, 2], "topics": [["a"], ["b"]]})
+    df2 = pd.DataFrame({"comment-id": [1], "topics": [["a"]]})
+    with self.assertRaises(ValueError):
+      evals_lib.analyze_categorization_diffs([df1, df2])
+
+  def test_get_topic_assignment_matrices(self):
+    """Test that topic columns are shared across the dataframes."""
+    df1 = pd.DataFrame({
+        "comment-id": [1, 2],
+        "topics": [["topic1"], ["topic1", "topic2"]],
+    })
+    df2 = pd.DataFrame({
+        "comment-id": [2, 1],
+        "topics": [["topic3"], ["topic1"]],
+    })
+    matrix1, matrix2 = evals_lib.get_topic_assignment_matrices([df1, df2])
+    np.testing.assert_array_equal(
+        matrix1, [[True, False, False], [True, True, False]]
+    )
+    np.testing.assert_array_equal(
+        matrix2, [[True, False, False], [False, False, True]]
+    )
+
+  def test_analyze_categorization_change_degree(self):
+    """Test counting the changed assignments of each comment."""
+    df1 = pd.DataFrame({
+        "comment-id": [1, 2],
+        "topics": [["topic1"], ["topic1", "topic2"]],
+    })
+    df2 = pd.DataFrame({
+        "comment-id": [1, 2],
+        "topics": [["topic1"], ["topic3"]],
+    })
+    df3 = pd.DataFrame({
+        "comment-id": [1, 2],
+        "topics": [["topic2"], ["topic1", "topic2"]],
+    })
+    result = evals_lib.analyze_categorization_change_degree([df1, df2, df3])
+    # Comment 2 loses two topics and gains one between df1 and df2, and only
+    # comment 1 changes, by two assignments, between df1 and df3.
+    np.testing.assert_allclose(
+        evals_lib.get_pairwise_assignment_changes([df1, df2, df3]),
+        [[0, 3], [2, 0], [2, 3]],
+    )
+    self.assertAlmostEqual(result.mean, 5 / 3)
+    self.assertEqual(result.min, 1.0)
+    self.assertEqual(result.max, 2.5)
+
+  @patch("evals_lib.embeddings.get_cosine_similarity_matrix")
   def test_get_topic_set_similarity_identical_sets(
-      self, mock_get_cosine_similarity
+      self, mock_get_cosine_similarity_matrix
   ):
     """Test with two identical sets of topics."""
-    mock_get_cosine_similarity.return_value = 1.0
+    mock_get_cosine_similarity_matrix.side_effect = exact_match_similarities
     topic_set_1 = {"topic1", "topic2", "topic3"}
     topic_set_2 = {"topic1", "topic2", "topic3"}
     result = evals_lib.get_topic_set_similarity(topic_set_1, topic_set_2)
     self.assertEqual(result, 1.0)
-    self.assertEqual(mock_get_cosine_similarity.call_count, 18)
+    self.assertEqual(mock_get_cosine_similarity_matrix.call_count, 1)
 
-  @patch("evals_lib.embeddings.get_cosine_similarity")
+  @patch("evals_lib.embeddings.get_cosine_similarity_matrix")
   def test_get_topic_set_similarity_partial_overlap(
-      self, mock_get_cosine_similarity
+      self, mock_get_cosine_similarity_matrix
   ):
     """Test with two sets of topics that have some overlap."""
-    mock_get_cosine_similarity.side_effect = lambda x, y: 1.0 if x == y else 0
+    mock_get_cosine_similarity_matrix.side_effect = exact_match_similarities
     topic_set_1 = {"topic1", "topic2", "topic3"}
     topic_set_2 = {"topic2", "topic3", "topic4"}
     result = evals_lib.get_topic_set_similarity(topic_set_1, topic_set_2)
     self.assertEqual(result, 2 / 3)
-    self.assertEqual(mock_get_cosine_similarity.call_count, 18)
+    self.assertEqual(mock_get_cosine_similarity_matrix.call_count, 1)
+
+  def test_get_topic_set_similarity_from_matrix(self):
+    """Test that the best matches are averaged in both directions."""
+    similarities = np.array([[0.9, 0.1, 0.2], [0.8, 0.3, 0.4]])
+    result = evals_lib.get_topic_set_similarity_from_matrix(similarities)
+    # The first set's best matches average 0.85, and the second set's 1.6 / 3.
+    self.assertAlmostEqual(result, (0.85 + 1.6 / 3) / 2)
 
-  @patch("evals_lib.get_topic_set_similarity")
+  @patch("evals_lib.embeddings.get_cosine_similarity_matrix")
   def test_analyze_topic_set_similarity_identical_dataframes(
-      self, mock_get_topic_set_similarity
+      self, mock_get_cosine_similarity_matrix
   ):
     """Test with two identical DataFrames."""
-    mock_get_topic_set_similarity.return_value = 1.0
+    mock_get_cosine_similarity_matrix.side_effect = exact_match_similarities
     df1 = pd.DataFrame({"topics": [["topic1"], ["topic2"]]})
     df2 = pd.DataFrame({"topics": [["topic1"], ["topic2"]]})
     data = [df1, df2]
     result = evals_lib.analyze_topic_set_similarity(data)
     self.assertEqual(result.mean, 1.0)
-    self.assertEqual(mock_get_topic_set_similarity.call_count, 1)
+    self.assertEqual(mock_get_cosine_similarity_matrix.call_count, 1)
 
-  @patch("evals_lib.get_topic_set_similarity")
+  @patch("evals_lib.embeddings.get_cosine_similarity_matrix")
   def test_analyze_topic_set_similarity_multiple_dataframes(
-      self, mock_get_topic_set_similarity
+      self, mock_get_cosine_similarity_matrix
   ):
     """Test with multiple DataFrames."""
-    mock_get_topic_set_similarity.side_effect = [0.5, 0.75, 0.25]
+    mock_get_cosine_similarity_matrix.side_effect = exact_match_similarities
     df1 = pd.DataFrame({"topics": [["topic1"], ["topic2"]]})
-    df2 = pd.DataFrame({"topics": [["topic3"], ["topic4"]]})
-    df3 = pd.DataFrame({"topics": [["topic5"], ["topic6"]]})
+    df2 = pd.DataFrame({"topics": [["topic1"], ["topic3"]]})
+    df3 = pd.DataFrame({"topics": [["topic4", "topic5"], []]})
     data = [df1, df2, df3]
     result = evals_lib.analyze_topic_set_similarity(data)
-    self.assertEqual(result.mean, 0.5)
-    self.assertEqual(result.min, 0.25)
-    self.assertEqual(result.max, 0.75)
-    self.assertEqual(mock_get_topic_set_similarity.call_count, 3)
+    # Only df1 and df2 have a topic in common, half of each set.
+    self.assertAlmostEqual(result.mean, 0.5 / 3)
+    self.assertEqual(result.min, 0.0)
+    self.assertEqual(result.max, 0.5)
+    # Each topic set except the last is compared to all topics at once.
+    self.assertEqual(mock_get_cosine_similarity_matrix.call_count, 2)
 
-  @patch("evals_lib.embeddings.get_cosine_distance")
-  def test_topic_centered_silhouette(self, mock_get_cosine_distance):
+  @patch("evals_lib.embeddings.get_cosine_distance_matrix")
+  def test_topic_centered_silhouette(self, mock_get_cosine_distance_matrix):
     """Test the topic_centered_silhouette function."""
     # Arrange
-    mock_get_cosine_distance.side_effect = lambda x, y: {
+    mock_get_cosine_distance_matrix.side_effect = distances_lookup({
         ("topic1", "comment1"): 0.1,
         ("topic1", "comment2"): 0.8,
         ("topic2", "comment1"): 0.7,
         ("topic2", "comment2"): 0.2,
-    }[(x, y)]
+    })
     df = pd.DataFrame({
         "comment-id": [1, 2],
         "comment_text": ["comment1", "comment2"],
@@ -178,6 +344,45 @@ class TestEvalsLib(unittest.TestCase):
     self.assertAlmostEqual(result.min, silh2, places=3)
     self.assertAlmostEqual(result.max, silh1, places=3)
 
+  @patch("evals_lib.embeddings.get_cosine_distance")
+  @patch("evals_lib.embeddings.get_cosine_distance_matrix")
+  def test_topic_centered_silhouette_matches_per_topic_scores(
+      self, mock_get_cosine_distance_matrix, mock_get_cosine_distance
+  ):
+    """Test comments with several topics against the per-topic functions."""
+    # Arrange
+    distances = {
+        (topic, comment): 0.1 * (3 * topic_index + comment_index) % 0.9
+        for topic_index, topic in enumerate(["topic1", "topic2", "topic3"])
+        for comment_index, comment in enumerate(
+            ["comment1", "comment2", "comment3", "comment4"]
+        )
+    }
+    mock_get_cosine_distance_matrix.side_effect = distances_lookup(distances)
+    mock_get_cosine_distance.side_effect = lambda x, y: distances[(x, y)]
+    df = pd.DataFrame({
+        "comment_text": ["comment1", "comment2", "comment3", "comment4"],
+        "topics": [
+            ["topic1", "topic2"],
+            ["topic1"],
+            ["topic3", "topic2"],
+            ["topic3"],
+        ],
+    })
+    expected_scores = [
+        evals_lib.topic_centered_silhouette_for_topic(df, topic)
+        for topic in ["topic1", "topic2", "topic3"]
+    ]
+
+    # Act
+    result = evals_lib.topic_centered_silhouette(df)
+
+    # Assert
+    self.assertAlmostEqual(result.mean, np.mean(expected_scores))
+    self.assertAlmostEqual(result.min, np.min(expected_scores))
+    self.assertAlmostEqual(result.max, np.max(expected_scores))
+    mock_get_cosine_distance_matrix.assert_called_once()
+
   @patch("evals_lib.embeddings.get_cosine_distance")
   def test_topic_centered_comment_separation_three_topics(
       self, mock_get_cosine_distance
@@ -196,14 +401,14 @@ class TestEvalsLib(unittest.TestCase):
     result1 = evals_lib.topic_centered_comment_separation(comment1, topics)
     self.assertEqual(result1, (0.5, "topic3"))
 
-  @patch("evals_lib.embeddings.get_embedding")
-  def test_get_topic_centroid(self, mock_get_embedding):
+  @patch("evals_lib.embeddings.get_embeddings")
+  def test_get_topic_centroid(self, mock_get_embeddings):
     """Test the get_topic_centroid method."""
     # Arrange
-    mock_get_embedding.side_effect = lambda x: {
+    mock_get_embeddings.side_effect = embeddings_lookup({
         "comment1": np.array([0.1, 0.9]),
         "comment2": np.array([0.0, 0.9]),
-    }[x]
+    })
     df = pd.DataFrame({
         "comment-id": [1, 2],
         "comment_text": ["comment1", "comment2"],
@@ -217,18 +422,18 @@ class TestEvalsLib(unittest.TestCase):
     # Assert
     np.testing.assert_array_almost_equal(result, expected_centroid)
 
-  @patch("evals_lib.embeddings.get_embedding")
-  def test_centroid_silhouette_for_single_topic(self, mock_get_embedding):
+  @patch("evals_lib.embeddings.get_embeddings")
+  def test_centroid_silhouette_for_single_topic(self, mock_get_embeddings):
     """Test the centroid_silhouette function."""
     # Arrange
-    mock_get_embedding.side_effect = lambda x: {
+    mock_get_embeddings.side_effect = embeddings_lookup({
         "comment1": np.array([2, 7]),
         "comment2": np.array([0, 9]),
         "comment3": np.array([-2, -8]),
         "comment4": np.array([-4, -6]),
         "comment5": np.array([4, 5]),
         "comment6": np.array([6, 9]),
-    }[x]
+    })
     df = pd.DataFrame([
         {"comment-id": 1, "comment_text": "comment1", "topics": ["topic1"]},
         {"comment-id": 2, "comment_text": "comment2", "topics": ["topic1"]},
@@ -254,6 +459,147 @@ class TestEvalsLib(unittest.TestCase):
     self.assertAlmostEqual(topic1_separation, sep1, places=3)
     self.assertAlmostEqual(topic1_result, silh1, places=3)
 
+  @patch("evals_lib.embeddings.get_embedding")
+  @patch("evals_lib.embeddings.get_embeddings")
+  def test_centroid_silhouette_multiple_topics(
+      self, mock_get_embeddings, mock_get_embedding
+  ):
+    """Test comments with several topics against a direct computation."""
+    # Arrange
+    vectors = {
+        "comment1": np.array([2.0, 7.0, 1.0]),
+        "comment2": np.array([0.0, 9.0, -1.0]),
+        "comment3": np.array([-2.0, -8.0, 3.0]),
+        "comment4": np.array([4.0, 5.0, 0.0]),
+    }
+    mock_get_embeddings.side_effect = embeddings_lookup(vectors)
+    mock_get_embedding.side_effect = vectors.get
+    df = pd.DataFrame([
+        {"comment_text": "comment1", "topics": ["topic1", "topic2"]},
+        {"comment_text": "comment2", "topics": ["topic1"]},
+        {"comment_text": "comment3", "topics": ["topic2", "topic3"]},
+        {"comment_text": "comment4", "topics": ["topic3"]},
+    ])
+    centroids = {
+        "topic1": (vectors["comment1"] + vectors["comment2"]) / 2,
+        "topic2": (vectors["comment1"] + vectors["comment3"]) / 2,
+        "topic3": (vectors["comment3"] + vectors["comment4"]) / 2,
+    }
+
+    def distance(a, b):
+      return 1 - np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+
+    # Act
+    silhouette_obj = evals_lib.CentroidSilhouette(df)
+
+    # Assert
+    self.assertAlmostEqual(
+        silhouette_obj.topic_cohesion("topic2"),
+        np.mean([
+            distance(centroids["topic2"], vectors["comment1"]),
+            distance(centroids["topic2"], vectors["comment3"]),
+        ]),
+    )
+    separation1 = distance(centroids["topic3"], vectors["comment1"])
+    separation3 = distance(centroids["topic1"], vectors["comment3"])
+    self.assertEqual(
+        silhouette_obj.comment_separation(df.iloc[0].to_dict()),
+        (ANY, "topic3"),
+    )
+    self.assertAlmostEqual(
+        silhouette_obj.comment_separation(df.iloc[0].to_dict())[0],
+        separation1,
+    )
+    self.assertAlmostEqual(
+        silhouette_obj.topic_separation("topic2"),
+        np.mean([separation1, separation3]),
+    )
+    # All the embeddings are fetched at once, and the centroids are cached.
+    mock_get_embeddings.assert_called_once()
+
+  def test_centroid_silhouette_matches_full_precision_computation(self):
+    """Tests float32 cached embeddings against a per-pair float64 computation.
+
+    Centroids and distances are computed from the cached float32 embeddings,
+    so results agree with a computation on the original float64 vectors to
+    within CENTROID_SILHOUETTE_TOLERANCE rather than exactly.
+    """
+    rng = np.random.default_rng(0)
+    texts = [f"comment{i}" for i in range(40)]
+    vectors = {text: rng.normal(size=64) for text in texts}
+    topics = ["topic1", "topic2", "topic3", "topic4"]
+    assignments = [
+        [topics[i % 4]] + ([topics[(i + 1) % 4]] if i % 3 == 0 else [])
+        for i in range(len(texts))
+    ]
+
+    class FakeBackend(evals_lib.embeddings.EmbeddingBackend):
+      name = "fake"
+      full_dimensionality = 64
+
+      def embed(self, texts, dimensionality=None):
+        return np.stack([vectors[text] for text in texts])
+
+    def distance(a, b):
+      return 1 - np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+
+    centroids = {
+        topic: np.mean(
+            [vectors[t] for t, a in zip(texts, assignments) if topic in a],
+            axis=0,
+        )
+        for topic in topics
+    }
+    with patch("evals_lib.embeddings.embeddings", EmbeddingTable()):
+      evals_lib.embeddings.use_backend(FakeBackend())
+      self.addCleanup(evals_lib.embeddings.use_backend, None)
+      silhouette_obj = evals_lib.CentroidSilhouette(
+          pd.DataFrame({"comment_text": texts, "topics": assignments})
+      )
+
+      for topic in topics:
+        topic_texts = [t for t, a in zip(texts, assignments) if topic in a]
+        cohesion = np.mean(
+            [distance(centroids[topic], vectors[t]) for t in topic_texts]
+        )
+        separation = np.mean([
+            min(
+                distance(centroids[other], vectors[t])
+                for other in topics
+                if other not in assignments[texts.index(t)]
+            )
+            for t in topic_texts
+        ])
+        self.assertLess(
+            abs(silhouette_obj.topic_cohesion(topic) - cohesion),
+            CENTROID_SILHOUETTE_TOLERANCE,
+        )
+        self.assertLess(
+            abs(silhouette_obj.topic_separation(topic) - separation),
+            CENTROID_SILHOUETTE_TOLERANCE,
+        )
+
+  @patch("evals_lib.embeddings.get_embedding")
+  @patch("evals_lib.embeddings.get_embeddings")
+  def test_centroid_comment_separation_all_topics(
+      self, mock_get_embeddings, mock_get_embedding
+  ):
+    """Test a comment assigned to every topic has no separation."""
+    vectors = {"comment1": np.array([1.0, 0.0]), "comment2": np.array([0, 1])}
+    mock_get_embeddings.side_effect = embeddings_lookup(vectors)
+    mock_get_embedding.side_effect = vectors.get
+    df = pd.DataFrame([
+        {"comment_text": "comment1", "topics": ["topic1", "topic2"]},
+        {"comment_text": "comment2", "topics": ["topic2"]},
+    ])
+    silhouette_obj = evals_lib.CentroidSilhouette(df)
+    separation, topic = silhouette_obj.comment_separation(
+        df.iloc[0].to_dict()
+    )
+    self.assertTrue(math.isnan(separation))
+    self.assertIsNone(topic)
+    self.assertTrue(math.isnan(silhouette_obj.topic_separation("topic2")))
+
   @patch("evals_lib.CentroidSilhouette.topic_silhouette")
   def test_centroid_silhouette_for_all_topics(self, mock_topic_silhouette):
     """Test the centroid_silhouette function."""
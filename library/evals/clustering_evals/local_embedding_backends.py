@@ -0,0 +1,215 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Embedding backends that run locally, without any API credentials.
+
+HashedTfidfBackend needs nothing beyond numpy, and SentenceTransformerBackend
+needs the optional sentence-transformers package.
+"""
+
+import hashlib
+import re
+import zlib
+from embeddings_lib import EmbeddingBackend
+import numpy as np
+
+try:
+  import sentence_transformers
+except ImportError:
+  sentence_transformers = None
+
+# The dimensionality of hashed TF-IDF embeddings.
+DEFAULT_TFIDF_DIMENSIONALITY = 256
+# The number of buckets words and word pairs are hashed into.
+DEFAULT_NUM_HASHED_FEATURES = 4096
+# Extra random directions sampled by the randomized SVD, for accuracy.
+SVD_OVERSAMPLES = 10
+# Power iterations run by the randomized SVD, for accuracy.
+SVD_POWER_ITERATIONS = 4
+# The default sentence-transformers model, which is small enough for CPUs.
+DEFAULT_SENTENCE_TRANSFORMER_MODEL = "all-MiniLM-L6-v2"
+# How many texts sentence-transformers encodes at a time.
+SENTENCE_TRANSFORMER_BATCH_SIZE = 64
+
+_WORD_PATTERN = re.compile(r"\w+")
+
+
+def _top_right_singular_vectors(
+    matrix: np.ndarray, k: int, rng: np.random.Generator
+) -> np.ndarray:
+  """Returns the top k right singular vectors of the matrix, as rows.
+
+  This uses randomized SVD (Halko et al., 2009), which is much faster than a
+  full SVD when k is small compared to the matrix.
+  """
+  k = min(k, *matrix.shape)
+  sample = rng.standard_normal(
+      (matrix.shape[1], k + SVD_OVERSAMPLES), dtype=matrix.dtype
+  )
+  basis, _ = np.linalg.qr(matrix @ sample)
+  for _ in range(SVD_POWER_ITERATIONS):
+    basis, _ = np.linalg.qr(matrix.T @ basis)
+    basis, _ = np.linalg.qr(matrix @ basis)
+  _, _, right_vectors = np.linalg.svd(basis.T @ matrix, full_matrices=False)
+  return right_vectors[:k]
+
+
+class HashedTfidfBackend(EmbeddingBackend):
+  """Embeds texts with latent semantic analysis of hashed TF-IDF vectors.
+
+  Words and word pairs are hashed into a fixed number of features, weighted by
+  TF-IDF, and projected onto the top singular vectors of the corpus. The
+  weights and projection are fit on the first texts embedded, so embed the
+  whole corpus at once first, e.g. with evals_lib.prefetch_embeddings. The
+  backend's name includes a fingerprint of that corpus, so embeddings from
+  different fits aren't mixed in the persistent store. The fingerprint is
+  taken in prepare, before the store is searched, so reruns on the same
+  corpus find their stored embeddings without fitting again.
+
+  The work is done in a few large matrix operations, which numpy's BLAS
+  spreads across all cores.
+  """
+
+  def __init__(
+      self,
+      dimensionality: int = DEFAULT_TFIDF_DIMENSIONALITY,
+      num_features: int = DEFAULT_NUM_HASHED_FEATURES,
+      seed: int = 0,
+  ):
+    """Initializes the backend.
+
+    Args:
+      dimensionality: The dimensionality of the embeddings.
+      num_features: The number of hashed features.
+      seed: The seed for the randomized SVD.
+    """
+    self.full_dimensionality = dimensionality
+    self.num_features = num_features
+    self.seed = seed
+    self.name = "hashed-tfidf-svd"
+    # The texts to fit on, once known.
+    self._corpus = None
+    self._idf = None
+    self._components = None
+
+  def _hash_counts(self, texts: list[str]) -> np.ndarray:
+    """Returns the counts of each text's hashed words and word pairs."""
+    text_indices = []
+    feature_indices = []
+    signs = []
+    for i, text in enumerate(texts):
+      words = _WORD_PATTERN.findall(text.lower())
+      tokens = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+      hashes = np.array(
+          [zlib.crc32(token.encode("utf-8")) for token in tokens],
+          dtype=np.uint32,
+      )
+      text_indices.append(np.full(len(tokens), i))
+      feature_indices.append(hashes % self.num_features)
+      # The top bit picks the sign, so that collisions tend to cancel out.
+      signs.append(np.where(hashes >> 31, -1.0, 1.0))
+
+    counts = np.zeros((len(texts), self.num_features), dtype=np.float32)
+    if texts:
+      np.add.at(
+          counts,
+          (np.concatenate(text_indices), np.concatenate(feature_indices)),
+          np.concatenate(signs),
+      )
+    return counts
+
+  def _tfidf(self, counts: np.ndarray) -> np.ndarray:
+    """Returns L2-normalized TF-IDF vectors, with sublinear term frequencies."""
+    tf = np.sign(counts) * np.log1p(np.abs(counts))
+    tfidf = tf * self._idf
+    norms = np.linalg.norm(tfidf, axis=1, keepdims=True)
+    return tfidf / np.where(norms == 0, 1, norms)
+
+  def fit(self, texts: list[str]) -> None:
+    """Fits the TF-IDF weights and SVD projection on a corpus of texts."""
+    counts = self._hash_counts(texts)
+    document_frequency = np.count_nonzero(counts, axis=0)
+    self._idf = (
+        np.log((1 + len(texts)) / (1 + document_frequency)) + 1
+    ).astype(np.float32)
+    self._components = _top_right_singular_vectors(
+        self._tfidf(counts),
+        self.full_dimensionality,
+        np.random.default_rng(self.seed),
+    )
+    self._set_corpus(texts)
+
+  def _set_corpus(self, texts: list[str]) -> None:
+    """Sets the corpus to fit on, and the name with its fingerprint."""
+    self._corpus = texts
+    corpus_hash = hashlib.sha256("\n".join(sorted(texts)).encode("utf-8"))
+    self.name = f"hashed-tfidf-svd-{corpus_hash.hexdigest()[:16]}"
+
+  def prepare(self, texts: list[str]) -> None:
+    if self._corpus is None:
+      self._set_corpus(texts)
+
+  def embed(
+      self, texts: list[str], dimensionality: int | None = None
+  ) -> np.ndarray:
+    if self._components is None:
+      self.fit(texts if self._corpus is None else self._corpus)
+    projected = self._tfidf(self._hash_counts(texts)) @ self._components.T
+    # A small corpus can have fewer singular vectors than dimensions.
+    embeddings = np.zeros(
+        (len(texts), self.full_dimensionality), dtype=np.float32
+    )
+    embeddings[:, : projected.shape[1]] = projected
+    return embeddings[:, :dimensionality]
+
+
+class SentenceTransformerBackend(EmbeddingBackend):
+  """Embeds texts with a sentence-transformers model, loaded once.
+
+  Texts are encoded in batches, and the model runs across all cores on CPU,
+  or on a GPU if one is available.
+  """
+
+  def __init__(
+      self,
+      model_name: str = DEFAULT_SENTENCE_TRANSFORMER_MODEL,
+      device: str | None = None,
+  ):
+    """Loads the model, downloading it if it isn't cached yet.
+
+    Args:
+      model_name: The name or path of the sentence-transformers model.
+      device: The device to run the model on, e.g. "cpu" or "cuda". Defaults
+        to a GPU if one is available.
+    """
+    if sentence_transformers is None:
+      raise ImportError(
+          "SentenceTransformerBackend requires the sentence-transformers"
+          " package: pip install sentence-transformers"
+      )
+    self._model = sentence_transformers.SentenceTransformer(
+        model_name, device=device
+    )
+    self.name = f"sentence-transformers/{model_name}"
+    self.full_dimensionality = self._model.get_sentence_embedding_dimension()
+
+  def embed(
+      self, texts: list[str], dimensionality: int | None = None
+  ) -> np.ndarray:
+    embeddings = self._model.encode(
+        texts,
+        batch_size=SENTENCE_TRANSFORMER_BATCH_SIZE,
+        convert_to_numpy=True,
+    )
+    return embeddings[:, :dimensionality]
@@ -0,0 +1,122 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for local_embedding_backends."""
+
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+from embedding_store import EmbeddingStore
+from embedding_table import EmbeddingTable
+import embeddings_lib
+# Module under test
+import local_embedding_backends
+import numpy as np
+
+CORPUS = [
+    "We need more affordable housing in the city",
+    "Housing prices in the city are not affordable",
+    "Rent for housing keeps going up",
+    "The public parks need more trees",
+    "Plant more trees in the parks",
+    "Buses should run more often at night",
+    "Night bus service is too infrequent",
+]
+
+
+def cosine_similarity(a: np.ndarray, b: np.ndarray) -> float:
+  return np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b))
+
+
+class TestHashedTfidfBackend(unittest.TestCase):
+
+  def test_similar_texts_are_closer(self):
+    backend = local_embedding_backends.HashedTfidfBackend(dimensionality=4)
+    vectors = backend.embed(CORPUS)
+
+    self.assertEqual(vectors.shape, (len(CORPUS), 4))
+    self.assertGreater(
+        cosine_similarity(vectors[0], vectors[1]),
+        cosine_similarity(vectors[0], vectors[3]),
+    )
+    self.assertGreater(
+        cosine_similarity(vectors[5], vectors[6]),
+        cosine_similarity(vectors[5], vectors[4]),
+    )
+
+  def test_embeddings_are_stable_after_fitting(self):
+    backend = local_embedding_backends.HashedTfidfBackend(dimensionality=4)
+    vectors = backend.embed(CORPUS)
+    name = backend.name
+
+    np.testing.assert_allclose(
+        backend.embed(CORPUS[2:3]), vectors[2:3], atol=1e-6
+    )
+    self.assertEqual(backend.name, name)
+    self.assertTrue(name.startswith("hashed-tfidf-svd-"))
+
+  def test_pads_and_truncates_dimensionality(self):
+    backend = local_embedding_backends.HashedTfidfBackend(dimensionality=32)
+    self.assertEqual(backend.embed(CORPUS).shape, (len(CORPUS), 32))
+    self.assertEqual(backend.embed(CORPUS, 2).shape, (len(CORPUS), 2))
+
+  def test_works_as_embeddings_lib_backend(self):
+    with patch("embeddings_lib.embeddings", embeddings_lib.embeddings):
+      embeddings_lib.use_backend(
+          local_embedding_backends.HashedTfidfBackend(dimensionality=4)
+      )
+      self.addCleanup(embeddings_lib.use_backend, None)
+
+      embeddings_lib.get_embeddings(CORPUS)
+      self.assertGreater(
+          embeddings_lib.get_cosine_similarity(CORPUS[3], CORPUS[4]),
+          embeddings_lib.get_cosine_similarity(CORPUS[3], CORPUS[0]),
+      )
+
+  @patch("embeddings_lib.embeddings", new_callable=EmbeddingTable)
+  def test_reruns_find_stored_embeddings(self, unused_table):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    store = EmbeddingStore(os.path.join(temp_dir.name, "embeddings.sqlite"))
+    self.addCleanup(store.close)
+    embeddings_lib.use_store(store)
+    self.addCleanup(embeddings_lib.use_store, None)
+    self.addCleanup(embeddings_lib.use_backend, None)
+
+    embeddings_lib.use_backend(
+        local_embedding_backends.HashedTfidfBackend(dimensionality=4)
+    )
+    vectors = embeddings_lib.get_embeddings(CORPUS)
+
+    # A new process starts with an unfitted backend and an empty cache.
+    backend = local_embedding_backends.HashedTfidfBackend(dimensionality=4)
+    embeddings_lib.use_backend(backend)
+    with patch.object(backend, "fit") as mock_fit:
+      np.testing.assert_allclose(
+          embeddings_lib.get_embeddings(CORPUS), vectors, atol=1e-6
+      )
+    mock_fit.assert_not_called()
+
+
+class TestSentenceTransformerBackend(unittest.TestCase):
+
+  @patch("local_embedding_backends.sentence_transformers", None)
+  def test_requires_sentence_transformers(self):
+    with self.assertRaises(ImportError):
+      local_embedding_backends.SentenceTransformerBackend()
+
+
+if __name__ == "__main__":
+  unittest.main()
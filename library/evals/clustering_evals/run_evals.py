@@ -15,13 +15,18 @@
 """This script runs evals on Topic Identification and Categorization.
 
 Be sure to set the following environment variables before running for access to
-Gemini embeddings:
+Gemini embeddings, unless a local --embedding-backend is used:
 export GOOGLE_CLOUD_PROJECT=<your project name>
 export GOOGLE_CLOUD_LOCATION=us-central1
 export GOOGLE_GENAI_USE_VERTEXAI=True
 """
 import argparse
+import functools
+import embedding_store
+import embedding_table
+import embeddings_lib
 import evals_lib
+import local_embedding_backends
 import pandas as pd
 
 
@@ -45,7 +50,80 @@ def parse_arguments() -> argparse.Namespace:
       required=True,
       help="Path where the output CSV results file will be saved.",
   )
-  return parser.parse_args()
+  parser.add_argument(
+      "--embedding-backend",
+      type=str,
+      choices=("gemini", "hashed-tfidf", "sentence-transformers"),
+      default="gemini",
+      help=(
+          "What to compute embeddings with. hashed-tfidf and"
+          " sentence-transformers run locally without credentials."
+      ),
+  )
+  parser.add_argument(
+      "--sentence-transformer-model",
+      type=str,
+      default=local_embedding_backends.DEFAULT_SENTENCE_TRANSFORMER_MODEL,
+      help="The model to use with the sentence-transformers backend.",
+  )
+  parser.add_argument(
+      "--embedding-store-path",
+      type=str,
+      help=(
+          "Path of a SQLite file to persist embeddings in across runs. If not"
+          " set, embeddings are only cached in memory."
+      ),
+  )
+  parser.add_argument(
+      "--embedding-store-max-mb",
+      type=int,
+      default=embedding_store.DEFAULT_MAX_SIZE_BYTES // 1024**2,
+      help="The size in MB after which old stored embeddings are evicted.",
+  )
+  parser.add_argument(
+      "--embedding-dtype",
+      type=str,
+      choices=embedding_table.SUPPORTED_DTYPES,
+      default="float32",
+      help=(
+          "The dtype to keep embeddings in memory as. float16 and int8 use less"
+          " memory, at the cost of some precision."
+      ),
+  )
+  parser.add_argument(
+      "--embedding-dimensionality",
+      type=int,
+      help=(
+          "The dimensionality to run evals at, e.g. 256 or 768. Defaults to the"
+          " embedding model's full dimensionality."
+      ),
+  )
+  parser.add_argument(
+      "--calibrate-dimensionalities",
+      type=int,
+      nargs="+",
+      help=(
+          "Dimensionalities to compare the evals at against full"
+          " dimensionality. Requires --calibration-csv-path."
+      ),
+  )
+  parser.add_argument(
+      "--calibration-csv-path",
+      type=str,
+      help="Path where the dimensionality calibration CSV will be saved.",
+  )
+  parser.add_argument(
+      "--max-workers",
+      type=int,
+      help=(
+          "The maximum number of processes to evaluate runs in parallel with."
+          " Defaults to the number of CPUs."
+      ),
+  )
+  args = parser.parse_args()
+  if args.calibrate_dimensionalities and not args.calibration_csv_path:
+    parser.error("--calibrate-dimensionalities requires --calibration-csv-path")
+  return args
 
 
 class ResultsData:
@@ -55,45 +133,99 @@ class ResultsData:
     self.results = results
 
 
+def get_embedding_backend(
+    args: argparse.Namespace,
+) -> embeddings_lib.EmbeddingBackend:
+  """Returns the embedding backend selected by the arguments."""
+  if args.embedding_backend == "hashed-tfidf":
+    return local_embedding_backends.HashedTfidfBackend()
+  if args.embedding_backend == "sentence-transformers":
+    return local_embedding_backends.SentenceTransformerBackend(
+        args.sentence_transformer_model
+    )
+  return embeddings_lib.GeminiBackend()
+
+
+# Analyses that don't use embeddings, and so don't depend on dimensionality.
+NON_EMBEDDING_ANALYSES = (
+    "Topic Categorization Diff Rate",
+    "Topic Categorization Change Degree",
+)
+
+
+def get_analyses(
+    data: list[pd.DataFrame], max_workers: int | None = None
+) -> dict[str, evals_lib.Analysis]:
+  """Returns the analyses to run on the data, by name.
+
+  Args:
+    data: A list of comments dataframes.
+    max_workers: The maximum number of processes the silhouette analyses
+      evaluate runs in parallel with, defaulting to the number of CPUs.
+  """
+  analyses = {}
+  # These evals require comparing different runs, so they should be skipped if
+  # there's only one input dataset.
+  if len(data) > 1:
+    analyses["Topic Categorization Diff Rate"] = (
+        evals_lib.analyze_categorization_diffs
+    )
+    analyses["Topic Categorization Change Degree"] = (
+        evals_lib.analyze_categorization_change_degree
+    )
+    analyses["Topic Set Similarity"] = evals_lib.analyze_topic_set_similarity
+
+  analyses["Topic Centered Silhouette"] = functools.partial(
+      evals_lib.analyze_topic_centered_silhouette_scores,
+      max_workers=max_workers,
+  )
+  analyses["Centroid Centered Silhouette"] = functools.partial(
+      evals_lib.analyze_centroid_silhouette_scores,
+      max_workers=max_workers,
+  )
+  return analyses
+
+
 def main(args: argparse.Namespace) -> None:
   input_files = args.input_data
   output_path = args.output_csv_path
 
+  embeddings_lib.set_embedding_dtype(args.embedding_dtype)
+  embeddings_lib.use_backend(get_embedding_backend(args))
+  if args.embedding_store_path:
+    embeddings_lib.use_store(
+        embedding_store.EmbeddingStore(
+            args.embedding_store_path,
+            max_size_bytes=args.embedding_store_max_mb * 1024**2,
+        )
+    )
+
   data = []
   for filepath in input_files:
     new_df = pd.read_csv(filepath)
     new_df = evals_lib.convert_topics_col_to_list(new_df)
     data.append(new_df)
 
-  results = []
-  # These evals require comparing different runs, so they should be skipped if
-  # there's only one input dataset.
-  if len(data) > 1:
-    results.append(
-        ResultsData(
-            name="Topic Categorization Diff Rate",
-            results=evals_lib.analyze_categorization_diffs(data),
-        )
-    )
-    results.append(
-        ResultsData(
-            name="Topic Set Similarity",
-            results=evals_lib.analyze_topic_set_similarity(data),
-        )
+  if args.calibrate_dimensionalities:
+    # Calibration starts from full dimensionality embeddings, so run it before
+    # the evals truncate them.
+    embedding_analyses = {
+        name: analysis
+        for name, analysis in get_analyses(data, args.max_workers).items()
+        if name not in NON_EMBEDDING_ANALYSES
+    }
+    calibration = evals_lib.calibrate_dimensionality(
+        data, embedding_analyses, args.calibrate_dimensionalities
     )
+    with open(args.calibration_csv_path, "w") as f:
+      calibration.to_csv(f, index=False)
 
-  results.append(
-      ResultsData(
-          name="Topic Centered Silhouette",
-          results=evals_lib.analyze_topic_centered_silhouette_scores(data),
-      )
-  )
-  results.append(
-      ResultsData(
-          name="Centroid Centered Silhouette",
-          results=evals_lib.analyze_centroid_silhouette_scores(data),
-      )
-  )
+  embeddings_lib.set_output_dimensionality(args.embedding_dimensionality)
+  evals_lib.prefetch_embeddings(data)
+  results = [
+      ResultsData(name=name, results=analysis(data))
+      for name, analysis in get_analyses(data, args.max_workers).items()
+  ]
 
   # Create a dictionary to store the results
   results_data = {
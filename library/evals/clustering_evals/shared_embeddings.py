@@ -0,0 +1,114 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shares an EmbeddingTable with worker processes through shared memory.
+
+The table's embeddings are copied into shared memory once, and each worker
+maps them as numpy arrays without copying, so they aren't pickled for every
+task sent to the workers.
+"""
+
+from multiprocessing import shared_memory
+from typing import NamedTuple
+from embedding_table import EmbeddingTable
+import numpy as np
+
+# The shared memory blocks attached in this process. They're kept open for as
+# long as the process runs, since the tables attached to them use their memory.
+_attached_blocks = []
+
+
+class SharedTableHandle(NamedTuple):
+  """Identifies a table in shared memory, to attach to it in another process."""
+
+  texts: list[str]
+  shape: tuple[int, int]
+  dtype: str
+  matrix_block_name: str
+  norms_block_name: str
+
+
+def _copy_to_block(array: np.ndarray) -> shared_memory.SharedMemory:
+  # Shared memory blocks can't be empty.
+  block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+  np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+  return block
+
+
+class SharedEmbeddingTable:
+  """A copy of an EmbeddingTable in shared memory.
+
+  The shared memory is freed when the SharedEmbeddingTable is closed, so keep
+  it open while other processes use it, e.g.
+
+    with SharedEmbeddingTable(table) as shared_table:
+      with ProcessPoolExecutor(
+          initializer=attach, initargs=(shared_table.handle,)
+      ) as pool:
+        ...
+  """
+
+  def __init__(self, table: EmbeddingTable):
+    """Copies the table's embeddings into shared memory.
+
+    Args:
+      table: The table to share.
+    """
+    texts, normalized, norms = table.arrays()
+    self._matrix_block = _copy_to_block(normalized)
+    self._norms_block = _copy_to_block(norms)
+    self.handle = SharedTableHandle(
+        texts=texts,
+        shape=normalized.shape,
+        dtype=normalized.dtype.name,
+        matrix_block_name=self._matrix_block.name,
+        norms_block_name=self._norms_block.name,
+    )
+
+  def close(self):
+    """Frees the shared memory."""
+    for block in (self._matrix_block, self._norms_block):
+      block.close()
+      block.unlink()
+
+  def __enter__(self) -> "SharedEmbeddingTable":
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.close()
+
+
+def attach(handle: SharedTableHandle) -> EmbeddingTable:
+  """Returns a table backed by the shared memory of a SharedEmbeddingTable.
+
+  The table reads the shared embeddings without copying them, and can't
+  change them. Adding texts that aren't shared copies the embeddings into the
+  process's own memory first.
+
+  Args:
+    handle: The handle of the SharedEmbeddingTable.
+  """
+  matrix_block = shared_memory.SharedMemory(name=handle.matrix_block_name)
+  norms_block = shared_memory.SharedMemory(name=handle.norms_block_name)
+  _attached_blocks.extend([matrix_block, norms_block])
+  normalized = np.ndarray(
+      handle.shape, dtype=handle.dtype, buffer=matrix_block.buf
+  )
+  norms = np.ndarray(
+      (len(handle.texts),), dtype=np.float32, buffer=norms_block.buf
+  )
+  # Other processes read the same memory, so don't let this one change it.
+  normalized.flags.writeable = False
+  norms.flags.writeable = False
+  return EmbeddingTable.from_arrays(handle.texts, normalized, norms)
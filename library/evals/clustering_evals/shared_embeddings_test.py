@@ -0,0 +1,55 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http:#www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Tests for shared_embeddings."""
+
+from multiprocessing import shared_memory
+import unittest
+from embedding_table import EmbeddingTable
+import numpy as np
+# Module under test
+import shared_embeddings
+
+
+class TestSharedEmbeddings(unittest.TestCase):
+
+  def test_attach_reads_shared_table(self):
+    table = EmbeddingTable("int8")
+    table.add(["a", "b"], np.array([[3.0, 4.0], [0.0, 2.0]]))
+
+    with shared_embeddings.SharedEmbeddingTable(table) as shared_table:
+      attached = shared_embeddings.attach(shared_table.handle)
+
+      self.assertEqual(len(attached), 2)
+      self.assertEqual(attached.dtype, np.int8)
+      np.testing.assert_allclose(
+          attached.get_vectors(["b", "a"]), table.get_vectors(["b", "a"])
+      )
+      # The shared embeddings can't be changed, but new ones can be added.
+      with self.assertRaises(ValueError):
+        attached.add(["a"], np.array([[1.0, 0.0]]))
+      attached.add(["c"], np.array([[1.0, 0.0]]))
+      np.testing.assert_allclose(attached.get_vectors(["c"]), [[1.0, 0.0]])
+
+  def test_close_frees_shared_memory(self):
+    shared_table = shared_embeddings.SharedEmbeddingTable(EmbeddingTable())
+    name = shared_table.handle.matrix_block_name
+    shared_table.close()
+
+    with self.assertRaises(FileNotFoundError):
+      shared_memory.SharedMemory(name=name)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -17,6 +17,7 @@ This module provides a wrapper around the Google Generative AI API.
 """
 
 import asyncio
+import concurrent.futures
 import logging
 import random
 import os
@@ -29,6 +30,10 @@ from google.protobuf import duration_pb2, json_format
 from google.api_core import exceptions as google_exceptions
 import pandas as pd
 
+from .run_progress import RunProgress
+from .token_budget import TokenBudget
+from .token_limits import OutputTokenLimiter
+
 
 class GenaiModelError(Exception):
   """Base exception for errors in the GenaiModel."""
@@ -43,6 +48,8 @@ class Job(TypedDict, total=False):
   delay_between_calls_seconds: int
   initial_retry_delay: int
   job_id: int
+  job_type: Optional[str]
+  max_output_tokens: Optional[int]
   opinion: Optional[str]
   opinion_num: Optional[int]
   prompt: str
@@ -65,6 +72,8 @@ RETRY_DELAY_SEC = 1
 INITIAL_RETRY_DELAY = 0.5
 # Maximum number of concurrent API calls.
 MAX_CONCURRENT_CALLS = 100
+# Maximum number of responses waiting on, or being parsed by, a parser executor.
+MAX_PENDING_PARSES = 64
 
 COMPLETED_BATCH_JOB_STATES = frozenset({
     "JOB_STATE_SUCCEEDED",
@@ -74,6 +83,38 @@ COMPLETED_BATCH_JOB_STATES = frozenset({
 })
 
 
+def _timed_parse(
+    response_parser: Callable[[str, Dict[str, Any]], Any],
+    resp: Dict[str, Any],
+    job: Job,
+) -> Tuple[Any, float]:
+  """Runs the response parser and returns its result with the parse time.
+
+  This is a module-level function so it can be pickled and sent to a
+  ProcessPoolExecutor. The time excludes any time spent waiting in the
+  executor's queue.
+  """
+  start_time = time.perf_counter()
+  result = response_parser(resp, job)
+  return result, time.perf_counter() - start_time
+
+
+def _usage_fields(response: Any) -> Dict[str, Any]:
+  """Returns the token counts of a response, or {} if it has none."""
+  usage_metadata = getattr(response, "usage_metadata", None)
+  if usage_metadata is None:
+    return {}
+  return {
+      "total_token_count": usage_metadata.total_token_count,
+      "prompt_token_count": usage_metadata.prompt_token_count,
+      "candidates_token_count": usage_metadata.candidates_token_count,
+      "tool_use_prompt_token_count": (
+          usage_metadata.tool_use_prompt_token_count
+      ),
+      "thoughts_token_count": usage_metadata.thoughts_token_count,
+  }
+
+
 class GenaiModel:
   """A wrapper around the Google Generative AI API."""
 
@@ -82,6 +123,7 @@ class GenaiModel:
       model_name: str,
       api_key: str | None = None,
       safety_filters_on: bool = False,
+      output_token_limiter: Optional[OutputTokenLimiter] = None,
   ):
     """Initializes the GenaiModel.
 
@@ -90,6 +132,9 @@ class GenaiModel:
       api_key: The Google Generative AI API key. If not provided, the
         GOOGLE_API_KEY environment variable will be used.
       safety_filters_on: Whether to enable safety filters. Defaults to False.
+      output_token_limiter: If set, output and thinking token counts are
+        recorded for each job's `job_type`, and used to set tighter
+        `max_output_tokens` and thinking budgets on later jobs of that type.
     """
     if not api_key:
       api_key = os.getenv("GOOGLE_API_KEY")
@@ -101,6 +146,7 @@ class GenaiModel:
 
     self.client = genai.Client(api_key=api_key)
     self.model = model_name
+    self.output_token_limiter = output_token_limiter
     self.safety_settings = (
         [
             genai.types.SafetySetting(
@@ -181,6 +227,40 @@ class GenaiModel:
     logging.info("   Resuming all workers after availability pause.")
     self._system_available_event.set()
 
+  def _get_pause_state(self) -> Optional[str]:
+    """Returns why workers are globally paused, or None if they aren't."""
+    if not self._quota_available_event.is_set():
+      return "quota"
+    if not self._system_available_event.is_set():
+      return "service unavailable"
+    return None
+
+  async def _parse_response(
+      self,
+      response_parser: Callable[[str, Dict[str, Any]], Any],
+      resp: Dict[str, Any],
+      job: Job,
+      parser_executor: Optional[concurrent.futures.Executor],
+      parse_semaphore: Optional[asyncio.Semaphore],
+  ) -> Tuple[Any, float]:
+    """Runs the response parser inline, or in the executor if one is given.
+
+    When an executor is used, the semaphore bounds how many responses can be
+    queued for parsing at once, so that fast API calls can't pile up an
+    unbounded backlog of unparsed responses in memory.
+
+    Returns:
+      A tuple of the parser result and the time in seconds spent parsing.
+    """
+    if parser_executor is None:
+      return _timed_parse(response_parser, resp, job)
+
+    loop = asyncio.get_running_loop()
+    async with parse_semaphore:
+      return await loop.run_in_executor(
+          parser_executor, _timed_parse, response_parser, resp, job
+      )
+
   async def _api_worker_with_retry(
       self,
       worker_id: int,
@@ -189,6 +269,10 @@ class GenaiModel:
       stats_list: list,
       stop_event: asyncio.Event,
       response_parser: Callable[[str, Dict[str, Any]], Any],
+      parser_executor: Optional[concurrent.futures.Executor] = None,
+      parse_semaphore: Optional[asyncio.Semaphore] = None,
+      token_budget: Optional[TokenBudget] = None,
+      progress: Optional[RunProgress] = None,
   ):
     """
     Consumes jobs from the queue, calls the Gemini API with retry logic,
@@ -220,7 +304,12 @@ class GenaiModel:
       response_mime_type = job.get("response_mime_type")
       response_schema = job.get("response_schema")
       thinking_budget = job.get("thinking_budget")
+      max_output_tokens = job.get("max_output_tokens")
+      job_type = job.get("job_type")
       temperature = job.get("temperature", 0.0)
+      # Whether learned token limits are used. They are dropped for the rest of
+      # the job if they cause a response to be cut short.
+      use_learned_limits = self.output_token_limiter is not None
 
       # Prepare logging prefix
       log_prefix = f"[Worker-{worker_id}]"
@@ -234,9 +323,16 @@ class GenaiModel:
       else:
         log_prefix += f" Processing job"
 
+      if progress is not None:
+        progress.job_started()
+      succeeded = False
+
       # Initialize failure tracking stats
       stats["non_quota_failures"] = 0
       stats["is_complete_failure"] = False
+      stats["parse_time_seconds"] = 0.0
+      stats["stopped_by_token_budget"] = False
+      stats["token_limit_fallbacks"] = 0
 
       # This list tracks failures for this job, to be included in the final
       # results for debugging. It is not part of the retry logic itself.
@@ -254,11 +350,26 @@ class GenaiModel:
         if stop_event.is_set():
           logging.info(f"{log_prefix} Stop event received, terminating.")
           break
+        # Stop dispatching new calls once the run's budget is used up.
+        if token_budget is not None and not (
+            await token_budget.wait_for_capacity()
+        ):
+          stats["stopped_by_token_budget"] = True
+          break
 
         API_ERROR = "API Error"
 
         try:
-          logging.info(f"{log_prefix} (Attempt {attempt + 1})...")
+          logging.debug(f"{log_prefix} (Attempt {attempt + 1})...")
+
+          attempt_max_output_tokens = max_output_tokens
+          attempt_thinking_budget = thinking_budget
+          if use_learned_limits:
+            attempt_max_output_tokens, attempt_thinking_budget = (
+                self.output_token_limiter.get_limits(
+                    job_type, max_output_tokens, thinking_budget
+                )
+            )
 
           # Make the actual API call
           resp = await self._call_gemini(
@@ -267,9 +378,31 @@ class GenaiModel:
               system_prompt=system_prompt,
               response_mime_type=response_mime_type,
               response_schema=response_schema,
-              thinking_budget=thinking_budget,
+              thinking_budget=attempt_thinking_budget,
               temperature=temperature,
+              max_output_tokens=attempt_max_output_tokens,
           )
+          if token_budget is not None:
+            token_budget.record_response(resp)
+
+          if (
+              use_learned_limits
+              and resp.get("error") == "MAX_TOKENS"
+              and (
+                  attempt_max_output_tokens != max_output_tokens
+                  or attempt_thinking_budget != thinking_budget
+              )
+          ):
+            # The learned limits were too tight for this job. Retry it with its
+            # own limits, without counting this against its attempts.
+            logging.warning(
+                f"{log_prefix} Response cut short by learned token limits,"
+                " retrying without them."
+            )
+            use_learned_limits = False
+            stats["token_limit_fallbacks"] += 1
+            self.output_token_limiter.record_truncation(job_type)
+            continue
 
           if resp.get("error"):
             # Raise the error to be handled by the common exception block
@@ -280,9 +413,16 @@ class GenaiModel:
 
           try:
             job["current_attempt"] = attempt
-            result = response_parser(resp, job)
+            result, parse_time = await self._parse_response(
+                response_parser,
+                resp,
+                job,
+                parser_executor,
+                parse_semaphore,
+            )
           except Exception as e:
             raise Exception(f"Response parsing failed: {e}")
+          stats["parse_time_seconds"] += parse_time
 
           # --- Success Path ---
           result_data = {
@@ -296,12 +436,20 @@ class GenaiModel:
                   "tool_use_prompt_token_count"
               ],
               "thoughts_token_count": resp["thoughts_token_count"],
+              "parse_time_seconds": parse_time,
               "failed_tries": pd.DataFrame(failed_tries),
           }
           # Merge the original job data into the result
           result_data = {**job, **result_data}
           results_list.append(result_data)
 
+          if self.output_token_limiter is not None:
+            self.output_token_limiter.record(
+                job_type,
+                resp["candidates_token_count"],
+                resp["thoughts_token_count"],
+            )
+
           stats["total_token_used"] = resp["total_token_count"]
           stats["prompt_token_count"] = resp["prompt_token_count"]
           stats["candidates_token_count"] = resp["candidates_token_count"]
@@ -310,7 +458,8 @@ class GenaiModel:
           # On success, reset the availability backoff delay
           self._backoff_delay = self._initial_backoff_delay
 
-          logging.info(f"✅ {log_prefix} Successfully processed.")
+          succeeded = True
+          logging.debug(f"✅ {log_prefix} Successfully processed.")
 
           # Add a delay after a successful call to respect rate limits.
           await asyncio.sleep(delay_between_calls_seconds)
@@ -430,6 +579,10 @@ class GenaiModel:
 
       # Always append the stats object to the list, regardless of success.
       stats_list.append(stats)
+      if progress is not None:
+        progress.job_finished(
+            succeeded, (stats.get("total_token_used") or 0) if succeeded else 0
+        )
       queue.task_done()
 
   async def process_prompts_concurrently(
@@ -440,11 +593,39 @@ class GenaiModel:
       retry_attempts: int = MAX_LLM_RETRIES,
       initial_retry_delay: int = INITIAL_RETRY_DELAY,
       delay_between_calls_seconds: int = RETRY_DELAY_SEC,
+      parser_executor: Optional[concurrent.futures.Executor] = None,
+      max_pending_parses: int = MAX_PENDING_PARSES,
+      token_budget: Optional[TokenBudget] = None,
+      progress_interval_seconds: Optional[float] = None,
+      progress_status_file: Optional[str] = None,
   ) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Orchestrates the process of generating prompts and processing them
     using a queue and concurrent workers.
 
+    Args:
+      prompts: The jobs to process. Each one must contain a "prompt".
+      response_parser: Called with the API response and the job, and returns
+        the parsed result. A parser that raises causes the job to be retried.
+      max_concurrent_calls: The number of concurrent API workers.
+      retry_attempts: How many times a job is tried before it's given up on.
+      initial_retry_delay: The delay before the first retry of a job.
+      delay_between_calls_seconds: How long a worker waits after a success.
+      parser_executor: An optional executor to run the response parser in, so
+        that CPU-heavy parsing doesn't block the event loop making API calls.
+        With a ProcessPoolExecutor the parser and jobs must be picklable, and
+        changes the parser makes to the job are not seen by the caller.
+      max_pending_parses: The maximum number of responses that can be waiting
+        on, or running in, the parser executor. Unused without an executor.
+      token_budget: An optional budget that is enforced as the run progresses.
+        Calls are throttled as it nears its limit, and jobs that haven't
+        started when it runs out are skipped and marked with
+        `stopped_by_token_budget` in their stats.
+      progress_interval_seconds: If set, a one line summary of progress,
+        throughput, pause state and ETA is logged at this interval.
+      progress_status_file: If set, the same progress is written as JSON to
+        this path at each interval, every 60 seconds by default.
+
     Returns:
         A tuple containing:
         - llm_response: A DataFrame with the successful results.
@@ -458,6 +639,19 @@ class GenaiModel:
     final_results: List[Dict] = []
     final_stats: List[Dict] = []
     stop_event = asyncio.Event()
+    parse_semaphore = (
+        asyncio.Semaphore(max_pending_parses) if parser_executor else None
+    )
+
+    progress = None
+    progress_reporter = None
+    if progress_interval_seconds or progress_status_file:
+      progress = RunProgress(len(prompts), status_file=progress_status_file)
+      progress_reporter = asyncio.create_task(
+          progress.report_periodically(
+              progress_interval_seconds or 60, self._get_pause_state
+          )
+      )
 
     # Create and start the worker tasks
     workers: List[asyncio.Task] = [
@@ -469,6 +663,10 @@ class GenaiModel:
                 final_stats,
                 stop_event,
                 response_parser,
+                parser_executor,
+                parse_semaphore,
+                token_budget,
+                progress,
             )
         )
         for i in range(max_concurrent_calls)
@@ -505,15 +703,34 @@ class GenaiModel:
       # Wait for workers to finish gracefully
       await asyncio.gather(*workers, return_exceptions=True)
       logging.info("Workers stopped.")
+    finally:
+      if progress_reporter is not None:
+        progress_reporter.cancel()
+        progress.report(self._get_pause_state())
 
     # --- Create final DataFrames from the aggregated results ---
     llm_response = pd.DataFrame(final_results)
     llm_response_stats = pd.DataFrame(final_stats)
 
     self._log_retry_summary(llm_response)
+    self._log_parse_time_summary(llm_response)
+    if token_budget is not None:
+      token_budget.log_summary()
 
     return llm_response, llm_response_stats
 
+  def _log_parse_time_summary(self, results_df: pd.DataFrame):
+    """Logs how much time was spent in the response parser."""
+    if "parse_time_seconds" not in results_df.columns:
+      return
+
+    parse_times = results_df["parse_time_seconds"]
+    logging.info(
+        f"Response parsing took {parse_times.sum():.2f}s in total"
+        f" (mean: {parse_times.mean() * 1000:.1f}ms,"
+        f" max: {parse_times.max() * 1000:.1f}ms per job)."
+    )
+
   def _log_retry_summary(self, results_df: pd.DataFrame):
     """Logs a summary of how many retries each job required."""
     if "failed_tries" not in results_df.columns:
@@ -547,6 +764,7 @@ class GenaiModel:
       response_mime_type: Optional[str] = None,
       response_schema: Optional[Dict[str, Any]] = None,
       thinking_budget: Optional[int] = None,
+      max_output_tokens: Optional[int] = None,
   ) -> Optional[Dict[str, Any]]:
     """Calls the Gemini model with the given prompt.
 
@@ -558,6 +776,8 @@ class GenaiModel:
       response_mime_type: The response mime type to use for the model.
       response_schema: The response schema to use for the model.
       thinking_budget: The token budget for the model's thinking process.
+      max_output_tokens: The maximum number of tokens the model can generate,
+        including thinking tokens.
 
     Returns:
       A dictionary containing the model's response and token count,
@@ -583,6 +803,7 @@ class GenaiModel:
               response_mime_type=response_mime_type,
               response_schema=response_schema,
               thinking_config=thinking_config,
+              max_output_tokens=max_output_tokens,
               automatic_function_calling=genai.types.AutomaticFunctionCallingConfig(
                   maximum_remote_calls=MAX_CONCURRENT_CALLS
               ),
@@ -591,7 +812,8 @@ class GenaiModel:
       if not response.candidates:
         logging.error("The response from the API contained no candidates.")
         logging.error("This might be due to a problem with the prompt itself.")
-        return {"error": response.prompt_feedback}
+        # The prompt was still processed, so its tokens are billed.
+        return {"error": response.prompt_feedback, **_usage_fields(response)}
 
       candidate = response.candidates[0]
 
@@ -606,17 +828,7 @@ class GenaiModel:
             "function_name": function_call.name,
             "function_args": json_format.MessageToDict(function_call.args),
             "text": "",  # Ensure text field exists to avoid key errors
-            "total_token_count": response.usage_metadata.total_token_count,
-            "prompt_token_count": response.usage_metadata.prompt_token_count,
-            "candidates_token_count": (
-                response.usage_metadata.candidates_token_count
-            ),
-            "tool_use_prompt_token_count": (
-                response.usage_metadata.tool_use_prompt_token_count
-            ),
-            "thoughts_token_count": (
-                response.usage_metadata.thoughts_token_count
-            ),
+            **_usage_fields(response),
             "error": None,
         }
 
@@ -631,21 +843,15 @@ class GenaiModel:
             "error": candidate.finish_reason.name,
             "finish_message": candidate.finish_message,
             "token_count": candidate.token_count,
+            # Truncated and blocked responses are billed like complete ones.
+            **_usage_fields(response),
         }
 
       return {
           "text": (
               candidate.content.parts[0].text if candidate.content.parts else ""
           ),
-          "total_token_count": response.usage_metadata.total_token_count,
-          "prompt_token_count": response.usage_metadata.prompt_token_count,
-          "candidates_token_count": (
-              response.usage_metadata.candidates_token_count
-          ),
-          "tool_use_prompt_token_count": (
-              response.usage_metadata.tool_use_prompt_token_count
-          ),
-          "thoughts_token_count": response.usage_metadata.thoughts_token_count,
+          **_usage_fields(response),
           "error": None,
       }
     except Exception as e:
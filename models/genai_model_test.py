@@ -1,11 +1,17 @@
 import unittest
 from unittest.mock import patch, MagicMock, AsyncMock
 import asyncio
+import concurrent.futures
+import json
+import os
+import tempfile
 import pandas as pd
 import logging
 from google.api_core import exceptions as google_exceptions
 
 from models import genai_model
+from models.token_budget import TokenBudget
+from models.token_limits import OutputTokenLimiter
 
 # Disable logging for tests
 logging.disable(logging.CRITICAL)
@@ -114,6 +120,11 @@ class GenaiModelAsyncMethodsTest(unittest.TestCase):
     mock_candidate.token_count = 0
     mock_candidate.content.parts = []
     mock_response.candidates = [mock_candidate]
+    mock_response.usage_metadata.total_token_count = 12
+    mock_response.usage_metadata.prompt_token_count = 7
+    mock_response.usage_metadata.candidates_token_count = 0
+    mock_response.usage_metadata.tool_use_prompt_token_count = 0
+    mock_response.usage_metadata.thoughts_token_count = 5
     mock_client_instance.aio.models.generate_content.return_value = (
         mock_response
     )
@@ -123,6 +134,8 @@ class GenaiModelAsyncMethodsTest(unittest.TestCase):
 
     self.assertEqual(result['error'], 'SAFETY')
     self.assertEqual(result['finish_message'], 'Blocked for safety')
+    self.assertEqual(result['total_token_count'], 12)
+    self.assertEqual(result['thoughts_token_count'], 5)
 
   def test_call_gemini_empty_prompt(self, mock_genai_client):
     """Tests a call to the Gemini API with an empty prompt."""
@@ -277,6 +290,210 @@ class GenaiModelAsyncMethodsTest(unittest.TestCase):
     self.assertEqual(mock_call_gemini.call_count, 4)
     self.assertNotIn('Opinion 2', results_df['opinion'].tolist())
 
+  @patch('models.genai_model.GenaiModel._call_gemini')
+  def test_process_prompts_with_parser_executor(
+      self, mock_call_gemini, mock_genai_client
+  ):
+    """Tests that parsing can be moved off the event loop to an executor."""
+    mock_call_gemini.return_value = {
+        'text': 'parsed',
+        'total_token_count': 10,
+        'prompt_token_count': 7,
+        'candidates_token_count': 1,
+        'tool_use_prompt_token_count': 1,
+        'thoughts_token_count': 1,
+        'error': None,
+    }
+
+    model = genai_model.GenaiModel(api_key='test_key', model_name='test_model')
+
+    def simple_parser(resp, job):
+      return f"{resp['text']}_{job['opinion']}"
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+      results_df, stats_df = asyncio.run(
+          model.process_prompts_concurrently(
+              self.prompts,
+              simple_parser,
+              delay_between_calls_seconds=0,
+              parser_executor=executor,
+              max_pending_parses=1,
+          )
+      )
+
+    self.assertEqual(len(results_df), 3)
+    self.assertIn('parsed_Opinion 2', results_df['result'].tolist())
+    self.assertTrue((results_df['parse_time_seconds'] >= 0).all())
+    self.assertIn('parse_time_seconds', stats_df.columns)
+
+  @patch('models.genai_model.GenaiModel._call_gemini')
+  def test_process_prompts_stops_when_token_budget_exhausted(
+      self, mock_call_gemini, mock_genai_client
+  ):
+    """Tests that no more calls are made once the token budget is used up."""
+    mock_call_gemini.return_value = {
+        'text': 'parsed',
+        'total_token_count': 10,
+        'prompt_token_count': 7,
+        'candidates_token_count': 1,
+        'tool_use_prompt_token_count': 1,
+        'thoughts_token_count': 1,
+        'error': None,
+    }
+
+    model = genai_model.GenaiModel(api_key='test_key', model_name='test_model')
+    budget = TokenBudget(max_total_tokens=15)
+    results_df, stats_df = asyncio.run(
+        model.process_prompts_concurrently(
+            self.prompts,
+            lambda resp, j: resp['text'],
+            max_concurrent_calls=1,
+            delay_between_calls_seconds=0,
+            token_budget=budget,
+        )
+    )
+
+    self.assertEqual(len(results_df), 2)
+    self.assertEqual(mock_call_gemini.call_count, 2)
+    self.assertEqual(budget.total_tokens, 20)
+    self.assertTrue(stats_df['stopped_by_token_budget'].any())
+
+  @patch('models.genai_model.GenaiModel._call_gemini')
+  def test_process_prompts_falls_back_when_learned_limit_truncates(
+      self, mock_call_gemini, mock_genai_client
+  ):
+    """Tests that a job cut short by a learned limit is retried without it."""
+    success = {
+        'text': 'parsed',
+        'total_token_count': 10,
+        'prompt_token_count': 7,
+        'candidates_token_count': 2,
+        'tool_use_prompt_token_count': 0,
+        'thoughts_token_count': 0,
+        'error': None,
+    }
+    mock_call_gemini.side_effect = [
+        success,  # Job 1, no limit learned yet
+        {'error': 'MAX_TOKENS', 'finish_message': '', 'token_count': 3},
+        success,  # Job 2, retried without the learned limit
+        success,  # Job 3
+    ]
+
+    limiter = OutputTokenLimiter(percentile=100, headroom=1.0, min_samples=1)
+    model = genai_model.GenaiModel(
+        api_key='test_key',
+        model_name='test_model',
+        output_token_limiter=limiter,
+    )
+    results_df, _ = asyncio.run(
+        model.process_prompts_concurrently(
+            self.prompts,
+            lambda resp, j: resp['text'],
+            max_concurrent_calls=1,
+            retry_attempts=1,
+            delay_between_calls_seconds=0,
+        )
+    )
+
+    self.assertEqual(len(results_df), 3)
+    max_output_tokens = [
+        call.kwargs['max_output_tokens']
+        for call in mock_call_gemini.call_args_list
+    ]
+    # The truncation widened the learned limit for later jobs.
+    self.assertEqual(max_output_tokens, [None, 2, None, 3])
+    self.assertTrue(all(results_df['failed_tries'].apply(lambda d: d.empty)))
+
+  @patch('models.genai_model.GenaiModel._call_gemini')
+  def test_process_prompts_charges_truncated_responses_to_budget(
+      self, mock_call_gemini, mock_genai_client
+  ):
+    """Tests that truncated responses and their fallbacks use up budget."""
+    usage = {
+        'total_token_count': 10,
+        'prompt_token_count': 7,
+        'candidates_token_count': 2,
+        'tool_use_prompt_token_count': 0,
+        'thoughts_token_count': 1,
+    }
+    success = {'text': 'parsed', **usage, 'error': None}
+    truncated = {
+        'error': 'MAX_TOKENS',
+        'finish_message': '',
+        'token_count': 2,
+        **usage,
+    }
+    mock_call_gemini.side_effect = [
+        success,  # Job 1, no limit learned yet
+        truncated,  # Job 2, cut short by the learned limit
+        success,  # Job 2, retried without the learned limit
+        truncated,  # Job 3, cut short by the learned limit
+        truncated,  # Job 3, cut short by its own limit too
+    ]
+
+    model = genai_model.GenaiModel(
+        api_key='test_key',
+        model_name='test_model',
+        output_token_limiter=OutputTokenLimiter(
+            percentile=100, headroom=1.0, min_samples=1
+        ),
+    )
+    budget = TokenBudget(max_total_tokens=1000)
+    asyncio.run(
+        model.process_prompts_concurrently(
+            self.prompts,
+            lambda resp, j: resp['text'],
+            max_concurrent_calls=1,
+            retry_attempts=1,
+            delay_between_calls_seconds=0,
+            token_budget=budget,
+        )
+    )
+
+    self.assertEqual(mock_call_gemini.call_count, 5)
+    self.assertEqual(budget.total_tokens, 50)
+    self.assertEqual(budget.thinking_tokens, 5)
+
+  @patch('models.genai_model.GenaiModel._call_gemini')
+  def test_process_prompts_writes_progress_status_file(
+      self, mock_call_gemini, mock_genai_client
+  ):
+    """Tests that the final progress is written to the status file."""
+    mock_call_gemini.side_effect = [
+        {
+            'text': 'parsed',
+            'total_token_count': 10,
+            'prompt_token_count': 7,
+            'candidates_token_count': 1,
+            'tool_use_prompt_token_count': 1,
+            'thoughts_token_count': 1,
+            'error': None,
+        },
+        Exception('API Error'),
+        Exception('API Error'),
+    ]
+
+    model = genai_model.GenaiModel(api_key='test_key', model_name='test_model')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      status_file = os.path.join(tmp_dir, 'status.json')
+      asyncio.run(
+          model.process_prompts_concurrently(
+              self.prompts,
+              lambda resp, j: resp['text'],
+              max_concurrent_calls=1,
+              retry_attempts=1,
+              delay_between_calls_seconds=0,
+              progress_status_file=status_file,
+          )
+      )
+      with open(status_file) as f:
+        status = json.load(f)
+
+    self.assertEqual(status['completed'], 1)
+    self.assertEqual(status['failed'], 2)
+    self.assertEqual(status['in_flight'], 0)
+    self.assertEqual(status['total_tokens'], 10)
+
   @patch('models.genai_model.GenaiModel._log_retry_summary')
   def test_log_retry_summary(self, mock_log, mock_genai_client):
     """Tests that the retry summary is logged correctly."""
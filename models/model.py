@@ -15,9 +15,11 @@
 """Abstract class to interact with LLMs."""
 
 from abc import ABC, abstractmethod
-from typing import TypeVar
+from typing import List, TypeVar
 from pydantic import BaseModel
 
+from .model_util import DEFAULT_VERTEX_PARALLELISM, gather_tasks_in_parallel
+
 # Generic type variable to use as a schema for LLM response, constrained to Pydantic models inheriting from BaseModel.
 SchemaType = TypeVar("SchemaType", bound=BaseModel)
 # Lists of Pydantic models (can be List[BaseModel] or List[AnyScalarType])
@@ -61,3 +63,51 @@ class Model(ABC):
         The model response parsed as an instance of the schema.
     """
     pass
+
+  async def generate_text_batch(
+      self, prompts: List[str], limit: int = DEFAULT_VERTEX_PARALLELISM
+  ) -> List[str]:
+    """Generates a text response for each of the given prompts.
+
+    This calls generate_text concurrently, with at most `limit` calls in
+    flight.
+
+    Args:
+        prompts: The prompts to process.
+        limit: The maximum number of concurrent calls, if calls are made
+          concurrently.
+
+    Returns:
+        The model responses, in the order of the prompts.
+
+    Raises:
+        The first exception raised for any of the prompts.
+    """
+    return await gather_tasks_in_parallel(prompts, self.generate_text, limit)
+
+  async def generate_data_batch(
+      self,
+      prompts: List[str],
+      schema: type[SchemaType] | type[ListSchemaType],
+      limit: int = DEFAULT_VERTEX_PARALLELISM,
+  ) -> List[SchemaType | ListSchemaType]:
+    """Generates structured data for each of the given prompts.
+
+    This calls generate_data concurrently, with at most `limit` calls in
+    flight.
+
+    Args:
+        prompts: The prompts to process.
+        schema: The schema to parse every response with, see generate_data.
+        limit: The maximum number of concurrent calls, if calls are made
+          concurrently.
+
+    Returns:
+        The parsed model responses, in the order of the prompts.
+
+    Raises:
+        The first exception raised for any of the prompts.
+    """
+    return await gather_tasks_in_parallel(
+        prompts, lambda prompt: self.generate_data(prompt, schema), limit
+    )
@@ -0,0 +1,60 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from typing import List
+import unittest
+
+from models.model import Model
+
+
+class EchoModel(Model):
+  """A model that echoes prompts back, failing on prompts containing 'fail'."""
+
+  def __init__(self):
+    self.max_in_flight = 0
+    self._in_flight = 0
+
+  async def generate_text(self, prompt: str) -> str:
+    self._in_flight += 1
+    self.max_in_flight = max(self.max_in_flight, self._in_flight)
+    await asyncio.sleep(0.01 if prompt == "slow" else 0)
+    self._in_flight -= 1
+    if "fail" in prompt:
+      raise ValueError(prompt)
+    return prompt.upper()
+
+  async def generate_data(self, prompt: str, schema):
+    return [await self.generate_text(prompt)]
+
+
+class ModelBatchTest(unittest.IsolatedAsyncioTestCase):
+
+  async def test_generate_text_batch_keeps_prompt_order(self):
+    model = EchoModel()
+    results = await model.generate_text_batch(["slow", "a", "b", "c"], limit=2)
+    self.assertEqual(results, ["SLOW", "A", "B", "C"])
+    self.assertEqual(model.max_in_flight, 2)
+
+  async def test_generate_data_batch_uses_schema(self):
+    results = await EchoModel().generate_data_batch(["a", "b"], List[str])
+    self.assertEqual(results, [["A"], ["B"]])
+
+  async def test_generate_text_batch_raises_first_error(self):
+    with self.assertRaisesRegex(ValueError, "fail"):
+      await EchoModel().generate_text_batch(["a", "fail", "b"])
+
+
+if __name__ == "__main__":
+  unittest.main()
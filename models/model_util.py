@@ -14,7 +14,33 @@
 
 # Util class for models
 
+import asyncio
+import contextlib
+import functools
+import json
+import logging
 import os
+import random
+import re
+import time
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Iterable,
+    List,
+    NamedTuple,
+    Sequence,
+)
+
+from pydantic import TypeAdapter, ValidationError
+
+try:
+  import orjson
+except ImportError:
+  orjson = None
 
 # The maximum number of times a task should be retried.
 MAX_RETRIES = 10
@@ -22,9 +48,501 @@ MAX_RETRIES = 10
 MAX_LLM_RETRIES = 4
 # How long in seconds to wait between LLM calls.
 RETRY_DELAY_SEC = 10
+# The maximum number of quota or availability errors an LLM call tolerates.
+# These don't count towards MAX_LLM_RETRIES.
+MAX_TRANSIENT_RETRIES = 20
+# The longest a model pauses all of its calls for after such an error.
+MAX_BACKOFF_DELAY_SEC = 120
 
 # Set default vertex parallelism (number of concurrent LLM calls) based on similarly named env var, or use default value
 parallelism_env_var = os.environ.get("DEFAULT_VERTEX_PARALLELISM")
 DEFAULT_VERTEX_PARALLELISM = (
     int(parallelism_env_var) if parallelism_env_var else 1000
 )
+
+# The JSON parser used for structured responses, based on similarly named env
+# var. "pydantic" (the default) parses and validates natively in one pass, and
+# "orjson" parses with orjson, if it's installed, before validating.
+JSON_BACKEND = os.environ.get("MODEL_JSON_BACKEND", "pydantic")
+
+# Prompt for asking the model to fix a response that didn't match its schema.
+REPAIR_PROMPT = """The OUTPUT below was supposed to be JSON matching the SCHEMA below, but it failed validation with the ERROR below.
+Fix the OUTPUT so that it matches the SCHEMA, keeping its content the same.
+Respond with only the fixed JSON.
+
+SCHEMA:
+{schema}
+
+OUTPUT:
+{output}
+
+ERROR:
+{error}
+"""
+# The maximum number of model calls generate_structured_output makes to get
+# output matching the schema, counting both the full prompt and repair prompts.
+MAX_STRUCTURED_OUTPUT_ATTEMPTS = 3
+
+# How many schemas to keep compiled validators for.
+SCHEMA_CACHE_SIZE = 256
+
+# The HTTP status codes of quota and availability errors.
+TRANSIENT_STATUS_CODES = (429, 503)
+
+
+class TokenLimitExceededError(Exception):
+  """Custom exception for when the token limit is exceeded."""
+
+  pass
+
+
+class BackoffGate:
+  """A pause shared by all calls of a model, after quota or availability errors.
+
+  Without it, every concurrent call backs off on its own, and a burst of 429s
+  makes all of them sleep and retry in lockstep. Instead, the first error
+  pauses every call until a shared resume time. The pause follows the server's
+  retry hint if it gives one, and otherwise uses decorrelated jitter:
+  a random delay between the base delay and three times the previous one.
+  Waiting calls are released spread over a short window, not all at once.
+  """
+
+  def __init__(
+      self,
+      base_delay_sec: float = RETRY_DELAY_SEC,
+      max_delay_sec: float = MAX_BACKOFF_DELAY_SEC,
+      release_window_sec: float = 1.0,
+  ):
+    self.base_delay_sec = base_delay_sec
+    self.max_delay_sec = max_delay_sec
+    self.release_window_sec = release_window_sec
+    self._delay = base_delay_sec
+    self._resume_at = 0.0
+
+  def is_paused(self) -> bool:
+    return time.monotonic() < self._resume_at
+
+  async def wait(self):
+    """Waits until the current pause, if any, is over."""
+    while self.is_paused():
+      await asyncio.sleep(
+          self._resume_at
+          - time.monotonic()
+          + random.uniform(0, self.release_window_sec)
+      )
+
+  def pause(self, retry_after_sec: float | None = None):
+    """Pauses all calls after a quota or availability error.
+
+    Errors from calls that were already in flight when the pause started don't
+    extend it, unless the server asks for a longer wait.
+
+    Args:
+      retry_after_sec: How long the server asked clients to wait, if it did.
+    """
+    now = time.monotonic()
+    if retry_after_sec is not None:
+      self._resume_at = max(
+          self._resume_at, now + min(retry_after_sec, self.max_delay_sec)
+      )
+      return
+    if self._resume_at > now:
+      return
+    self._delay = min(
+        self.max_delay_sec,
+        random.uniform(self.base_delay_sec, self._delay * 3),
+    )
+    logging.warning(f"Pausing all model calls for {self._delay:.1f} seconds.")
+    self._resume_at = now + self._delay
+
+  def record_success(self):
+    """Resets the pause length after a successful call."""
+    self._delay = self.base_delay_sec
+
+
+class TaskResult(NamedTuple):
+  """The outcome of running a task on one item."""
+
+  # The position of the item in the input.
+  index: int
+  item: Any
+  # The task's return value, or None if it raised.
+  result: Any
+  # The exception the task raised, or None if it succeeded.
+  error: BaseException | None
+
+
+async def stream_tasks_in_parallel(
+    items: Iterable[Any] | AsyncIterable[Any],
+    func: Callable[[Any], Awaitable[Any]],
+    limit: int = DEFAULT_VERTEX_PARALLELISM,
+    ordered: bool = False,
+    on_progress: Callable[[int, int], None] | None = None,
+) -> AsyncIterator[TaskResult]:
+  """Runs an async function on each item, yielding results as they finish.
+
+  Items are pulled from `items` lazily, so at most `limit` tasks exist at a
+  time and memory use depends on the concurrency rather than on the number of
+  items. Exceptions raised by a task are returned in its TaskResult instead of
+  stopping the other tasks.
+
+  Args:
+    items: The items to process. Can be a generator or an async iterable.
+    func: The async function to call on each item.
+    limit: The maximum number of concurrent tasks.
+    ordered: Whether to yield results in the order of the items, rather than
+      as they complete. In order, finished results wait behind slower earlier
+      items, and count towards `limit` until they are yielded.
+    on_progress: Called with the number of finished and failed tasks each time
+      a task finishes.
+
+  Yields:
+    A TaskResult for each item.
+  """
+  if isinstance(items, AsyncIterable):
+    item_iterator = aiter(items)
+
+    async def next_item() -> tuple[bool, Any]:
+      try:
+        return True, await anext(item_iterator)
+      except StopAsyncIteration:
+        return False, None
+
+  else:
+    sync_iterator = iter(items)
+
+    async def next_item() -> tuple[bool, Any]:
+      try:
+        return True, next(sync_iterator)
+      except StopIteration:
+        return False, None
+
+  async def run(index: int, item: Any) -> TaskResult:
+    try:
+      return TaskResult(index, item, await func(item), None)
+    except Exception as e:
+      return TaskResult(index, item, None, e)
+
+  pending: set[asyncio.Task] = set()
+  # Finished results waiting for earlier items, when yielding in order.
+  buffered: dict[int, TaskResult] = {}
+  next_index = 0
+  next_to_yield = 0
+  num_done = 0
+  num_failed = 0
+  items_left = True
+  try:
+    while True:
+      while items_left and len(pending) + len(buffered) < limit:
+        items_left, item = await next_item()
+        if items_left:
+          pending.add(asyncio.create_task(run(next_index, item)))
+          next_index += 1
+      if not pending:
+        break
+
+      done, pending = await asyncio.wait(
+          pending, return_when=asyncio.FIRST_COMPLETED
+      )
+      for task in sorted(done, key=lambda t: t.result().index):
+        task_result = task.result()
+        num_done += 1
+        if task_result.error is not None:
+          num_failed += 1
+        if on_progress:
+          on_progress(num_done, num_failed)
+        if not ordered:
+          yield task_result
+          continue
+        buffered[task_result.index] = task_result
+        while next_to_yield in buffered:
+          yield buffered.pop(next_to_yield)
+          next_to_yield += 1
+  finally:
+    # Don't leave tasks running if the caller stops iterating early.
+    for task in pending:
+      task.cancel()
+
+
+async def gather_tasks_in_parallel(
+    items: Sequence[Any],
+    func: Callable[[Any], Awaitable[Any]],
+    limit: int = DEFAULT_VERTEX_PARALLELISM,
+) -> list[Any]:
+  """Runs an async function on each item, returning results in item order.
+
+  Results are written into place as tasks finish. This differs from the
+  ordered mode of stream_tasks_in_parallel, where a slow item holds back the
+  pool: here it only occupies its own slot.
+
+  Args:
+    items: The items to process.
+    func: The async function to call on each item.
+    limit: The maximum number of concurrent tasks.
+
+  Returns:
+    The result of func for each item, in the order of the items.
+
+  Raises:
+    The first exception raised by any task. The other tasks are cancelled.
+  """
+  results = [None] * len(items)
+  async with contextlib.aclosing(
+      stream_tasks_in_parallel(items, func, limit)
+  ) as task_results:
+    async for task_result in task_results:
+      if task_result.error is not None:
+        raise task_result.error
+      results[task_result.index] = task_result.result
+  return results
+
+
+class CompiledSchema(NamedTuple):
+  """A schema's validator and serialized JSON schema, built once."""
+
+  adapter: TypeAdapter
+  # The JSON schema, serialized for use in prompts.
+  json_schema: str
+
+
+@functools.lru_cache(maxsize=SCHEMA_CACHE_SIZE)
+def _compile_schema(schema: Any) -> CompiledSchema:
+  adapter = TypeAdapter(schema)
+  return CompiledSchema(adapter, json.dumps(adapter.json_schema()))
+
+
+def get_compiled_schema(schema: Any) -> CompiledSchema:
+  """Returns the compiled validator and JSON schema for a schema.
+
+  These are cached per schema, as building them costs more than validating a
+  typical response.
+  """
+  try:
+    hash(schema)
+  except TypeError:
+    return _compile_schema.__wrapped__(schema)
+  return _compile_schema(schema)
+
+
+def _find_json_span(text: str) -> tuple[int, int]:
+  """Returns the start and end indices of the JSON payload in a response.
+
+  The payload runs from the first '{' or '[' to the last '}' or ']', which
+  skips markdown code fences and any text around the payload. Without
+  brackets, only a leading ```json and trailing ``` fence are skipped.
+  """
+  starts = [i for i in (text.find("{"), text.find("[")) if i != -1]
+  if starts:
+    start = min(starts)
+    end = max(text.rfind("}"), text.rfind("]")) + 1
+    if end > start:
+      return start, end
+  start = 7 if text.startswith("```json") else 0
+  end = len(text) - 3 if text.endswith("```") else len(text)
+  return start, max(start, end)
+
+
+def _validate_json(json_text: str, schema: Any) -> Any:
+  """Parses JSON text and validates it against the schema."""
+  # The schema argument itself is the type hint, e.g. Topic or List[Topic]
+  adapter = get_compiled_schema(schema).adapter
+  if JSON_BACKEND == "orjson" and orjson is not None:
+    return adapter.validate_python(orjson.loads(json_text))
+  # Pydantic parses and validates the JSON natively in a single pass.
+  return adapter.validate_json(json_text)
+
+
+def parse_structured_response(response_text: str, schema: Any) -> Any:
+  """Extracts the JSON payload from a model response and validates it.
+
+  Args:
+    response_text: The model response.
+    schema: The Pydantic model (or a list of Pydantic models/scalars) the
+      payload should match.
+
+  Returns:
+    The payload parsed as an instance of the schema.
+
+  Raises:
+    ValueError: If the payload is not valid JSON or doesn't match the schema.
+  """
+  json_text = response_text.strip()
+  try:
+    # Constrained decoding returns bare JSON, so the whole response usually
+    # validates as is. Searching it for brackets first would pick out ones
+    # embedded in a scalar, e.g. the "[1]" in '"hello [1]"'.
+    return _validate_json(json_text, schema)
+  except (ValidationError, ValueError):
+    start, end = _find_json_span(json_text)
+    json_text = json_text[start:end]
+
+  try:
+    return _validate_json(json_text, schema)
+
+  except ValidationError as e:  # Catches Pydantic validation errors
+    logging.debug(
+        f"Model response failed Pydantic validation for schema {schema}:"
+        f" {json_text}.\nError: {e}"
+    )
+    raise ValueError(f"Model response failed Pydantic validation") from e
+  except (
+      json.JSONDecodeError
+  ) as e:  # Catches errors if json_text is not valid JSON
+    logging.debug(f"Model returned invalid JSON: {json_text}.")
+    raise ValueError(f"Model returned invalid JSON") from e
+  except Exception as e:  # Catches any other unexpected errors during parsing
+    logging.error(
+        f"Failed to parse or validate model response against schema {schema}:"
+        f" {json_text}.\nError: {e}"
+    )
+    raise ValueError(
+        f"Failed to parse or validate model response: {json_text}."
+    ) from e
+
+
+async def generate_structured_output(
+    call_llm: Callable[[str], Awaitable[str]],
+    prompt: str,
+    schema: Any,
+    repair_invalid_output: bool = True,
+) -> Any:
+  """Calls the model until its response matches the schema.
+
+  Decoding is greedy, so sending a prompt again would mostly return the same
+  invalid output. Instead, invalid output is sent back to the model with
+  REPAIR_PROMPT to be fixed, which is much cheaper than resending a prompt
+  that can contain thousands of comments. No prompt is sent twice, and at most
+  MAX_STRUCTURED_OUTPUT_ATTEMPTS calls are made.
+
+  Args:
+    call_llm: Sends a prompt to the model and returns the response text.
+    prompt: The prompt to send first.
+    schema: The Pydantic model (or a list of Pydantic models/scalars) the
+      response should match.
+    repair_invalid_output: Whether invalid output is sent back to be fixed.
+      Otherwise the prompt is only sent once.
+
+  Returns:
+    The response parsed as an instance of the schema.
+
+  Raises:
+    ValueError: If no response matched the schema.
+  """
+  compiled_schema = get_compiled_schema(schema)
+  sent_prompts = set()
+  next_prompt = prompt
+  for attempt in range(1, MAX_STRUCTURED_OUTPUT_ATTEMPTS + 1):
+    sent_prompts.add(next_prompt)
+    response_text = await call_llm(next_prompt)
+    try:
+      return parse_structured_response(response_text, schema)
+    except ValueError as e:
+      error = e
+    logging.error(f"Attempt {attempt} returned invalid output: {error}")
+
+    if not repair_invalid_output:
+      break
+    next_prompt = REPAIR_PROMPT.format(
+        schema=compiled_schema.json_schema,
+        output=response_text,
+        error=error.__cause__ or error,
+    )
+    if next_prompt in sent_prompts:
+      break
+
+  raise error
+
+
+def _is_transient_error(error: Exception) -> bool:
+  """Whether the error is a quota (429) or availability (503) error.
+
+  Errors are classified by their type or HTTP status code only, since their
+  messages can contain those numbers for unrelated reasons.
+  """
+  # google.api_core and google.genai errors have the HTTP status as `code`,
+  # and httpx and requests errors have it on their response.
+  status_code = getattr(error, "code", None)
+  response = getattr(error, "response", None)
+  if not isinstance(status_code, int) and response is not None:
+    status_code = getattr(response, "status_code", None)
+  return status_code in TRANSIENT_STATUS_CODES
+
+
+def _get_retry_hint_sec(error: Exception) -> float | None:
+  """Returns how long the server asked to wait before retrying, if it did."""
+  match = re.search(
+      r"retry(?:Delay)?[\"']?\s*(?:in|:)?\s*[\"']?(\d+(?:\.\d+)?)s",
+      str(error),
+      re.IGNORECASE,
+  )
+  return float(match.group(1)) if match else None
+
+
+async def retry_call(
+    func: Callable[..., Any],  # The async function to call
+    validator: Callable[[Any], bool],  # A function to validate the response
+    max_retries: int,
+    error_message: str,
+    retry_delay_sec: float,
+    func_args: List[Any] | None = None,
+    validator_args: List[Any] | None = None,
+    backoff_gate: BackoffGate | None = None,
+    max_transient_retries: int = MAX_TRANSIENT_RETRIES,
+):
+  """Calls func until the validator accepts its response.
+
+  With a backoff gate, quota and availability errors pause all calls sharing
+  the gate instead of backing off independently, and don't count towards
+  `max_retries` (only towards `max_transient_retries`).
+  """
+  func_args = func_args or []
+  validator_args = validator_args or []
+  backoff_growth_rate = 2.5  # Controls how quickly delay increases b/w retries
+  transient_errors = 0
+
+  attempt = 1
+  while attempt <= max_retries:
+    if backoff_gate is not None:
+      await backoff_gate.wait()
+    try:
+      response = await func(*func_args)
+
+      if validator(response, *validator_args):
+        if backoff_gate is not None:
+          backoff_gate.record_success()
+        return response
+
+      logging.error(f"Attempt {attempt} failed. Invalid response: {response}")
+    except Exception as error:
+      # catch input tokens limit error in case our check for prompt length was not enough
+      if "exceeds the maximum number of tokens allowed" in str(error):
+        raise TokenLimitExceededError(error) from error
+      if isinstance(error, TokenLimitExceededError):
+        raise  # Re-raise the proactively caught token limit error
+      error_message = str(error)
+      # Don't pollute the logs with the long 429 error messages
+      # Extract the relevant part of the error message
+      match = re.search(r"429 Resource exhausted.*", error_message)
+      if match:
+        error_message = match.group(0).split(".")[0]
+
+      if backoff_gate is not None and _is_transient_error(error):
+        transient_errors += 1
+        if transient_errors > max_transient_retries:
+          raise Exception(
+              f"Failed after {transient_errors} quota or availability errors:"
+              f" {error_message}"
+          ) from error
+        logging.warning(f"Transient error, waiting to retry: {error_message}")
+        backoff_gate.pause(_get_retry_hint_sec(error))
+        continue
+
+      logging.error(f"Attempt {attempt} failed: {error_message}")
+
+    # Exponential backoff calculation
+    delay = retry_delay_sec * (backoff_growth_rate ** (attempt - 1))
+    logging.info(f"Retrying in {int(delay)} seconds (attempt {attempt})")
+    await asyncio.sleep(delay)
+    attempt += 1
+
+  raise Exception(f"Failed after {max_retries} attempts: {error_message}")
@@ -0,0 +1,330 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+from typing import List, Optional
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from google.api_core import exceptions as google_exceptions
+import httpx
+from pydantic import BaseModel
+from models import model_util, vertex_model
+from models.model_util import gather_tasks_in_parallel, stream_tasks_in_parallel
+
+
+class Subtopic(BaseModel):
+  name: str
+  count: Optional[int] = None
+
+
+class Topic(BaseModel):
+  name: str
+  subtopics: List[Subtopic]
+
+
+async def collect(results):
+  return [result async for result in results]
+
+
+class StreamTasksInParallelTest(unittest.IsolatedAsyncioTestCase):
+
+  async def test_ordered_results(self):
+    async def slow_for_small_items(item):
+      await asyncio.sleep(0.01 * (5 - item))
+      return item * 2
+
+    results = await collect(
+        stream_tasks_in_parallel(
+            range(5), slow_for_small_items, limit=5, ordered=True
+        )
+    )
+
+    self.assertEqual([r.index for r in results], [0, 1, 2, 3, 4])
+    self.assertEqual([r.result for r in results], [0, 2, 4, 6, 8])
+
+  async def test_unordered_results_as_completed(self):
+    async def slow_for_small_items(item):
+      await asyncio.sleep(0.01 * (3 - item))
+      return item
+
+    results = await collect(
+        stream_tasks_in_parallel(range(3), slow_for_small_items, limit=3)
+    )
+
+    self.assertEqual([r.result for r in results], [2, 1, 0])
+
+  async def test_errors_are_collected_per_item(self):
+    async def fail_on_odd_items(item):
+      if item % 2:
+        raise ValueError(f"bad item {item}")
+      return item
+
+    progress = []
+    results = await collect(
+        stream_tasks_in_parallel(
+            range(4),
+            fail_on_odd_items,
+            limit=2,
+            ordered=True,
+            on_progress=lambda done, failed: progress.append((done, failed)),
+        )
+    )
+
+    self.assertEqual([r.result for r in results], [0, None, 2, None])
+    self.assertIsInstance(results[1].error, ValueError)
+    self.assertEqual(progress[-1], (4, 2))
+
+  async def test_items_pulled_lazily_within_limit(self):
+    pulled = []
+    running = 0
+    max_running = 0
+
+    def items():
+      for i in range(10):
+        pulled.append(i)
+        yield i
+
+    async def track_concurrency(item):
+      nonlocal running, max_running
+      running += 1
+      max_running = max(max_running, running)
+      await asyncio.sleep(0)
+      running -= 1
+      return item
+
+    results = stream_tasks_in_parallel(items(), track_concurrency, limit=3)
+    first = await anext(results)
+    await results.aclose()
+
+    self.assertEqual(first.index, 0)
+    self.assertLessEqual(len(pulled), 4)
+    self.assertLessEqual(max_running, 3)
+
+  async def test_async_iterable_items(self):
+    async def items():
+      for i in range(3):
+        yield i
+
+    async def double(item):
+      return item * 2
+
+    results = await collect(
+        stream_tasks_in_parallel(items(), double, ordered=True)
+    )
+
+    self.assertEqual([r.result for r in results], [0, 2, 4])
+
+  async def test_run_tasks_in_parallel_raises_first_error(self):
+    async def fail_on_item_one(item, offset):
+      if item == 1:
+        raise ValueError("bad item")
+      return item + offset
+
+    results = await vertex_model.run_tasks_in_parallel(
+        [2, 0], fail_on_item_one, 2, 10
+    )
+    self.assertEqual(results, [12, 10])
+    with self.assertRaises(ValueError):
+      await vertex_model.run_tasks_in_parallel(
+          [0, 1, 2], fail_on_item_one, 2, 10
+      )
+
+
+class GatherTasksInParallelTest(unittest.IsolatedAsyncioTestCase):
+
+  async def test_slow_item_does_not_block_others(self):
+    others_done = asyncio.Event()
+    finished = []
+
+    async def wait_for_others_on_first_item(item):
+      if item == 0:
+        # With the slots held by finished results, this would never be set.
+        await others_done.wait()
+      finished.append(item)
+      if len(finished) == 9:
+        others_done.set()
+      return item * 2
+
+    results = await asyncio.wait_for(
+        gather_tasks_in_parallel(
+            list(range(10)), wait_for_others_on_first_item, limit=2
+        ),
+        timeout=5,
+    )
+
+    self.assertEqual(results, [item * 2 for item in range(10)])
+    self.assertEqual(finished[-1], 0)
+
+  async def test_raises_first_error(self):
+    async def fail_on_item_two(item):
+      if item == 2:
+        raise ValueError("bad item")
+      return item
+
+    with self.assertRaisesRegex(ValueError, "bad item"):
+      await gather_tasks_in_parallel(list(range(5)), fail_on_item_two, limit=2)
+
+
+class StructuredResponseTest(unittest.TestCase):
+
+  def test_find_json_span(self):
+    text = 'Here you go:\n```json\n{"a": [1]}\n```'
+    start, end = model_util._find_json_span(text)
+    self.assertEqual(text[start:end], '{"a": [1]}')
+
+    self.assertEqual(model_util._find_json_span("[1, 2]"), (0, 6))
+    text = '```json"scalar"```'
+    start, end = model_util._find_json_span(text)
+    self.assertEqual(text[start:end], '"scalar"')
+
+  def test_parse_structured_response(self):
+    result = model_util.parse_structured_response(
+        'Sure!\n```json\n{"name": "a", "subtopics": []}\n```', Topic
+    )
+    self.assertEqual(result, Topic(name="a", subtopics=[]))
+
+    with self.assertRaises(ValueError):
+      model_util.parse_structured_response('{"name": "a"}', Topic)
+    with self.assertRaises(ValueError):
+      model_util.parse_structured_response('{"name": ', Topic)
+
+  def test_parse_structured_response_scalar_with_brackets(self):
+    self.assertEqual(
+        model_util.parse_structured_response('"hello [1]"', str),
+        "hello [1]",
+    )
+    self.assertEqual(
+        model_util.parse_structured_response(' "{a} or [b]"\n', str),
+        "{a} or [b]",
+    )
+
+  @patch.object(model_util, "JSON_BACKEND", "orjson")
+  def test_parse_structured_response_orjson_backend(self):
+    result = model_util.parse_structured_response(
+        '[{"name": "a", "count": 2}]', List[Subtopic]
+    )
+    self.assertEqual(result, [Subtopic(name="a", count=2)])
+
+    with self.assertRaises(ValueError):
+      model_util.parse_structured_response("[{]", List[Subtopic])
+
+  def test_compiled_schemas_are_cached(self):
+    self.assertIs(
+        model_util.get_compiled_schema(List[Topic]),
+        model_util.get_compiled_schema(List[Topic]),
+    )
+
+
+class RetryCallTest(unittest.IsolatedAsyncioTestCase):
+
+  async def test_retry_call_transient_errors_do_not_use_attempts(self):
+    mock_func = AsyncMock()
+    mock_func.side_effect = [
+        google_exceptions.ResourceExhausted("429 Resource exhausted."),
+        google_exceptions.ServiceUnavailable("503 Service Unavailable"),
+        "response",
+    ]
+    gate = model_util.BackoffGate(
+        base_delay_sec=0.01, release_window_sec=0
+    )
+
+    result = await model_util.retry_call(
+        mock_func, lambda x: True, 1, "error", 1, backoff_gate=gate
+    )
+
+    self.assertEqual(result, "response")
+    self.assertEqual(mock_func.call_count, 3)
+    self.assertEqual(gate._delay, gate.base_delay_sec)
+
+  async def test_retry_call_transient_errors_are_capped(self):
+    mock_func = AsyncMock()
+    mock_func.side_effect = google_exceptions.ResourceExhausted("429")
+    gate = MagicMock(spec=model_util.BackoffGate)
+
+    with self.assertRaises(Exception) as context:
+      await model_util.retry_call(
+          mock_func,
+          lambda x: True,
+          3,
+          "error",
+          1,
+          backoff_gate=gate,
+          max_transient_retries=2,
+      )
+
+    self.assertIn("quota or availability errors", str(context.exception))
+    self.assertEqual(mock_func.call_count, 3)
+    self.assertEqual(gate.pause.call_count, 2)
+
+  def test_is_transient_error(self):
+    self.assertTrue(
+        model_util._is_transient_error(
+            google_exceptions.ResourceExhausted("Resource exhausted.")
+        )
+    )
+    request = httpx.Request("POST", "http://localhost")
+    response = httpx.Response(429, request=request)
+    self.assertTrue(
+        model_util._is_transient_error(
+            httpx.HTTPStatusError("", request=request, response=response)
+        )
+    )
+    # Status codes that only appear in the message don't count.
+    self.assertFalse(
+        model_util._is_transient_error(
+            ValueError("Prompt has 429 tokens, request id 503")
+        )
+    )
+    self.assertFalse(
+        model_util._is_transient_error(
+            google_exceptions.InvalidArgument("429 Resource exhausted")
+        )
+    )
+
+  def test_get_retry_hint_sec(self):
+    self.assertEqual(
+        model_util._get_retry_hint_sec(
+            Exception("429 Quota exceeded. Please retry in 18.5s.")
+        ),
+        18.5,
+    )
+    self.assertEqual(
+        model_util._get_retry_hint_sec(Exception("{'retryDelay': '7s'}")), 7
+    )
+    self.assertIsNone(model_util._get_retry_hint_sec(Exception("429")))
+
+  @patch("time.monotonic")
+  def test_backoff_gate_pause(self, mock_monotonic):
+    mock_monotonic.return_value = 100
+    gate = model_util.BackoffGate(base_delay_sec=1, max_delay_sec=30)
+
+    gate.pause()
+    self.assertTrue(gate.is_paused())
+    first_delay = gate._delay
+    self.assertGreaterEqual(first_delay, 1)
+    self.assertLessEqual(first_delay, 3)
+
+    # Errors during a pause don't extend it, unless the server asks for longer.
+    gate.pause()
+    self.assertEqual(gate._resume_at, 100 + first_delay)
+    gate.pause(retry_after_sec=60)
+    self.assertEqual(gate._resume_at, 130)
+
+    mock_monotonic.return_value = 131
+    self.assertFalse(gate.is_paused())
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,223 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A Model for local servers with an OpenAI-compatible chat completions API, such
+as the llama.cpp server, LM Studio or vLLM.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, Type
+import httpx
+
+from .model import Model, SchemaType, ListSchemaType
+from .model_util import (
+    MAX_LLM_RETRIES,
+    BackoffGate,
+    TokenLimitExceededError,
+    generate_structured_output,
+    get_compiled_schema,
+    retry_call,
+)
+
+# The default server URL, based on similarly named env var. This is LM Studio's
+# default, llama.cpp and vLLM serve on ports 8080 and 8000 by default.
+DEFAULT_BASE_URL = os.environ.get(
+    "OPENAI_COMPATIBLE_BASE_URL", "http://127.0.0.1:1234/v1"
+)
+# The default number of concurrent requests. Local servers usually process a
+# few requests in parallel at most, and queue the rest.
+DEFAULT_MAX_CONCURRENT_CALLS = 4
+# The default maximum number of tokens to generate per response.
+DEFAULT_MAX_TOKENS = 4096
+# How long in seconds to wait for a response. Local models can be slow on long
+# prompts, so this is generous.
+DEFAULT_TIMEOUT_SEC = 600
+# How long in seconds idle keep-alive connections are kept open.
+KEEPALIVE_EXPIRY_SEC = 60
+# How long in seconds to wait between retries. Local servers fail fast, so
+# there's no need to wait as long as for hosted APIs.
+RETRY_DELAY_SEC = 1
+# Phrases servers use in errors about prompts that don't fit the context.
+CONTEXT_LENGTH_ERRORS = (
+    "context length",
+    "context size",
+    "context window",
+    "maximum context",
+)
+
+
+class OpenAICompatibleModel(Model):
+  """A Model that calls an OpenAI-compatible chat completions endpoint.
+
+  Requests share a pool of keep-alive connections, and at most
+  `max_concurrent_calls` are in flight at a time. Structured output is
+  constrained to the schema with a `json_schema` response format, which
+  servers without support for it ignore; responses are validated either way.
+  """
+
+  def __init__(
+      self,
+      model_name: str,
+      base_url: str = DEFAULT_BASE_URL,
+      api_key: str | None = None,
+      max_concurrent_calls: int = DEFAULT_MAX_CONCURRENT_CALLS,
+      max_tokens: int = DEFAULT_MAX_TOKENS,
+      timeout_seconds: float = DEFAULT_TIMEOUT_SEC,
+      transport: httpx.AsyncBaseTransport | None = None,
+      repair_invalid_output: bool = True,
+  ):
+    """Initializes the OpenAICompatibleModel.
+
+    Args:
+      model_name: The name of the model, as known to the server.
+      base_url: The server's API base URL, up to and including e.g. "/v1".
+      api_key: The API key to send, if the server needs one. If not provided,
+        the OPENAI_COMPATIBLE_API_KEY environment variable will be used.
+      max_concurrent_calls: The maximum number of requests in flight.
+      max_tokens: The maximum number of tokens to generate per response.
+      timeout_seconds: How long to wait for each response.
+      transport: The httpx transport to use, e.g. for tests.
+      repair_invalid_output: Whether invalid structured output is sent back
+        to the model to be fixed. Otherwise the full prompt is only sent once.
+    """
+    self.model_name = model_name
+    self.repair_invalid_output = repair_invalid_output
+    self.max_tokens = max_tokens
+    api_key = api_key or os.getenv("OPENAI_COMPATIBLE_API_KEY")
+    headers = {"Authorization": f"Bearer {api_key}"} if api_key else {}
+    self.client = httpx.AsyncClient(
+        base_url=base_url.rstrip("/"),
+        headers=headers,
+        timeout=timeout_seconds,
+        limits=httpx.Limits(
+            max_connections=max_concurrent_calls,
+            max_keepalive_connections=max_concurrent_calls,
+            keepalive_expiry=KEEPALIVE_EXPIRY_SEC,
+        ),
+        transport=transport,
+    )
+    self.semaphore = asyncio.Semaphore(max_concurrent_calls)
+    # Shared by all calls, so overload errors pause them together.
+    self.backoff_gate = BackoffGate(base_delay_sec=RETRY_DELAY_SEC)
+
+  async def close(self):
+    """Closes the pooled connections."""
+    await self.client.aclose()
+
+  async def generate_text(self, prompt: str) -> str:
+    return await self._call_llm_with_retry(prompt)
+
+  async def generate_data(
+      self, prompt: str, schema: Type[SchemaType] | Type[ListSchemaType]
+  ) -> SchemaType | ListSchemaType:
+    response_format = {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "response",
+            "strict": True,
+            "schema": to_strict_json_schema(
+                json.loads(get_compiled_schema(schema).json_schema)
+            ),
+        },
+    }
+
+    return await generate_structured_output(
+        lambda next_prompt: self._call_llm_with_retry(
+            next_prompt, response_format
+        ),
+        prompt,
+        schema,
+        self.repair_invalid_output,
+    )
+
+  async def _call_llm_with_retry(
+      self, prompt: str, response_format: Dict[str, Any] | None = None
+  ) -> str:
+    def is_valid(response_text: str) -> bool:
+      return bool(response_text)
+
+    return await retry_call(
+        self._call_llm,
+        is_valid,
+        MAX_LLM_RETRIES,
+        "Failed to get a valid model response.",
+        RETRY_DELAY_SEC,
+        func_args=[prompt, response_format],
+        backoff_gate=self.backoff_gate,
+    )
+
+  async def _call_llm(
+      self, prompt: str, response_format: Dict[str, Any] | None
+  ) -> str:
+    """Makes one chat completions request and returns the response text."""
+    request = {
+        "model": self.model_name,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": 0,
+        "max_tokens": self.max_tokens,
+    }
+    if response_format is not None:
+      request["response_format"] = response_format
+
+    async with self.semaphore:
+      response = await self.client.post("/chat/completions", json=request)
+    if response.status_code == 400 and any(
+        phrase in response.text.lower() for phrase in CONTEXT_LENGTH_ERRORS
+    ):
+      raise TokenLimitExceededError(response.text)
+    response.raise_for_status()
+
+    choices = response.json().get("choices") or []
+    if not choices:
+      logging.error(f"Model response has no choices: {response.text}")
+      return ""
+    return (choices[0].get("message") or {}).get("content") or ""
+
+
+def to_strict_json_schema(json_schema: Any) -> Any:
+  """Makes a JSON schema acceptable to servers' strict `json_schema` mode.
+
+  Strict mode rejects object schemas that allow additional properties or leave
+  properties out of `required`, which Pydantic does for fields with defaults.
+  Such fields are made required, so the model always generates them.
+
+  Args:
+    json_schema: The JSON schema, or a part of it.
+
+  Returns:
+    A copy of the schema with every object schema, including those in `$defs`,
+    closed to additional properties and requiring all of its properties.
+  """
+  if isinstance(json_schema, list):
+    return [to_strict_json_schema(value) for value in json_schema]
+  if not isinstance(json_schema, dict):
+    return json_schema
+  strict_schema = {}
+  for key, value in json_schema.items():
+    if key in ("properties", "$defs"):
+      # These map names to schemas, so the names mustn't be taken for keywords.
+      strict_schema[key] = {
+          name: to_strict_json_schema(subschema)
+          for name, subschema in value.items()
+      }
+    else:
+      strict_schema[key] = to_strict_json_schema(value)
+  if "properties" in strict_schema:
+    strict_schema["additionalProperties"] = False
+    strict_schema["required"] = list(strict_schema["properties"])
+  return strict_schema
@@ -0,0 +1,155 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+from typing import List
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import httpx
+from pydantic import BaseModel
+from models.model_util import TokenLimitExceededError
+from models.openai_compatible_model import (
+    OpenAICompatibleModel,
+    to_strict_json_schema,
+)
+
+
+class Topic(BaseModel):
+  name: str
+
+
+def completion(content: str) -> httpx.Response:
+  return httpx.Response(
+      200, json={"choices": [{"message": {"content": content}}]}
+  )
+
+
+def make_model(handler, **kwargs) -> OpenAICompatibleModel:
+  return OpenAICompatibleModel(
+      "local-model",
+      base_url="http://localhost:8080/v1/",
+      transport=httpx.MockTransport(handler),
+      **kwargs,
+  )
+
+
+class OpenAICompatibleModelTest(unittest.IsolatedAsyncioTestCase):
+
+  async def test_generate_text(self):
+    requests = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+      requests.append(request)
+      return completion("hello")
+
+    model = make_model(handler, api_key="secret")
+    self.assertEqual(await model.generate_text("hi"), "hello")
+    await model.close()
+
+    request = requests[0]
+    self.assertEqual(
+        str(request.url), "http://localhost:8080/v1/chat/completions"
+    )
+    self.assertEqual(request.headers["Authorization"], "Bearer secret")
+    body = json.loads(request.content)
+    self.assertEqual(body["model"], "local-model")
+    self.assertEqual(body["messages"], [{"role": "user", "content": "hi"}])
+    self.assertNotIn("response_format", body)
+
+  async def test_generate_data_sends_json_schema(self):
+    bodies = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+      bodies.append(json.loads(request.content))
+      return completion('[{"name": "Housing"}]')
+
+    model = make_model(handler)
+    result = await model.generate_data("topics?", List[Topic])
+
+    self.assertEqual(result, [Topic(name="Housing")])
+    response_format = bodies[0]["response_format"]
+    self.assertEqual(response_format["type"], "json_schema")
+    self.assertEqual(response_format["json_schema"]["schema"]["type"], "array")
+
+  def test_to_strict_json_schema(self):
+    class Theme(BaseModel):
+      title: str
+      # A field named like a JSON schema keyword.
+      properties: List[str] = []
+
+    class Summary(BaseModel):
+      themes: List[Theme]
+      note: str | None = None
+
+    strict_schema = to_strict_json_schema(Summary.model_json_schema())
+
+    self.assertFalse(strict_schema["additionalProperties"])
+    self.assertEqual(strict_schema["required"], ["themes", "note"])
+    theme_schema = strict_schema["$defs"]["Theme"]
+    self.assertFalse(theme_schema["additionalProperties"])
+    self.assertEqual(theme_schema["required"], ["title", "properties"])
+    self.assertEqual(
+        theme_schema["properties"]["properties"],
+        Theme.model_json_schema()["properties"]["properties"],
+    )
+
+  async def test_generate_data_repairs_invalid_output(self):
+    responses = iter(["not json", '{"name": "Housing"}'])
+    prompts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+      prompts.append(json.loads(request.content)["messages"][0]["content"])
+      return completion(next(responses))
+
+    model = make_model(handler)
+    self.assertEqual(
+        await model.generate_data("topic?", Topic), Topic(name="Housing")
+    )
+    # The invalid output is sent back to be fixed, instead of the full prompt.
+    self.assertEqual(prompts[0], "topic?")
+    self.assertIn("not json", prompts[1])
+
+  async def test_generate_data_does_not_resend_identical_prompts(self):
+    prompts = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+      prompts.append(json.loads(request.content)["messages"][0]["content"])
+      return completion("not json")
+
+    model = make_model(handler)
+    with self.assertRaises(ValueError):
+      await model.generate_data("topic?", Topic)
+    # The second repair prompt would be the same as the first.
+    self.assertEqual(len(prompts), 2)
+
+  @patch("asyncio.sleep", new_callable=AsyncMock)
+  async def test_retries_server_errors(self, mock_sleep):
+    responses = iter([httpx.Response(500), completion("ok")])
+    model = make_model(lambda request: next(responses))
+    self.assertEqual(await model.generate_text("hi"), "ok")
+    mock_sleep.assert_awaited_once()
+
+  async def test_context_length_error_raises_token_limit_error(self):
+    model = make_model(
+        lambda request: httpx.Response(
+            400, text="the request exceeds the available context size"
+        )
+    )
+    with self.assertRaises(TokenLimitExceededError):
+      await model.generate_text("a very long prompt")
+
+
+if __name__ == "__main__":
+  unittest.main()
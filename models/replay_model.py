@@ -0,0 +1,156 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A Model that records another model's responses, and replays them offline.
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Type
+
+from .model import Model, SchemaType, ListSchemaType
+from .model_util import get_compiled_schema
+
+# Calls the wrapped model and saves its responses to the cassette.
+RECORD = "record"
+# Serves responses from the cassette without calling any model.
+REPLAY = "replay"
+
+
+class CassetteMissError(Exception):
+  """Raised when replaying a request that isn't in the cassette."""
+
+
+def _request_key(
+    method: str,
+    prompt: str,
+    schema: Type[SchemaType] | Type[ListSchemaType] | None = None,
+) -> str:
+  """Returns the cassette key for a request."""
+  schema_json = get_compiled_schema(schema).json_schema if schema else None
+  request = json.dumps([method, prompt, schema_json])
+  return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+class ReplayModel(Model):
+  """Records a model's responses to a cassette file, or replays them.
+
+  The cassette is a JSONL file with one line per request, holding a hash of
+  the request (the method, prompt and schema), the response and how long the
+  response took. Prompts aren't stored, which keeps cassettes small. In record
+  mode every request is sent to the wrapped model and appended to the
+  cassette, replacing any earlier response to the same request. In replay
+  mode responses are served from the cassette, immediately or after their
+  recorded latency.
+
+  Only Model subclasses can be wrapped. GenaiModel isn't one, so its
+  process_prompts_concurrently and batch calls can't be recorded.
+  """
+
+  def __init__(
+      self,
+      cassette_path: str,
+      mode: str = REPLAY,
+      model: Model | None = None,
+      replay_latency: bool = False,
+  ):
+    """Initializes the ReplayModel.
+
+    Args:
+      cassette_path: The path of the cassette file.
+      mode: RECORD or REPLAY.
+      model: The model to record. Required in record mode.
+      replay_latency: Whether replayed responses wait for as long as the
+        recorded ones took.
+    """
+    if mode not in (RECORD, REPLAY):
+      raise ValueError(
+          f"Unknown mode '{mode}', expected '{RECORD}' or '{REPLAY}'."
+      )
+    if mode == RECORD and model is None:
+      raise ValueError("A model to record is required in record mode.")
+    if model is not None:
+      self.categorization_batch_size = model.categorization_batch_size
+    self.cassette_path = cassette_path
+    self.mode = mode
+    self.model = model
+    self.replay_latency = replay_latency
+    self.entries: Dict[str, Dict[str, Any]] = self._load_cassette()
+    logging.info(
+        f"Loaded {len(self.entries)} recorded responses from {cassette_path}."
+    )
+
+  def _load_cassette(self) -> Dict[str, Dict[str, Any]]:
+    entries = {}
+    if not os.path.exists(self.cassette_path):
+      if self.mode == REPLAY:
+        raise FileNotFoundError(f"Cassette {self.cassette_path} not found.")
+      return entries
+    with open(self.cassette_path, encoding="utf-8") as f:
+      for line in f:
+        if line.strip():
+          entry = json.loads(line)
+          entries[entry["key"]] = entry
+    return entries
+
+  def _save_entry(self, entry: Dict[str, Any]):
+    self.entries[entry["key"]] = entry
+    with open(self.cassette_path, "a", encoding="utf-8") as f:
+      f.write(json.dumps(entry) + "\n")
+
+  async def _replay(self, key: str) -> Any:
+    entry = self.entries.get(key)
+    if entry is None:
+      raise CassetteMissError(
+          f"No recorded response for request {key} in {self.cassette_path}."
+      )
+    if self.replay_latency:
+      await asyncio.sleep(entry["latency_sec"])
+    return entry["response"]
+
+  async def generate_text(self, prompt: str) -> str:
+    key = _request_key("generate_text", prompt)
+    if self.mode == REPLAY:
+      return await self._replay(key)
+
+    start_time = time.monotonic()
+    response = await self.model.generate_text(prompt)
+    self._save_entry({
+        "key": key,
+        "latency_sec": time.monotonic() - start_time,
+        "response": response,
+    })
+    return response
+
+  async def generate_data(
+      self, prompt: str, schema: Type[SchemaType] | Type[ListSchemaType]
+  ) -> SchemaType | ListSchemaType:
+    key = _request_key("generate_data", prompt, schema)
+    adapter = get_compiled_schema(schema).adapter
+    if self.mode == REPLAY:
+      return adapter.validate_python(await self._replay(key))
+
+    start_time = time.monotonic()
+    response = await self.model.generate_data(prompt, schema)
+    self._save_entry({
+        "key": key,
+        "latency_sec": time.monotonic() - start_time,
+        "response": adapter.dump_python(response, mode="json"),
+    })
+    return response
@@ -0,0 +1,110 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+from typing import List
+import unittest
+from unittest.mock import AsyncMock, MagicMock, patch
+
+from pydantic import BaseModel
+from models import replay_model
+from models.replay_model import CassetteMissError, ReplayModel
+
+
+class Topic(BaseModel):
+  name: str
+
+
+def make_recorded_model() -> MagicMock:
+  model = MagicMock()
+  model.categorization_batch_size = 50
+  model.generate_text = AsyncMock(side_effect=lambda prompt: prompt.upper())
+  model.generate_data = AsyncMock(return_value=[Topic(name="Housing")])
+  return model
+
+
+class ReplayModelTest(unittest.IsolatedAsyncioTestCase):
+
+  def setUp(self):
+    temp_dir = tempfile.TemporaryDirectory()
+    self.addCleanup(temp_dir.cleanup)
+    self.cassette_path = os.path.join(temp_dir.name, "cassette.jsonl")
+
+  async def test_records_and_replays(self):
+    recorded_model = make_recorded_model()
+    recorder = ReplayModel(
+        self.cassette_path, replay_model.RECORD, recorded_model
+    )
+    self.assertEqual(recorder.categorization_batch_size, 50)
+    self.assertEqual(await recorder.generate_text("hi"), "HI")
+    self.assertEqual(
+        await recorder.generate_data("topics?", List[Topic]),
+        [Topic(name="Housing")],
+    )
+
+    player = ReplayModel(self.cassette_path)
+    self.assertEqual(await player.generate_text("hi"), "HI")
+    self.assertEqual(
+        await player.generate_data("topics?", List[Topic]),
+        [Topic(name="Housing")],
+    )
+    self.assertEqual(recorded_model.generate_text.await_count, 1)
+    self.assertEqual(recorded_model.generate_data.await_count, 1)
+
+  async def test_replay_miss_raises(self):
+    recorder = ReplayModel(
+        self.cassette_path, replay_model.RECORD, make_recorded_model()
+    )
+    await recorder.generate_text("hi")
+
+    player = ReplayModel(self.cassette_path)
+    with self.assertRaises(CassetteMissError):
+      await player.generate_text("bye")
+    # The schema is part of the request, so the same prompt doesn't match.
+    with self.assertRaises(CassetteMissError):
+      await player.generate_data("hi", List[Topic])
+
+  async def test_rerecording_replaces_response(self):
+    recorded_model = make_recorded_model()
+    recorder = ReplayModel(
+        self.cassette_path, replay_model.RECORD, recorded_model
+    )
+    await recorder.generate_text("hi")
+    recorded_model.generate_text = AsyncMock(return_value="new")
+    await recorder.generate_text("hi")
+
+    player = ReplayModel(self.cassette_path)
+    self.assertEqual(await player.generate_text("hi"), "new")
+
+  @patch("asyncio.sleep", new_callable=AsyncMock)
+  async def test_replays_latency(self, mock_sleep):
+    recorder = ReplayModel(
+        self.cassette_path, replay_model.RECORD, make_recorded_model()
+    )
+    await recorder.generate_text("hi")
+    key = replay_model._request_key("generate_text", "hi")
+    latency = recorder.entries[key]["latency_sec"]
+
+    player = ReplayModel(self.cassette_path, replay_latency=True)
+    await player.generate_text("hi")
+    mock_sleep.assert_awaited_once_with(latency)
+
+  def test_replay_without_cassette_raises(self):
+    with self.assertRaises(FileNotFoundError):
+      ReplayModel(self.cassette_path)
+
+
+if __name__ == "__main__":
+  unittest.main()
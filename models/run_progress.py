@@ -0,0 +1,157 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Tracks and reports the progress, throughput and ETA of long running jobs.
+"""
+
+import asyncio
+import collections
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Deque, Dict, Optional, Tuple
+
+# How many seconds of recent completions throughput is measured over.
+DEFAULT_WINDOW_SEC = 300
+
+
+class RunProgress:
+  """Counts job outcomes and derives throughput and an ETA from them.
+
+  Throughput is measured over a rolling window of recent completions, so the
+  ETA follows the current rate rather than the average over the whole run.
+  """
+
+  def __init__(
+      self,
+      total_jobs: int,
+      window_seconds: float = DEFAULT_WINDOW_SEC,
+      status_file: Optional[str] = None,
+  ):
+    """Initializes the RunProgress.
+
+    Args:
+      total_jobs: The number of jobs in the run.
+      window_seconds: How many seconds throughput is measured over.
+      status_file: If set, a JSON status is written to this path on each
+        report.
+    """
+    self.total_jobs = total_jobs
+    self.window_seconds = window_seconds
+    self.status_file = status_file
+    self.completed = 0
+    self.failed = 0
+    self.in_flight = 0
+    self.tokens = 0
+    self._start_time = time.monotonic()
+    # (completion time, tokens used) of each job finished in the window.
+    self._recent: Deque[Tuple[float, int]] = collections.deque()
+
+  def job_started(self):
+    """Records that a worker has picked up a job."""
+    self.in_flight += 1
+
+  def job_finished(self, succeeded: bool, tokens: int = 0):
+    """Records that a job has either succeeded or been given up on."""
+    self.in_flight -= 1
+    if succeeded:
+      self.completed += 1
+    else:
+      self.failed += 1
+    self.tokens += tokens
+    self._recent.append((time.monotonic(), tokens))
+
+  def snapshot(self, pause_state: Optional[str] = None) -> Dict[str, Any]:
+    """Returns the current progress.
+
+    Args:
+      pause_state: The reason workers are paused, if they are.
+    """
+    now = time.monotonic()
+    while self._recent and self._recent[0][0] < now - self.window_seconds:
+      self._recent.popleft()
+    elapsed = now - self._start_time
+    window = max(min(self.window_seconds, elapsed), 1e-9)
+    jobs_per_min = len(self._recent) / window * 60
+    tokens_per_min = sum(tokens for _, tokens in self._recent) / window * 60
+
+    remaining = self.total_jobs - self.completed - self.failed
+    eta_seconds = remaining / jobs_per_min * 60 if jobs_per_min else None
+    return {
+        "total": self.total_jobs,
+        "completed": self.completed,
+        "failed": self.failed,
+        "in_flight": self.in_flight,
+        "pending": remaining - self.in_flight,
+        "jobs_per_min": jobs_per_min,
+        "tokens_per_min": tokens_per_min,
+        "total_tokens": self.tokens,
+        "paused": pause_state,
+        "elapsed_seconds": elapsed,
+        "eta_seconds": eta_seconds,
+    }
+
+  def report(self, pause_state: Optional[str] = None):
+    """Logs a one line progress summary, and updates the status file."""
+    snapshot = self.snapshot(pause_state)
+    logging.info(_format_snapshot(snapshot))
+    if self.status_file:
+      _write_status_file(self.status_file, snapshot)
+
+  async def report_periodically(
+      self,
+      interval_seconds: float,
+      get_pause_state: Callable[[], Optional[str]],
+  ):
+    """Reports progress every `interval_seconds` until cancelled."""
+    while True:
+      await asyncio.sleep(interval_seconds)
+      self.report(get_pause_state())
+
+
+def _format_duration(seconds: Optional[float]) -> str:
+  if seconds is None:
+    return "?"
+  minutes, seconds = divmod(int(seconds), 60)
+  hours, minutes = divmod(minutes, 60)
+  return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def _format_snapshot(snapshot: Dict[str, Any]) -> str:
+  done = snapshot["completed"] + snapshot["failed"]
+  line = (
+      f"Progress: {done}/{snapshot['total']} done"
+      f" ({snapshot['completed']} ok, {snapshot['failed']} failed),"
+      f" {snapshot['in_flight']} in flight,"
+      f" {snapshot['jobs_per_min']:.1f} jobs/min,"
+      f" {snapshot['tokens_per_min']:.0f} tokens/min,"
+      f" elapsed {_format_duration(snapshot['elapsed_seconds'])},"
+      f" ETA {_format_duration(snapshot['eta_seconds'])}"
+  )
+  if snapshot["paused"]:
+    line += f" [paused: {snapshot['paused']}]"
+  return line
+
+
+def _write_status_file(path: str, snapshot: Dict[str, Any]):
+  """Writes the snapshot as JSON, replacing the file atomically."""
+  tmp_path = f"{path}.tmp"
+  try:
+    with open(tmp_path, "w", encoding="utf-8") as f:
+      json.dump({**snapshot, "updated_at": time.time()}, f)
+    os.replace(tmp_path, path)
+  except OSError as e:
+    logging.error(f"Error writing progress status file {path}: {e}")
@@ -0,0 +1,86 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+import unittest
+from unittest.mock import patch
+
+from models import run_progress
+from models.run_progress import RunProgress
+
+
+class RunProgressTest(unittest.TestCase):
+
+  @patch("time.monotonic")
+  def test_snapshot(self, mock_monotonic):
+    mock_monotonic.return_value = 0
+    progress = RunProgress(total_jobs=10, window_seconds=60)
+    for _ in range(4):
+      progress.job_started()
+    progress.job_finished(succeeded=True, tokens=100)
+    progress.job_finished(succeeded=False)
+
+    mock_monotonic.return_value = 30
+    snapshot = progress.snapshot(pause_state="quota")
+
+    self.assertEqual(snapshot["completed"], 1)
+    self.assertEqual(snapshot["failed"], 1)
+    self.assertEqual(snapshot["in_flight"], 2)
+    self.assertEqual(snapshot["pending"], 6)
+    self.assertAlmostEqual(snapshot["jobs_per_min"], 4)
+    self.assertAlmostEqual(snapshot["tokens_per_min"], 200)
+    self.assertAlmostEqual(snapshot["eta_seconds"], 120)
+    self.assertEqual(snapshot["paused"], "quota")
+
+  @patch("time.monotonic")
+  def test_throughput_only_counts_recent_jobs(self, mock_monotonic):
+    mock_monotonic.return_value = 0
+    progress = RunProgress(total_jobs=10, window_seconds=60)
+    progress.job_started()
+    progress.job_finished(succeeded=True, tokens=100)
+
+    mock_monotonic.return_value = 120
+    snapshot = progress.snapshot()
+
+    self.assertEqual(snapshot["jobs_per_min"], 0)
+    self.assertIsNone(snapshot["eta_seconds"])
+    self.assertEqual(snapshot["total_tokens"], 100)
+
+  def test_report_writes_status_file(self):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      status_file = os.path.join(tmp_dir, "status.json")
+      progress = RunProgress(total_jobs=2, status_file=status_file)
+      progress.job_started()
+
+      progress.report()
+
+      with open(status_file) as f:
+        status = json.load(f)
+      self.assertEqual(status["total"], 2)
+      self.assertEqual(status["in_flight"], 1)
+      self.assertIn("updated_at", status)
+
+  def test_format_snapshot(self):
+    progress = RunProgress(total_jobs=3)
+    line = run_progress._format_snapshot(progress.snapshot("quota"))
+
+    self.assertIn("0/3 done", line)
+    self.assertIn("ETA ?", line)
+    self.assertIn("[paused: quota]", line)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,174 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs GenaiModel.process_prompts_concurrently across several worker processes.
+
+A single event loop becomes CPU bound at very high concurrency. This module
+splits the jobs into contiguous shards, and runs each one in its own process
+with its own GenaiModel and event loop.
+"""
+
+import asyncio
+import concurrent.futures
+import logging
+import multiprocessing
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import pandas as pd
+
+from .genai_model import GenaiModel, MAX_CONCURRENT_CALLS
+
+
+def _split_into_shards(
+    prompts: List[Dict[str, Any]], num_shards: int
+) -> List[Tuple[int, List[Dict[str, Any]]]]:
+  """Splits the prompts into at most `num_shards` contiguous, non-empty shards.
+
+  Returns:
+    A list of (index of the shard's first prompt, shard prompts) tuples.
+  """
+  num_shards = max(min(num_shards, len(prompts)), 1)
+  base_size, remainder = divmod(len(prompts), num_shards)
+  shards = []
+  start = 0
+  for i in range(num_shards):
+    size = base_size + (1 if i < remainder else 0)
+    if size:
+      shards.append((start, prompts[start : start + size]))
+    start += size
+  return shards
+
+
+def _split_concurrency(max_concurrent_calls: int, num_shards: int) -> List[int]:
+  """Splits the concurrency budget as evenly as possible between the shards."""
+  base_calls, remainder = divmod(max_concurrent_calls, num_shards)
+  return [
+      max(base_calls + (1 if i < remainder else 0), 1)
+      for i in range(num_shards)
+  ]
+
+
+def _run_shard(
+    start_index: int,
+    prompts: List[Dict[str, Any]],
+    response_parser: Callable[[str, Dict[str, Any]], Any],
+    max_concurrent_calls: int,
+    model_kwargs: Dict[str, Any],
+    process_kwargs: Dict[str, Any],
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+  """Processes one shard of prompts in the current process."""
+  model = GenaiModel(**model_kwargs)
+  results, stats = asyncio.run(
+      model.process_prompts_concurrently(
+          prompts,
+          response_parser,
+          max_concurrent_calls=max_concurrent_calls,
+          **process_kwargs,
+      )
+  )
+  # Job ids and numbers are assigned per shard, so offset them to match the
+  # position of each job in the full list of prompts.
+  for column in ("job_id", "opinion_num"):
+    if column in results.columns:
+      results[column] += start_index
+  return results, stats
+
+
+def _merge_shard_results(
+    shard_results: List[Tuple[pd.DataFrame, pd.DataFrame]],
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+  """Merges shard results, ordering the results by job id.
+
+  The stats of each shard are kept in completion order, with the shards in
+  the order of their prompts.
+  """
+  results = pd.concat([r for r, _ in shard_results], ignore_index=True)
+  if "job_id" in results.columns:
+    results = results.sort_values("job_id", kind="stable", ignore_index=True)
+  stats = pd.concat([s for _, s in shard_results], ignore_index=True)
+  return results, stats
+
+
+async def process_prompts_sharded(
+    model_name: str,
+    prompts: List[Dict[str, Any]],
+    response_parser: Callable[[str, Dict[str, Any]], Any],
+    num_shards: Optional[int] = None,
+    max_concurrent_calls: int = MAX_CONCURRENT_CALLS,
+    api_key: Optional[str] = None,
+    safety_filters_on: bool = False,
+    **process_kwargs: Any,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+  """Processes the prompts across several processes, each with its own model.
+
+  Each process runs GenaiModel.process_prompts_concurrently on a contiguous
+  shard of the prompts, with an even share of `max_concurrent_calls`. Quota
+  pauses, token budgets and learned token limits are per shard, not shared.
+  Processes are spawned, so `response_parser`, the prompts and any
+  `process_kwargs` must be picklable, e.g. the parser must be a module-level
+  function.
+
+  Args:
+    model_name: The name of the model to use.
+    prompts: The jobs to process, as for process_prompts_concurrently.
+    response_parser: The response parser, as for process_prompts_concurrently.
+    num_shards: The number of processes to use. Defaults to the CPU count.
+    max_concurrent_calls: The total number of concurrent API calls, across all
+      shards.
+    api_key: The Google Generative AI API key, see GenaiModel.
+    safety_filters_on: Whether to enable safety filters, see GenaiModel.
+    **process_kwargs: Other arguments for process_prompts_concurrently.
+
+  Returns:
+    The same (llm_response, llm_response_stats) tuple as
+    process_prompts_concurrently, with results ordered by job id.
+  """
+  if not prompts:
+    return pd.DataFrame(), pd.DataFrame()
+
+  shards = _split_into_shards(prompts, num_shards or os.cpu_count() or 1)
+  concurrency = _split_concurrency(max_concurrent_calls, len(shards))
+  model_kwargs = {
+      "model_name": model_name,
+      "api_key": api_key,
+      "safety_filters_on": safety_filters_on,
+  }
+  logging.info(
+      f"Processing {len(prompts)} prompts in {len(shards)} shards with up to"
+      f" {max_concurrent_calls} concurrent calls in total."
+  )
+
+  loop = asyncio.get_running_loop()
+  with concurrent.futures.ProcessPoolExecutor(
+      max_workers=len(shards),
+      mp_context=multiprocessing.get_context("spawn"),
+  ) as executor:
+    shard_results = await asyncio.gather(*[
+        loop.run_in_executor(
+            executor,
+            _run_shard,
+            start_index,
+            shard_prompts,
+            response_parser,
+            shard_concurrency,
+            model_kwargs,
+            process_kwargs,
+        )
+        for (start_index, shard_prompts), shard_concurrency in zip(
+            shards, concurrency
+        )
+    ])
+
+  return _merge_shard_results(shard_results)
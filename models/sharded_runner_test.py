@@ -0,0 +1,94 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import logging
+import unittest
+from unittest.mock import patch
+
+import pandas as pd
+
+from models import sharded_runner
+
+# Disable logging for tests
+logging.disable(logging.CRITICAL)
+
+
+class ShardedRunnerTest(unittest.TestCase):
+
+  def test_split_into_shards(self):
+    prompts = [{'prompt': f'p{i}'} for i in range(5)]
+
+    shards = sharded_runner._split_into_shards(prompts, 2)
+
+    self.assertEqual([start for start, _ in shards], [0, 3])
+    self.assertEqual([len(shard) for _, shard in shards], [3, 2])
+
+  def test_split_into_shards_more_shards_than_prompts(self):
+    prompts = [{'prompt': 'p0'}, {'prompt': 'p1'}]
+
+    shards = sharded_runner._split_into_shards(prompts, 8)
+
+    self.assertEqual([start for start, _ in shards], [0, 1])
+
+  def test_split_concurrency(self):
+    self.assertEqual(sharded_runner._split_concurrency(10, 3), [4, 3, 3])
+    self.assertEqual(sharded_runner._split_concurrency(2, 3), [1, 1, 1])
+
+  @patch('google.genai.Client')
+  @patch('models.genai_model.GenaiModel._call_gemini')
+  def test_run_shard_offsets_job_ids(self, mock_call_gemini, mock_client):
+    mock_call_gemini.return_value = {
+        'text': 'parsed',
+        'total_token_count': 10,
+        'prompt_token_count': 7,
+        'candidates_token_count': 1,
+        'tool_use_prompt_token_count': 1,
+        'thoughts_token_count': 1,
+        'error': None,
+    }
+
+    results, stats = sharded_runner._run_shard(
+        5,
+        [{'prompt': 'p5'}, {'prompt': 'p6'}],
+        lambda resp, job: resp['text'],
+        2,
+        {'model_name': 'test_model', 'api_key': 'test_key'},
+        {'delay_between_calls_seconds': 0},
+    )
+
+    self.assertEqual(sorted(results['job_id'].tolist()), [5, 6])
+    self.assertEqual(sorted(results['opinion_num'].tolist()), [6, 7])
+    self.assertFalse(stats.empty)
+
+  def test_merge_shard_results(self):
+    shard_results = [
+        (
+            pd.DataFrame({'job_id': [1, 0], 'result': ['b', 'a']}),
+            pd.DataFrame({'total_token_used': [1, 2]}),
+        ),
+        (
+            pd.DataFrame({'job_id': [2], 'result': ['c']}),
+            pd.DataFrame({'total_token_used': [3]}),
+        ),
+    ]
+
+    results, stats = sharded_runner._merge_shard_results(shard_results)
+
+    self.assertEqual(results['result'].tolist(), ['a', 'b', 'c'])
+    self.assertEqual(results.index.tolist(), [0, 1, 2])
+    self.assertEqual(stats['total_token_used'].tolist(), [1, 2, 3])
+
+
+if __name__ == '__main__':
+  unittest.main()
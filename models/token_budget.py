@@ -0,0 +1,201 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A run-level token and spend budget that is enforced while a run is in progress.
+"""
+
+import asyncio
+import logging
+from typing import Any, Dict, Optional, Tuple
+
+# Estimated prices in USD per 1M tokens, as (input price, output price). Output
+# prices also apply to thinking tokens. These are list prices for prompts under
+# 200k tokens and are only meant for estimating spend, not for billing.
+DEFAULT_PRICES_PER_MILLION_TOKENS: Dict[str, Tuple[float, float]] = {
+    "gemini-2.5-pro": (1.25, 10.0),
+    "gemini-2.5-flash": (0.30, 2.50),
+    "gemini-2.5-flash-lite": (0.10, 0.40),
+}
+# The fraction of a budget after which dispatching new calls is slowed down.
+DEFAULT_THROTTLE_AT = 0.9
+# How long in seconds a worker waits before each call once throttling starts.
+DEFAULT_THROTTLE_DELAY_SEC = 5
+
+
+class TokenBudget:
+  """Tracks token usage for a run and decides whether more calls can be made.
+
+  Any combination of total token, thinking token and estimated spend limits
+  can be set. Once usage of any limit passes `throttle_at`, callers are slowed
+  down, and once any limit is reached no new calls should be dispatched. Calls
+  already in flight when the budget runs out still complete, so usage can end
+  up slightly over the budget.
+  """
+
+  def __init__(
+      self,
+      max_total_tokens: Optional[int] = None,
+      max_thinking_tokens: Optional[int] = None,
+      max_cost_usd: Optional[float] = None,
+      model_name: Optional[str] = None,
+      prices_per_million_tokens: Optional[
+          Dict[str, Tuple[float, float]]
+      ] = None,
+      throttle_at: float = DEFAULT_THROTTLE_AT,
+      throttle_delay_seconds: float = DEFAULT_THROTTLE_DELAY_SEC,
+  ):
+    """Initializes the TokenBudget.
+
+    Args:
+      max_total_tokens: The maximum number of tokens (input, output and
+        thinking) the run can use.
+      max_thinking_tokens: The maximum number of thinking tokens the run can
+        use.
+      max_cost_usd: The maximum estimated spend for the run, in USD.
+      model_name: The model used for the run, used to look up its prices.
+        Required if `max_cost_usd` is set.
+      prices_per_million_tokens: A price table to use instead of
+        DEFAULT_PRICES_PER_MILLION_TOKENS.
+      throttle_at: The fraction of any limit after which calls are throttled.
+      throttle_delay_seconds: How long to wait before each call while throttled.
+    """
+    prices = prices_per_million_tokens or DEFAULT_PRICES_PER_MILLION_TOKENS
+    self._prices = prices.get(model_name) if model_name else None
+    if max_cost_usd is not None and self._prices is None:
+      raise ValueError(
+          f"No prices known for model '{model_name}', so a cost budget can't"
+          " be enforced."
+      )
+
+    self.max_total_tokens = max_total_tokens
+    self.max_thinking_tokens = max_thinking_tokens
+    self.max_cost_usd = max_cost_usd
+    self.throttle_at = throttle_at
+    self.throttle_delay_seconds = throttle_delay_seconds
+
+    self.prompt_tokens = 0
+    self.output_tokens = 0
+    self.thinking_tokens = 0
+    self.total_tokens = 0
+    self._exhausted_logged = False
+
+  def record_response(self, resp: Dict[str, Any]):
+    """Adds the token usage of a `GenaiModel._call_gemini` response.
+
+    Error responses, e.g. ones cut short by MAX_TOKENS or blocked for safety,
+    are charged too. If one has no usage metadata, its candidate's token
+    count is charged as output.
+    """
+    output_tokens = resp.get("candidates_token_count") or 0
+    total_tokens = resp.get("total_token_count") or 0
+    if not total_tokens and resp.get("token_count"):
+      output_tokens = resp["token_count"]
+      total_tokens = output_tokens
+    self.record(
+        prompt_tokens=resp.get("prompt_token_count") or 0,
+        output_tokens=output_tokens,
+        thinking_tokens=resp.get("thoughts_token_count") or 0,
+        total_tokens=total_tokens,
+    )
+
+  def record(
+      self,
+      prompt_tokens: int = 0,
+      output_tokens: int = 0,
+      thinking_tokens: int = 0,
+      total_tokens: int = 0,
+  ):
+    """Adds token usage to the budget."""
+    self.prompt_tokens += prompt_tokens
+    self.output_tokens += output_tokens
+    self.thinking_tokens += thinking_tokens
+    self.total_tokens += total_tokens
+
+  @property
+  def estimated_cost_usd(self) -> Optional[float]:
+    """The estimated spend so far, or None if the model's prices are unknown."""
+    if self._prices is None:
+      return None
+    input_price, output_price = self._prices
+    return (
+        self.prompt_tokens * input_price
+        + (self.output_tokens + self.thinking_tokens) * output_price
+    ) / 1_000_000
+
+  def usage_fraction(self) -> float:
+    """Returns the used fraction of the most consumed limit."""
+    fractions = [0.0]
+    if self.max_total_tokens is not None:
+      fractions.append(self.total_tokens / max(self.max_total_tokens, 1))
+    if self.max_thinking_tokens is not None:
+      fractions.append(self.thinking_tokens / max(self.max_thinking_tokens, 1))
+    if self.max_cost_usd is not None:
+      fractions.append(self.estimated_cost_usd / max(self.max_cost_usd, 1e-9))
+    return max(fractions)
+
+  def is_exhausted(self) -> bool:
+    """Whether any limit has been reached."""
+    return self.usage_fraction() >= 1
+
+  async def wait_for_capacity(self) -> bool:
+    """Waits while the budget is nearly used up.
+
+    Returns:
+      False if the budget is exhausted and no new call should be made, and
+      True otherwise.
+    """
+    if self.is_exhausted():
+      if not self._exhausted_logged:
+        self._exhausted_logged = True
+        logging.warning(
+            "Token budget exhausted, no new calls will be dispatched."
+        )
+      return False
+    if self.usage_fraction() >= self.throttle_at:
+      await asyncio.sleep(self.throttle_delay_seconds)
+    return True
+
+  def summary(self) -> Dict[str, Any]:
+    """Returns the consumed and remaining amounts of each budget."""
+    summary = {
+        "prompt_tokens": self.prompt_tokens,
+        "output_tokens": self.output_tokens,
+        "thinking_tokens": self.thinking_tokens,
+        "total_tokens": self.total_tokens,
+        "estimated_cost_usd": self.estimated_cost_usd,
+    }
+    if self.max_total_tokens is not None:
+      summary["remaining_total_tokens"] = max(
+          self.max_total_tokens - self.total_tokens, 0
+      )
+    if self.max_thinking_tokens is not None:
+      summary["remaining_thinking_tokens"] = max(
+          self.max_thinking_tokens - self.thinking_tokens, 0
+      )
+    if self.max_cost_usd is not None:
+      summary["remaining_cost_usd"] = max(
+          self.max_cost_usd - self.estimated_cost_usd, 0.0
+      )
+    return summary
+
+  def log_summary(self):
+    """Logs the consumed and remaining amounts of each budget."""
+    logging.info("\n--- Token Budget Summary ---")
+    for name, value in self.summary().items():
+      if isinstance(value, float):
+        logging.info(f"{name}: {value:.4f}")
+      else:
+        logging.info(f"{name}: {value}")
+    logging.info("----------------------------\n")
@@ -0,0 +1,97 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+from unittest.mock import AsyncMock, patch
+
+from models.token_budget import TokenBudget
+
+
+class TokenBudgetTest(unittest.IsolatedAsyncioTestCase):
+
+  def test_record_response(self):
+    budget = TokenBudget(max_total_tokens=100)
+    budget.record_response({
+        "prompt_token_count": 5,
+        "candidates_token_count": 3,
+        "thoughts_token_count": None,
+        "total_token_count": 8,
+    })
+
+    self.assertEqual(budget.total_tokens, 8)
+    self.assertEqual(budget.thinking_tokens, 0)
+    self.assertEqual(budget.summary()["remaining_total_tokens"], 92)
+
+  def test_record_error_responses(self):
+    budget = TokenBudget(max_total_tokens=100)
+    budget.record_response({
+        "error": "MAX_TOKENS",
+        "finish_message": "",
+        "token_count": 50,
+        "prompt_token_count": 5,
+        "candidates_token_count": 50,
+        "thoughts_token_count": 20,
+        "total_token_count": 75,
+    })
+    # Without usage metadata, the candidate's token count is charged.
+    budget.record_response({"error": "SAFETY", "token_count": 10})
+
+    self.assertEqual(budget.total_tokens, 85)
+    self.assertEqual(budget.output_tokens, 60)
+    self.assertEqual(budget.thinking_tokens, 20)
+
+  def test_most_consumed_limit_is_used(self):
+    budget = TokenBudget(max_total_tokens=100, max_thinking_tokens=10)
+    budget.record(thinking_tokens=5, total_tokens=20)
+
+    self.assertAlmostEqual(budget.usage_fraction(), 0.5)
+    self.assertFalse(budget.is_exhausted())
+    budget.record(thinking_tokens=5, total_tokens=5)
+    self.assertTrue(budget.is_exhausted())
+
+  def test_cost_budget(self):
+    budget = TokenBudget(
+        max_cost_usd=1.0,
+        model_name="test-model",
+        prices_per_million_tokens={"test-model": (1.0, 10.0)},
+    )
+    budget.record(prompt_tokens=1_000_000, output_tokens=50_000)
+
+    self.assertAlmostEqual(budget.estimated_cost_usd, 1.5)
+    self.assertTrue(budget.is_exhausted())
+    self.assertEqual(budget.summary()["remaining_cost_usd"], 0.0)
+
+  def test_cost_budget_requires_prices(self):
+    with self.assertRaises(ValueError):
+      TokenBudget(max_cost_usd=1.0, model_name="unknown-model")
+
+  @patch("asyncio.sleep", new_callable=AsyncMock)
+  async def test_wait_for_capacity(self, mock_sleep):
+    budget = TokenBudget(
+        max_total_tokens=100, throttle_at=0.5, throttle_delay_seconds=3
+    )
+
+    self.assertTrue(await budget.wait_for_capacity())
+    mock_sleep.assert_not_called()
+
+    budget.record(total_tokens=60)
+    self.assertTrue(await budget.wait_for_capacity())
+    mock_sleep.assert_called_once_with(3)
+
+    budget.record(total_tokens=40)
+    self.assertFalse(await budget.wait_for_capacity())
+
+
+if __name__ == "__main__":
+  unittest.main()
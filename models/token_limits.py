@@ -0,0 +1,154 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Learns per job type output and thinking token limits from observed responses.
+"""
+
+import collections
+from typing import Deque, Dict, Optional, Tuple
+import numpy as np
+
+# The job type used for jobs that don't set one.
+DEFAULT_JOB_TYPE = "default"
+# The percentile of observed token counts the limits are set at.
+DEFAULT_PERCENTILE = 95
+# How much to scale the observed percentile by, to leave room for variance.
+DEFAULT_HEADROOM = 1.25
+# How many responses must be seen for a job type before limits are applied.
+DEFAULT_MIN_SAMPLES = 20
+# How many of the most recent responses are kept for each job type.
+DEFAULT_MAX_SAMPLES = 1000
+# The smallest thinking budget accepted by all Gemini 2.5 models.
+MIN_THINKING_BUDGET = 512
+# How much a job type's learned limits are widened each time one of them cuts a
+# response short.
+TRUNCATION_WIDENING = 1.25
+# The fraction of responses learned limits should cut short. After each
+# response that fits, the widening is undone a little, so that truncations
+# settle at about this rate.
+TARGET_TRUNCATION_RATE = 0.01
+
+
+class OutputTokenLimiter:
+  """Learns tight `max_output_tokens` and thinking budgets for each job type.
+
+  The output and thinking token counts of successful responses are recorded
+  per job type. Once enough responses have been seen, limits are suggested at
+  a percentile of those counts, scaled by some headroom. Gemini counts thinking
+  tokens towards `max_output_tokens`, so the output limit is learned from the
+  sum of output and thinking tokens.
+
+  Responses cut short by a learned limit should be retried without it and
+  reported with `record_truncation`, which widens the job type's limits, see
+  `GenaiModel._api_worker_with_retry`. Otherwise every job above the limit
+  would keep paying for two calls.
+  """
+
+  def __init__(
+      self,
+      percentile: float = DEFAULT_PERCENTILE,
+      headroom: float = DEFAULT_HEADROOM,
+      min_samples: int = DEFAULT_MIN_SAMPLES,
+      max_samples: int = DEFAULT_MAX_SAMPLES,
+  ):
+    """Initializes the OutputTokenLimiter.
+
+    Args:
+      percentile: The percentile of observed token counts to set limits at.
+      headroom: The factor the percentile is multiplied by to get the limit.
+      min_samples: The number of responses needed before a limit is suggested.
+      max_samples: The number of most recent responses kept per job type.
+    """
+    self.percentile = percentile
+    self.headroom = headroom
+    self.min_samples = min_samples
+    self._output_tokens: Dict[str, Deque[int]] = collections.defaultdict(
+        lambda: collections.deque(maxlen=max_samples)
+    )
+    self._thinking_tokens: Dict[str, Deque[int]] = collections.defaultdict(
+        lambda: collections.deque(maxlen=max_samples)
+    )
+    # The factor each job type's learned limits are widened by.
+    self._widening: Dict[str, float] = collections.defaultdict(lambda: 1.0)
+
+  def record(
+      self,
+      job_type: Optional[str],
+      output_tokens: Optional[int],
+      thinking_tokens: Optional[int],
+  ):
+    """Records the token counts of a successful response."""
+    job_type = job_type or DEFAULT_JOB_TYPE
+    thinking_tokens = thinking_tokens or 0
+    self._output_tokens[job_type].append((output_tokens or 0) + thinking_tokens)
+    self._thinking_tokens[job_type].append(thinking_tokens)
+    if job_type in self._widening:
+      self._widening[job_type] = max(
+          self._widening[job_type]
+          * TRUNCATION_WIDENING
+          ** (-TARGET_TRUNCATION_RATE / (1 - TARGET_TRUNCATION_RATE)),
+          1.0,
+      )
+
+  def record_truncation(self, job_type: Optional[str]):
+    """Widens the learned limits after one of them cut a response short."""
+    self._widening[job_type or DEFAULT_JOB_TYPE] *= TRUNCATION_WIDENING
+
+  def _limit(self, samples: Deque[int], job_type: str) -> int:
+    scale = self.headroom * self._widening.get(job_type, 1.0)
+    return max(int(np.ceil(np.percentile(samples, self.percentile) * scale)), 1)
+
+  def get_limits(
+      self,
+      job_type: Optional[str],
+      max_output_tokens: Optional[int] = None,
+      thinking_budget: Optional[int] = None,
+  ) -> Tuple[Optional[int], Optional[int]]:
+    """Returns the limits to use for a job of the given type.
+
+    Learned limits never loosen limits the job already sets, and a job's
+    thinking budget is only tightened if the model has been seen thinking.
+
+    Args:
+      job_type: The type of the job.
+      max_output_tokens: The job's own output token limit, if any.
+      thinking_budget: The job's own thinking budget, if any.
+
+    Returns:
+      A tuple of the max output tokens and the thinking budget to use.
+    """
+    job_type = job_type or DEFAULT_JOB_TYPE
+    output_samples = self._output_tokens.get(job_type)
+    if not output_samples or len(output_samples) < self.min_samples:
+      return max_output_tokens, thinking_budget
+
+    learned_output_limit = self._limit(output_samples, job_type)
+    if max_output_tokens is not None:
+      learned_output_limit = min(learned_output_limit, max_output_tokens)
+
+    learned_thinking_budget = thinking_budget
+    thinking_samples = self._thinking_tokens[job_type]
+    # A budget of 0 disables thinking and a negative one lets the model decide,
+    # and neither is a limit that can be tightened.
+    if max(thinking_samples) > 0 and (
+        thinking_budget is None or thinking_budget > 0
+    ):
+      learned_thinking_budget = max(
+          self._limit(thinking_samples, job_type), MIN_THINKING_BUDGET
+      )
+      if thinking_budget is not None:
+        learned_thinking_budget = min(learned_thinking_budget, thinking_budget)
+
+    return learned_output_limit, learned_thinking_budget
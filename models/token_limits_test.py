@@ -0,0 +1,81 @@
+# Copyright 2025 Google LLC
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from models.token_limits import MIN_THINKING_BUDGET, OutputTokenLimiter
+
+
+class OutputTokenLimiterTest(unittest.TestCase):
+
+  def test_no_limits_before_min_samples(self):
+    limiter = OutputTokenLimiter(min_samples=3)
+    limiter.record("summary", 100, 0)
+    limiter.record("summary", 100, 0)
+
+    self.assertEqual(limiter.get_limits("summary"), (None, None))
+    self.assertEqual(limiter.get_limits("summary", 50, 10), (50, 10))
+
+  def test_limits_learned_per_job_type(self):
+    limiter = OutputTokenLimiter(percentile=100, headroom=1.5, min_samples=2)
+    limiter.record("summary", 100, 0)
+    limiter.record("summary", 200, 0)
+    limiter.record("topics", 10, 0)
+    limiter.record("topics", 20, 0)
+
+    self.assertEqual(limiter.get_limits("summary"), (300, None))
+    self.assertEqual(limiter.get_limits("topics"), (30, None))
+    self.assertEqual(limiter.get_limits(None), (None, None))
+
+  def test_thinking_tokens_count_towards_output_limit(self):
+    limiter = OutputTokenLimiter(percentile=100, headroom=1.0, min_samples=1)
+    limiter.record(None, 100, 1000)
+
+    self.assertEqual(limiter.get_limits(None), (1100, 1000))
+
+  def test_learned_limits_never_loosen_job_limits(self):
+    limiter = OutputTokenLimiter(percentile=100, headroom=1.0, min_samples=1)
+    limiter.record(None, 100, 1000)
+
+    self.assertEqual(limiter.get_limits(None, 500, 800), (500, 800))
+    # Disabled and dynamic thinking budgets are left as they are.
+    self.assertEqual(limiter.get_limits(None, None, 0), (1100, 0))
+    self.assertEqual(limiter.get_limits(None, None, -1), (1100, -1))
+
+  def test_thinking_budget_has_a_minimum(self):
+    limiter = OutputTokenLimiter(percentile=100, headroom=1.0, min_samples=1)
+    limiter.record(None, 100, 10)
+
+    self.assertEqual(limiter.get_limits(None), (110, MIN_THINKING_BUDGET))
+
+  def test_truncations_widen_limits(self):
+    limiter = OutputTokenLimiter(percentile=100, headroom=1.0, min_samples=1)
+    limiter.record("summary", 100, 0)
+
+    # Each truncation widens the limit by TRUNCATION_WIDENING.
+    limiter.record_truncation("summary")
+    self.assertEqual(limiter.get_limits("summary"), (125, None))
+    limiter.record_truncation("summary")
+    self.assertEqual(limiter.get_limits("summary"), (157, None))
+    self.assertEqual(limiter.get_limits("topics"), (None, None))
+
+    # Responses that fit narrow the limits back slowly, never below the
+    # percentile.
+    for _ in range(2000):
+      limiter.record("summary", 100, 0)
+    self.assertEqual(limiter.get_limits("summary"), (100, None))
+
+
+if __name__ == "__main__":
+  unittest.main()
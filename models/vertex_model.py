@@ -13,11 +13,14 @@
 # limitations under the License.
 
 import asyncio
-import json
+import datetime
+import functools
 import logging
+import threading
 from typing import Any, List, Callable, Type
 import vertexai
 from vertexai.generative_models import (
+    GenerationConfig,
     GenerativeModel,
     HarmBlockThreshold,
     HarmCategory,
@@ -27,15 +30,70 @@ import google.auth
 from google.auth.transport.requests import Request as AuthRequest
 from requests.adapters import HTTPAdapter
 import requests
-from pydantic import ValidationError, TypeAdapter
-import re
+from pydantic import TypeAdapter
 
 from .model import Model as BaseModelClass, SchemaType, ListSchemaType
-from .model_util import MAX_LLM_RETRIES, DEFAULT_VERTEX_PARALLELISM, RETRY_DELAY_SEC, MAX_RETRIES
-
+from .model_util import (
+    DEFAULT_VERTEX_PARALLELISM,
+    MAX_LLM_RETRIES,
+    MAX_RETRIES,
+    RETRY_DELAY_SEC,
+    BackoffGate,
+    TokenLimitExceededError,
+    gather_tasks_in_parallel,
+    generate_structured_output,
+    retry_call,
+)
 
-class TokenLimitExceededError(Exception):
-  """Custom exception for when the token limit is exceeded."""
+# Param docs: http://cloud/vertex-ai/generative-ai/docs/model-reference/inference#generationconfig
+GENERATION_CONFIG = {
+    "temperature": 0,
+    "top_p": 0,
+}
+
+# How long before expiry credentials are refreshed in the background.
+CREDENTIAL_REFRESH_MARGIN_SEC = 300
+# How often the background refresher checks the credentials' expiry.
+CREDENTIAL_CHECK_INTERVAL_SEC = 30
+
+# Roughly how many characters there are per token, for estimating token counts
+# without calling the token count API.
+CHARS_PER_TOKEN = 4
+# The default token budget for each chunk when splitting oversized prompts. This
+# leaves headroom under Gemini's 1M token input limit for estimation error.
+MAX_CHUNK_TOKENS = 400_000
+
+# How many schemas to keep constrained decoding configs for.
+GENERATION_CONFIG_CACHE_SIZE = 256
+
+# JSON schema keywords with an equivalent in Vertex AI's response schema.
+_RESPONSE_SCHEMA_KEYWORDS = frozenset({
+    "type",
+    "format",
+    "title",
+    "description",
+    "nullable",
+    "enum",
+    "items",
+    "minItems",
+    "maxItems",
+    "properties",
+    "required",
+    "minProperties",
+    "maxProperties",
+    "minimum",
+    "maximum",
+    "minLength",
+    "maxLength",
+    "pattern",
+    "anyOf",
+})
+# JSON schema keywords that only annotate a schema, and can safely be dropped.
+_IGNORED_SCHEMA_KEYWORDS = frozenset({"default", "examples", "$defs"})
+
+
+class UnsupportedSchemaError(Exception):
+  """Raised when a schema can't be expressed as a Vertex AI response schema."""
 
   pass
 
@@ -47,19 +105,35 @@ class VertexModel(BaseModelClass):
       project: str,
       location: str,
       model_name: str,
+      repair_invalid_output: bool = True,
+      refresh_credentials_in_background: bool = True,
   ):
+    """Initializes the VertexModel.
+
+    Args:
+      project: The Google Cloud project to use.
+      location: The Google Cloud location to use.
+      model_name: The name of the model to use.
+      repair_invalid_output: Whether invalid structured output is sent back
+        to the model to be fixed. Otherwise the full prompt is only sent once.
+      refresh_credentials_in_background: Whether to refresh the credentials in
+        a background thread before they expire.
+    """
+    self.repair_invalid_output = repair_invalid_output
+    # Shared by all calls, so quota errors pause them together.
+    self.backoff_gate = BackoffGate()
     # Initialize Vertex AI SDK
-    creds = custom_pool_creds()  # Enables high concurrency
+    auth_request = create_pooled_auth_request()
+    creds = custom_pool_creds(auth_request)  # Enables high concurrency
+    self.credential_refresher = CredentialRefresher(creds, auth_request)
+    if refresh_credentials_in_background:
+      self.credential_refresher.start()
 
     vertexai.init(project=project, location=location, credentials=creds)
 
     self.llm = GenerativeModel(
         model_name=model_name,
-        generation_config={
-            # Param docs: http://cloud/vertex-ai/generative-ai/docs/model-reference/inference#generationconfig
-            "temperature": 0,
-            "top_p": 0,
-        },
+        generation_config=GENERATION_CONFIG,
         safety_settings={
             HarmCategory.HARM_CATEGORY_UNSPECIFIED: (
                 HarmBlockThreshold.BLOCK_NONE
@@ -82,55 +156,101 @@ class VertexModel(BaseModelClass):
         },
     )
 
+  def close(self):
+    """Stops refreshing the credentials in the background."""
+    self.credential_refresher.close()
+
+  def __enter__(self) -> "VertexModel":
+    return self
+
+  def __exit__(self, *unused_exc_info):
+    self.close()
+
   async def generate_text(self, prompt: str) -> str:
     return await self._call_llm_with_retry(prompt)
 
   async def generate_data(
       self, prompt: str, schema: Type[SchemaType] | Type[ListSchemaType]
   ) -> SchemaType | ListSchemaType:
-    response_text = await self._call_llm_with_retry(prompt)
-
-    json_text = response_text
-
-    # Drop markdown code block delimiters if present
-    if json_text.startswith("```json"):
-      json_text = json_text[7:]  # Remove ```json
-    if json_text.endswith("```"):
-      json_text = json_text[:-3]  # Remove ```
+    # Constrain decoding to the schema where possible. For schemas that can't be
+    # expressed this way, the response is parsed from a plain prompt instead.
+    generation_config = get_generation_config(schema)
+    return await generate_structured_output(
+        lambda next_prompt: self._call_llm_with_retry(
+            next_prompt, generation_config
+        ),
+        prompt,
+        schema,
+        self.repair_invalid_output,
+    )
 
-    # Find the first occurrence of '{' or '[', and drop everything in front of it as not expected.
-    match = re.search(r"[\[{]", json_text)
-    if match:
-      first_brace_index = match.start()
-      json_text = json_text[first_brace_index:]
+  async def map_reduce(
+      self,
+      items: List[str],
+      build_prompt: Callable[[List[str]], str],
+      reduce: Callable[[List[Any]], Any],
+      schema: Type[SchemaType] | Type[ListSchemaType] | None = None,
+      max_chunk_tokens: int = MAX_CHUNK_TOKENS,
+      limit: int = DEFAULT_VERTEX_PARALLELISM,
+  ) -> Any:
+    """Processes a list of items too large for one prompt in chunks.
+
+    The items (e.g. comments or statements) are split into chunks whose
+    prompts fit within `max_chunk_tokens`, the chunks are sent to the model
+    concurrently, and `reduce` combines the per-chunk responses. A chunk that
+    still exceeds the model's token limit is halved and retried.
+
+    Args:
+      items: The items to split between prompts.
+      build_prompt: Builds a prompt from a chunk of items.
+      reduce: Combines the responses for all chunks into the final result. It
+        receives them in the order of the items.
+      schema: If set, each chunk is processed with generate_data using this
+        schema, otherwise with generate_text.
+      max_chunk_tokens: The estimated token budget for each chunk's prompt.
+      limit: The maximum number of concurrent model calls.
+
+    Returns:
+      The result of `reduce`.
+    """
+    prompt_overhead = estimate_token_count(build_prompt([]))
+    chunks = split_into_token_bounded_chunks(
+        items, max(max_chunk_tokens - prompt_overhead, 1)
+    )
+    logging.info(f"Split {len(items)} items into {len(chunks)} chunks.")
+    chunk_results = await run_tasks_in_parallel(
+        chunks, self._map_chunk, limit, build_prompt, schema
+    )
+    return reduce([result for results in chunk_results for result in results])
 
+  async def _map_chunk(
+      self,
+      chunk: List[str],
+      build_prompt: Callable[[List[str]], str],
+      schema: Type[SchemaType] | Type[ListSchemaType] | None,
+  ) -> List[Any]:
+    """Returns the responses for a chunk, halving it if it's still too long."""
+    prompt = build_prompt(chunk)
     try:
-      # Use TypeAdapter for robust parsing of schema
-      # The schema argument itself is the type hint, e.g. Topic or List[Topic]
-      adapter = TypeAdapter(schema)
-      return adapter.validate_json(json_text)
-
-    except ValidationError as e:  # Catches Pydantic validation errors
-      logging.debug(
-          f"Model response failed Pydantic validation for schema {schema}:"
-          f" {json_text}.\nError: {e}"
+      if schema is None:
+        return [await self.generate_text(prompt)]
+      return [await self.generate_data(prompt, schema)]
+    except TokenLimitExceededError:
+      if len(chunk) < 2:
+        raise
+      logging.warning(
+          f"Chunk of {len(chunk)} items exceeds the token limit, halving it."
       )
-      raise ValueError(f"Model response failed Pydantic validation") from e
-    except (
-        json.JSONDecodeError
-    ) as e:  # Catches errors if json_text is not valid JSON
-      logging.debug(f"Model returned invalid JSON: {json_text}.")
-      raise ValueError(f"Model returned invalid JSON") from e
-    except Exception as e:  # Catches any other unexpected errors during parsing
-      logging.error(
-          f"Failed to parse or validate model response against schema {schema}:"
-          f" {json_text}.\nError: {e}"
+      middle = len(chunk) // 2
+      first_half, second_half = await asyncio.gather(
+          self._map_chunk(chunk[:middle], build_prompt, schema),
+          self._map_chunk(chunk[middle:], build_prompt, schema),
       )
-      raise ValueError(
-          f"Failed to parse or validate model response: {json_text}."
-      ) from e
+      return first_half + second_half
 
-  async def _call_llm_with_retry(self, prompt: str) -> str:
+  async def _call_llm_with_retry(
+      self, prompt: str, generation_config: GenerationConfig | None = None
+  ) -> str:
     # Gemini can take minutes to error on very long prompts.
     # To avoid this, we check the prompt length before making an API call.
     # We don't use the token count API as it can fail at the HTTP level.
@@ -143,8 +263,8 @@ class VertexModel(BaseModelClass):
 
     async def call_llm_inner() -> GenerationResponse:
       return await self.llm.generate_content_async(
-          prompt
-      )  # TODO: pass schema for constraint decoding
+          prompt, generation_config=generation_config
+      )
 
     def validate_response(response: GenerationResponse | None) -> bool:
       if not response:
@@ -166,57 +286,162 @@ class VertexModel(BaseModelClass):
       )
       return True
 
-    result = await _retry_call(
+    result = await retry_call(
         call_llm_inner,
         validate_response,
         MAX_LLM_RETRIES,
         "Failed to get a valid model response.",
         RETRY_DELAY_SEC,
+        backoff_gate=self.backoff_gate,
     )
     return result.text
 
 
-async def _retry_call(
-    func: Callable[..., Any],  # The async function to call
-    validator: Callable[[Any], bool],  # A function to validate the response
-    max_retries: int,
-    error_message: str,
-    retry_delay_sec: float,
-    func_args: List[Any] | None = None,
-    validator_args: List[Any] | None = None,
-):
-  func_args = func_args or []
-  validator_args = validator_args or []
-  backoff_growth_rate = 2.5  # Controls how quickly delay increases b/w retries
-
-  for attempt in range(1, max_retries + 1):
-    try:
-      response = await func(*func_args)
-
-      if validator(response, *validator_args):
-        return response
-
-      logging.error(f"Attempt {attempt} failed. Invalid response: {response}")
-    except Exception as error:
-      # catch input tokens limit error in case our check for prompt length was not enough
-      if "exceeds the maximum number of tokens allowed" in str(error):
-        raise TokenLimitExceededError(error) from error
-      if isinstance(error, TokenLimitExceededError):
-        raise  # Re-raise the proactively caught token limit error
-      error_message = str(error)
-      # Don't pollute the logs with the long 429 error messages
-      # Extract the relevant part of the error message
-      match = re.search(r"429 Resource exhausted.*", error_message)
-      if match:
-        error_message = match.group(0).split(".")[0]
-      logging.error(f"Attempt {attempt} failed: {error_message}")
-
-    # Exponential backoff calculation
-    delay = retry_delay_sec * (backoff_growth_rate ** (attempt - 1))
-    logging.info(f"Retrying in {int(delay)} seconds (attempt {attempt})")
-    await asyncio.sleep(delay)
-
-  raise Exception(f"Failed after {max_retries} attempts: {error_message}")
+def estimate_token_count(text: str) -> int:
+  """Estimates the number of tokens in the text from its length."""
+  return -(-len(text) // CHARS_PER_TOKEN)
+
+
+def split_into_token_bounded_chunks(
+    items: List[str], max_tokens: int
+) -> List[List[str]]:
+  """Splits items into consecutive chunks of at most `max_tokens` tokens.
+
+  Token counts are estimated from the items' lengths. An item that exceeds the
+  budget by itself gets a chunk of its own.
+  """
+  chunks = []
+  chunk = []
+  chunk_tokens = 0
+  for item in items:
+    item_tokens = estimate_token_count(item)
+    if chunk and chunk_tokens + item_tokens > max_tokens:
+      chunks.append(chunk)
+      chunk = []
+      chunk_tokens = 0
+    chunk.append(item)
+    chunk_tokens += item_tokens
+  if chunk:
+    chunks.append(chunk)
+  return chunks
+
+
+@functools.lru_cache(maxsize=GENERATION_CONFIG_CACHE_SIZE)
+def _build_generation_config(
+    schema: Type[SchemaType] | Type[ListSchemaType],
+) -> GenerationConfig | None:
+  response_schema = to_vertex_response_schema(schema)
+  if response_schema is None:
+    return None
+  return GenerationConfig(
+      **GENERATION_CONFIG,
+      response_mime_type="application/json",
+      response_schema=response_schema,
+  )
+
+
+def get_generation_config(
+    schema: Type[SchemaType] | Type[ListSchemaType],
+) -> GenerationConfig | None:
+  """Returns the constrained decoding config for a schema.
+
+  Configs are cached per schema. Returns None for schemas that can't be
+  expressed as a Vertex AI response schema.
+  """
+  try:
+    hash(schema)
+  except TypeError:
+    return _build_generation_config.__wrapped__(schema)
+  return _build_generation_config(schema)
+
+
+def to_vertex_response_schema(
+    schema: Type[SchemaType] | Type[ListSchemaType],
+) -> dict[str, Any] | None:
+  """Converts a schema to a Vertex AI response schema for constrained decoding.
+
+  References are inlined and nullable unions are turned into `nullable`
+  fields, since Vertex AI only supports a subset of JSON schema.
+
+  Args:
+    schema: The Pydantic model, or list of models or scalars, to convert.
+
+  Returns:
+    The response schema, or None if the schema can't be expressed as one, e.g.
+    because it is recursive or uses unsupported keywords.
+  """
+  try:
+    json_schema = TypeAdapter(schema).json_schema()
+    response_schema = _convert_json_schema(
+        json_schema, json_schema.get("$defs", {}), ()
+    )
+    # Check that the SDK can turn the result into a Schema proto.
+    GenerationConfig(
+        response_mime_type="application/json", response_schema=response_schema
+    )
+    return response_schema
+  except Exception as e:
+    logging.debug(
+        f"Schema {schema} can't be used for constrained decoding: {e}"
+    )
+    return None
+
+
+def _convert_json_schema(
+    node: dict[str, Any],
+    defs: dict[str, Any],
+    ref_stack: tuple[str, ...],
+) -> dict[str, Any]:
+  """Recursively converts a JSON schema node to a Vertex AI schema dict."""
+  if "$ref" in node:
+    name = node["$ref"].split("/")[-1]
+    if name in ref_stack:
+      raise UnsupportedSchemaError(f"Recursive reference to {name}")
+    overrides = {k: v for k, v in node.items() if k != "$ref"}
+    return _convert_json_schema(
+        {**defs[name], **overrides}, defs, ref_stack + (name,)
+    )
+
+  if "anyOf" in node:
+    options = [o for o in node["anyOf"] if o.get("type") != "null"]
+    rest = {k: v for k, v in node.items() if k != "anyOf"}
+    nullable = len(options) < len(node["anyOf"])
+    if len(options) == 1:
+      result = _convert_json_schema({**options[0], **rest}, defs, ref_stack)
+    else:
+      result = _convert_json_schema(rest, defs, ref_stack)
+      result["anyOf"] = [
+          _convert_json_schema(o, defs, ref_stack) for o in options
+      ]
+    if nullable:
+      result["nullable"] = True
+    return result
+
+  result = {}
+  for key, value in node.items():
+    if key in _IGNORED_SCHEMA_KEYWORDS:
+      continue
+    if key == "additionalProperties" and value is False:
+      continue
+    if key == "const" and isinstance(value, str):
+      result["enum"] = [value]
+      continue
+    if key not in _RESPONSE_SCHEMA_KEYWORDS:
+      raise UnsupportedSchemaError(f"Unsupported keyword '{key}'")
+    if key == "type" and not isinstance(value, str):
+      raise UnsupportedSchemaError(f"Unsupported type {value}")
+    if key == "items":
+      value = _convert_json_schema(value, defs, ref_stack)
+    elif key == "properties":
+      value = {
+          name: _convert_json_schema(prop, defs, ref_stack)
+          for name, prop in value.items()
+      }
+    result[key] = value
+  if "properties" in result:
+    # Keep the model's output in the same order as the fields.
+    result["propertyOrdering"] = list(result["properties"])
+  return result
 
 
 async def run_tasks_in_parallel(
@@ -226,28 +451,101 @@ async def run_tasks_in_parallel(
     *args: Any,
     **kwargs: Any,
 ) -> List[Any]:
-  semaphore = asyncio.Semaphore(limit)  # Controls concurrency
-
-  async def limited_task(item: Any) -> Any:
-    async with semaphore:
-      return await func(item, *args, **kwargs)
+  """Runs func on every item and returns the results in the order of the items.
 
+  Raises the first exception raised by any task. Use stream_tasks_in_parallel
+  to keep the results of the tasks that succeed instead.
+  """
   if items:
     logging.info(
         f"Running up to {limit} tasks in parallel for a total of"
         f" {len(items)} tasks..."
     )
 
-  tasks = [limited_task(item) for item in items]
-  results = await asyncio.gather(
-      *tasks, return_exceptions=False
-  )  # Set return_exceptions=True to debug individual task failures
-  return results
+  return await gather_tasks_in_parallel(
+      items, lambda item: func(item, *args, **kwargs), limit
+  )
+
+
+class CredentialRefresher:
+  """Refreshes credentials in a background thread before they expire.
+
+  Otherwise the token is refreshed synchronously by whichever request first
+  finds it expired, stalling every call waiting on it under load. Call close,
+  or use the refresher as a context manager, to stop the thread.
+  """
+
+  def __init__(
+      self,
+      credentials: Any,
+      auth_request: AuthRequest,
+      refresh_margin_sec: float = CREDENTIAL_REFRESH_MARGIN_SEC,
+      check_interval_sec: float = CREDENTIAL_CHECK_INTERVAL_SEC,
+  ):
+    self.credentials = credentials
+    self.auth_request = auth_request
+    self.refresh_margin_sec = refresh_margin_sec
+    self.check_interval_sec = check_interval_sec
+    self._stop_event = threading.Event()
+    self._thread: threading.Thread | None = None
+
+  def needs_refresh(self) -> bool:
+    """Whether the credentials expire within the refresh margin."""
+    expiry = getattr(self.credentials, "expiry", None)
+    if expiry is None:
+      return not self.credentials.token
+    # google-auth uses naive UTC datetimes for expiry.
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return (expiry - now).total_seconds() < self.refresh_margin_sec
+
+  def refresh_if_needed(self) -> bool:
+    """Refreshes the credentials if they're about to expire.
+
+    Returns:
+      Whether the credentials were refreshed.
+    """
+    if not self.needs_refresh():
+      return False
+    try:
+      self.credentials.refresh(self.auth_request)
+      logging.debug("Proactively refreshed credentials.")
+      return True
+    except Exception as e:
+      # The next request will refresh them synchronously instead.
+      logging.warning(f"Background credential refresh failed: {e}")
+      return False
+
+  def start(self):
+    """Starts checking the credentials in a daemon thread."""
+    if self._thread is not None:
+      return
+    self._thread = threading.Thread(
+        target=self._run, name="credential-refresher", daemon=True
+    )
+    self._thread.start()
+
+  def close(self):
+    """Stops the background thread, if it's running."""
+    self._stop_event.set()
+    if self._thread is not None:
+      self._thread.join()
+      self._thread = None
+
+  def __enter__(self) -> "CredentialRefresher":
+    self.start()
+    return self
 
+  def __exit__(self, *unused_exc_info):
+    self.close()
 
-def custom_pool_creds():
+  def _run(self):
+    while not self._stop_event.wait(self.check_interval_sec):
+      self.refresh_if_needed()
+
+
+def create_pooled_auth_request() -> AuthRequest:
+  """Returns a google-auth request backed by a large connection pool."""
   # By default, GCP uses connection pool of size 10, we need to override it to support higher concurrency.
-  # Create a session that holds up to 100 connections using a custom adaptor
   session = requests.Session()
   adapter = HTTPAdapter(
       pool_connections=DEFAULT_VERTEX_PARALLELISM,  # number of connection pools to cache
@@ -257,7 +555,18 @@ def custom_pool_creds():
   )
   session.mount("https://", adapter)
   # Build a google‑auth request using that session
-  auth_request = AuthRequest(session=session)
+  return AuthRequest(session=session)
+
+
+def custom_pool_creds(auth_request: AuthRequest | None = None):
+  """Returns app-default credentials, refreshed using a large connection pool.
+
+  Args:
+    auth_request: The google-auth request to refresh the credentials with.
+      Defaults to a new one from create_pooled_auth_request.
+  """
+  if auth_request is None:
+    auth_request = create_pooled_auth_request()
   # Retrieve app-default creds and refresh them with the new settings
   creds, _ = google.auth.default()
   creds.refresh(auth_request)  # primes the pool
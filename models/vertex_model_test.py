@@ -12,11 +12,44 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+from typing import List, Optional
 import unittest
-from unittest.mock import AsyncMock
+from unittest.mock import AsyncMock, MagicMock
 
-from models import vertex_model
-from models.vertex_model import TokenLimitExceededError
+from pydantic import BaseModel
+from models import model_util, vertex_model
+from models.vertex_model import TokenLimitExceededError, VertexModel
+
+
+class Subtopic(BaseModel):
+  name: str
+  count: Optional[int] = None
+
+
+class Topic(BaseModel):
+  name: str
+  subtopics: List[Subtopic]
+
+
+class TreeNode(BaseModel):
+  children: List["TreeNode"]
+
+
+def make_model(*response_texts: str) -> VertexModel:
+  """Returns a VertexModel with a mocked LLM that returns the given texts."""
+  model = VertexModel.__new__(VertexModel)
+  model.backoff_gate = vertex_model.BackoffGate()
+  model.repair_invalid_output = True
+  responses = []
+  for response_text in response_texts:
+    response = MagicMock()
+    response.text = response_text
+    response.candidates[0].content.parts[0].text = response_text
+    responses.append(response)
+  model.llm = MagicMock()
+  model.llm.generate_content_async = AsyncMock(side_effect=responses)
+  return model
 
 
 class VertexModelTest(unittest.IsolatedAsyncioTestCase):
@@ -28,7 +61,7 @@ class VertexModelTest(unittest.IsolatedAsyncioTestCase):
     )
 
     with self.assertRaises(TokenLimitExceededError) as context:
-      await vertex_model._retry_call(mock_func, lambda x: True, 3, "error", 1)
+      await vertex_model.retry_call(mock_func, lambda x: True, 3, "error", 1)
 
     self.assertIn(
         "exceeds the maximum number of tokens allowed", str(context.exception)
@@ -45,10 +78,197 @@ class VertexModelTest(unittest.IsolatedAsyncioTestCase):
     )
 
     with self.assertRaises(TokenLimitExceededError):
-      await vertex_model._retry_call(mock_func, lambda x: True, 3, "error", 1)
+      await vertex_model.retry_call(mock_func, lambda x: True, 3, "error", 1)
 
     self.assertEqual(mock_func.call_count, 1)
 
+  def test_to_vertex_response_schema_inlines_references(self):
+    response_schema = vertex_model.to_vertex_response_schema(List[Topic])
+
+    self.assertEqual(response_schema["type"], "array")
+    topic_schema = response_schema["items"]
+    self.assertEqual(topic_schema["propertyOrdering"], ["name", "subtopics"])
+    subtopic_schema = topic_schema["properties"]["subtopics"]["items"]
+    self.assertEqual(subtopic_schema["required"], ["name"])
+    self.assertEqual(
+        subtopic_schema["properties"]["count"],
+        {"type": "integer", "title": "Count", "nullable": True},
+    )
+
+  def test_to_vertex_response_schema_unsupported_schemas(self):
+    self.assertIsNone(vertex_model.to_vertex_response_schema(TreeNode))
+    self.assertIsNone(vertex_model.to_vertex_response_schema(dict[str, int]))
+
+  async def test_generate_data_uses_constrained_decoding(self):
+    model = make_model('[{"name": "Topic", "subtopics": []}]')
+
+    result = await model.generate_data("prompt", List[Topic])
+
+    self.assertEqual(result, [Topic(name="Topic", subtopics=[])])
+    generation_config = model.llm.generate_content_async.call_args.kwargs[
+        "generation_config"
+    ]
+    raw_config = generation_config._raw_generation_config
+    self.assertEqual(raw_config.response_mime_type, "application/json")
+    self.assertEqual(raw_config.temperature, 0)
+    self.assertEqual(raw_config.response_schema.items.property_ordering, [
+        "name",
+        "subtopics",
+    ])
+
+  async def test_generate_data_falls_back_for_unsupported_schemas(self):
+    model = make_model('```json\n{"children": []}\n```')
+
+    result = await model.generate_data("prompt", TreeNode)
+
+    self.assertEqual(result, TreeNode(children=[]))
+    self.assertIsNone(
+        model.llm.generate_content_async.call_args.kwargs["generation_config"]
+    )
+
+  async def test_generate_data_repairs_invalid_output(self):
+    model = make_model(
+        '{"name": "a"}',
+        '{"name": "a", "subtopics": []}',
+    )
+
+    result = await model.generate_data("long prompt", Topic)
+
+    self.assertEqual(result, Topic(name="a", subtopics=[]))
+    calls = model.llm.generate_content_async.call_args_list
+    self.assertEqual(len(calls), 2)
+    repair_prompt = calls[1].args[0]
+    self.assertNotIn("long prompt", repair_prompt)
+    self.assertIn('{"name": "a"}', repair_prompt)
+    self.assertIn("subtopics", repair_prompt)
+
+  async def test_generate_data_repairs_again_when_repair_fails(self):
+    model = make_model(
+        '{"name": "a"}',
+        "still invalid",
+        '{"name": "b", "subtopics": []}',
+    )
+
+    result = await model.generate_data("long prompt", Topic)
+
+    self.assertEqual(result, Topic(name="b", subtopics=[]))
+    prompts = [
+        c.args[0] for c in model.llm.generate_content_async.call_args_list
+    ]
+    self.assertEqual(prompts[0], "long prompt")
+    self.assertIn('{"name": "a"}', prompts[1])
+    self.assertIn("still invalid", prompts[2])
+
+  async def test_generate_data_does_not_resend_identical_prompts(self):
+    model = make_model('{"name": "a"}', '{"name": "a"}', '{"name": "a"}')
+
+    with self.assertRaises(ValueError):
+      await model.generate_data("long prompt", Topic)
+
+    # The second repair prompt would be the same as the first one.
+    self.assertEqual(model.llm.generate_content_async.call_count, 2)
+
+  async def test_generate_data_attempts_are_capped(self):
+    model = make_model(*[f'{{"name": "{i}"}}' for i in range(10)])
+
+    with self.assertRaises(ValueError):
+      await model.generate_data("long prompt", Topic)
+
+    self.assertEqual(
+        model.llm.generate_content_async.call_count,
+        model_util.MAX_STRUCTURED_OUTPUT_ATTEMPTS,
+    )
+
+  async def test_generate_data_without_repair(self):
+    model = make_model(
+        '{"name": "a"}',
+        '{"name": "b", "subtopics": []}',
+    )
+    model.repair_invalid_output = False
+
+    with self.assertRaises(ValueError):
+      await model.generate_data("long prompt", Topic)
+
+    # The full prompt isn't sent again, since it would mostly get the same
+    # output back.
+    self.assertEqual(model.llm.generate_content_async.call_count, 1)
+
+  def test_credential_refresher_refreshes_before_expiry(self):
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    credentials = MagicMock()
+    credentials.expiry = now + datetime.timedelta(minutes=30)
+    refresher = vertex_model.CredentialRefresher(
+        credentials, MagicMock(), refresh_margin_sec=300
+    )
+
+    self.assertFalse(refresher.refresh_if_needed())
+    credentials.refresh.assert_not_called()
+
+    credentials.expiry = now + datetime.timedelta(minutes=2)
+    self.assertTrue(refresher.refresh_if_needed())
+    credentials.refresh.assert_called_once_with(refresher.auth_request)
+
+  def test_credential_refresher_survives_refresh_errors(self):
+    credentials = MagicMock()
+    credentials.expiry = datetime.datetime(2000, 1, 1)
+    credentials.refresh.side_effect = Exception("network error")
+    refresher = vertex_model.CredentialRefresher(credentials, MagicMock())
+
+    self.assertFalse(refresher.refresh_if_needed())
+
+  def test_credential_refresher_thread_stops(self):
+    refresher = vertex_model.CredentialRefresher(
+        MagicMock(), MagicMock(), check_interval_sec=0.01
+    )
+    with refresher:
+      self.assertTrue(refresher._thread.is_alive())
+
+    self.assertIsNone(refresher._thread)
+
+  def test_split_into_token_bounded_chunks(self):
+    items = ["a" * 8, "b" * 8, "c" * 8, "d" * 40, "e" * 4]
+    chunks = vertex_model.split_into_token_bounded_chunks(items, max_tokens=4)
+    self.assertEqual(
+        chunks, [["a" * 8, "b" * 8], ["c" * 8], ["d" * 40], ["e" * 4]]
+    )
+
+  async def test_map_reduce_chunks_and_reduces_in_order(self):
+    model = VertexModel.__new__(VertexModel)
+    model.generate_text = AsyncMock(side_effect=lambda prompt: prompt.upper())
+    result = await model.map_reduce(
+        ["ab", "cd", "ef"],
+        build_prompt=lambda chunk: ",".join(chunk),
+        reduce=lambda results: "|".join(results),
+        max_chunk_tokens=1,
+    )
+    self.assertEqual(result, "AB|CD|EF")
+    self.assertEqual(model.generate_text.call_count, 3)
+
+  async def test_map_reduce_halves_chunks_over_token_limit(self):
+    model = VertexModel.__new__(VertexModel)
+
+    async def generate_data(prompt, schema):
+      if len(prompt.split(",")) > 2:
+        raise TokenLimitExceededError("too long")
+      return [prompt]
+
+    model.generate_data = AsyncMock(side_effect=generate_data)
+    result = await model.map_reduce(
+        ["a", "b", "c", "d", "e"],
+        build_prompt=lambda chunk: ",".join(chunk),
+        reduce=lambda results: [r for rs in results for r in rs],
+        schema=List[str],
+    )
+    self.assertEqual(result, ["a,b", "c", "d,e"])
+
+  async def test_map_reduce_raises_if_single_item_too_long(self):
+    model = VertexModel.__new__(VertexModel)
+    model.generate_text = AsyncMock(side_effect=TokenLimitExceededError("x"))
+    with self.assertRaises(TokenLimitExceededError):
+      await model.map_reduce(
+          ["a"], build_prompt="".join, reduce=lambda results: results
+      )
+
 
 if __name__ == "__main__":
   unittest.main()